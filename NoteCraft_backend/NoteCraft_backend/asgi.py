@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'NoteCraft_backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported after Django is set up, it reads settings and the Celery app
+from NoteMaker.task_events import task_events, EVENTS_PREFIX
+
+
+async def application(scope, receive, send):
+    # task events hold a connection open per waiting client, so they bypass the Django request cycle
+    if scope["type"] == "http" and scope["path"].startswith(EVENTS_PREFIX):
+        await task_events(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -1,6 +1,19 @@
 # your_project/celery.py
 import os
+import json
+import zlib
 from celery import Celery
+from kombu.serialization import register
+
+
+# JSON compressed with zlib; task results (full notes markdown) shrink several times in Redis
+def zjson_dumps(obj) -> bytes:
+    return zlib.compress(json.dumps(obj).encode("utf-8"))
+
+def zjson_loads(data) -> object:
+    return json.loads(zlib.decompress(data if isinstance(data, bytes) else data.encode("latin-1")))
+
+register('zjson', zjson_dumps, zjson_loads, content_type='application/x-zjson', content_encoding='binary')
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'NoteCraft_backend.settings') 
 
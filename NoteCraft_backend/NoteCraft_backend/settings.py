@@ -57,6 +57,8 @@ REST_FRAMEWORK = {
     ),
 }
 MIDDLEWARE = [
+    # outermost, so it sees the final response
+    'NoteMaker.middleware.async_streaming_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -110,8 +112,10 @@ CACHES = {
 }
 CELERY_BROKER_URL = os.getenv('REDIS_URL')
 CELERY_RESULT_BACKEND = CELERY_BROKER_URL
-CELERY_ACCEPT_CONTENT = ['json']
+CELERY_ACCEPT_CONTENT = ['json', 'zjson']
 CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'zjson'  # zlib-compressed JSON, registered in NoteCraft_backend/celery.py
+CELERY_RESULT_EXPIRES = timedelta(seconds=int(os.getenv('TASK_RESULT_TTL', '86400')))
 
 
 # Cloudinary configuration
@@ -23,16 +23,21 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('hello/', HelloWorldView.as_view()),
     path('generate_note/', GenerateNoteView.as_view()),
+    path('generate_note_stream/', GenerateNoteStreamView.as_view()),
     path('modify_image/', ModifyImageView.as_view()),
     path('modify_text/', ModifyTextView.as_view()),
+    path('modify_text_batch/', ModifyTextBatchView.as_view()),
     path('proxy-image/',ProxyImageView.as_view()),
     path('add_pdf/',DocumentUploadView.as_view()),
+    path('upload_status/<str:job_id>/', UploadStatusView.as_view(), name='upload_status'),
     path('api/signup/', SignupView.as_view(), name='signup'),
     path('api/login/', LoginView.as_view(), name='login'),
     path('search_pdfs/',ListDocumentView.as_view()),
+    path('delete_pdf/<uuid:document_id>/', DocumentDeleteView.as_view(), name='delete_pdf'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('logout/', LogoutView.as_view(), name="logout"),
     path('auth-status/', AuthStatusView.as_view(), name="auth-status"),
     path('task_status/<str:task_id>/', TaskStatusView.as_view(), name='task_status'),
     path('cancel_task/', CancelTaskView.as_view(), name='cancel_task'),
+    path('cache_stats/', CacheStatsView.as_view(), name='cache_stats'),
 ]
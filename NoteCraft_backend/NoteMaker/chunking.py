@@ -0,0 +1,50 @@
+import os
+from functools import lru_cache
+from typing import Dict, List
+import tiktoken
+
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "400"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+CHUNK_ENCODING = os.getenv("CHUNK_ENCODING", "cl100k_base")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = CHUNK_ENCODING) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(name)
+
+
+def chunk_text(text: str, chunk_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP) -> List[Dict]:
+    """
+    Split text into windows of chunk_tokens tokens, each sharing `overlap` tokens with the previous one.
+    Every chunk carries its character offsets into the text so it can be traced back to the source.
+    """
+    if overlap >= chunk_tokens:
+        raise ValueError("overlap must be smaller than chunk_tokens")
+    enc = get_encoding()
+    tokens = enc.encode(text, disallowed_special=())
+    if not tokens:
+        return []
+    decoded, offsets = enc.decode_with_offsets(tokens)
+    chunks = []
+    step = chunk_tokens - overlap
+    for index, start in enumerate(range(0, len(tokens), step)):
+        end = min(start + chunk_tokens, len(tokens))
+        char_start = offsets[start]
+        char_end = offsets[end] if end < len(tokens) else len(decoded)
+        chunks.append({
+            "text": decoded[char_start:char_end],
+            "chunk_index": index,
+            "start": char_start,
+            "end": char_end,
+        })
+        if end == len(tokens):
+            break
+    return chunks
+
+
+def chunk_document(doc: Dict, chunk_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP) -> List[Dict]:
+    """
+    Chunk doc["text"], copying every other key of the document onto each chunk.
+    """
+    fields = {k: v for k, v in doc.items() if k != "text"}
+    return [{**fields, **chunk} for chunk in chunk_text(doc["text"], chunk_tokens, overlap)]
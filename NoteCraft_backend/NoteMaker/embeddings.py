@@ -0,0 +1,112 @@
+import os
+import time
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from dotenv import load_dotenv
+from .redis_cache import RedisLRUCache, hash_key
+from .pinecone_client import get_pinecone
+load_dotenv()
+
+EMBED_MODEL = "llama-text-embed-v2"
+EMBED_BATCH_WINDOW = float(os.getenv("EMBED_BATCH_WINDOW", "0.01"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "96"))  # llama-text-embed-v2 input limit per call
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "30"))
+
+embedding_cache = RedisLRUCache(
+    "embeddings",
+    ttl=int(os.getenv("EMBED_CACHE_TTL", str(30 * 24 * 3600))),
+    max_entries=int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "200000")),
+)
+
+
+class EmbeddingBatcher:
+    """
+    Collects embed requests from every thread in the process for EMBED_BATCH_WINDOW seconds
+    and sends them to Pinecone as one multi-input call per input_type.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.queue: "queue.Queue[Tuple[str, str, Future]]" = queue.Queue()
+        self.pid: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def submit(self, text: str, input_type: str) -> Future:
+        self._ensure_worker()
+        future: Future = Future()
+        self.queue.put((text, input_type, future))
+        return future
+
+    def _ensure_worker(self) -> None:
+        # threads don't survive a fork, so each gunicorn / celery child starts its own
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+                self.pid = os.getpid()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: List[Tuple[str, str, Future]]) -> None:
+        by_type: Dict[str, List[Tuple[str, Future]]] = defaultdict(list)
+        for text, input_type, future in batch:
+            by_type[input_type].append((text, future))
+        for input_type, items in by_type.items():
+            texts = list(dict.fromkeys(text for text, _ in items))
+            try:
+                result = get_pinecone().inference.embed(
+                    model=EMBED_MODEL,
+                    inputs=texts,
+                    parameters={"input_type": input_type},
+                )
+                vectors = {text: np.asarray(e.values, dtype=np.float32) for text, e in zip(texts, result)}
+                for text, future in items:
+                    future.set_result(vectors[text])
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+
+
+batcher = EmbeddingBatcher(window=EMBED_BATCH_WINDOW, max_batch=EMBED_MAX_BATCH)
+
+
+def embed_texts(texts: List[str], input_type: str = "query") -> List[np.ndarray]:
+    """
+    Embed texts through the shared cache, sending only the misses to Pinecone via the micro-batcher.
+    Vectors are cached as raw float32 bytes.
+    """
+    keys = [hash_key(EMBED_MODEL, input_type, text) for text in texts]
+    vectors: List[Optional[np.ndarray]] = [
+        np.frombuffer(raw, dtype=np.float32) if raw is not None else None
+        for raw in embedding_cache.get_many(keys)
+    ]
+    futures = {i: batcher.submit(texts[i], input_type) for i, v in enumerate(vectors) if v is None}
+    fresh: Dict[str, bytes] = {}
+    for i, future in futures.items():
+        vectors[i] = future.result(timeout=EMBED_TIMEOUT)
+        fresh[keys[i]] = vectors[i].tobytes() # type: ignore
+    embedding_cache.set_many(fresh)
+    return vectors # type: ignore
+
+
+def embed_text(text: str, input_type: str = "query") -> np.ndarray:
+    return embed_texts([text], input_type)[0]
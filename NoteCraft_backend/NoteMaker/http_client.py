@@ -0,0 +1,117 @@
+import os
+import asyncio
+import threading
+import weakref
+from typing import Optional, Tuple
+import httpx
+import requests
+from requests.exceptions import RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+load_dotenv()
+
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.5"))
+
+DEFAULT_TIMEOUT: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT)
+ASYNC_POOL_SIZE = int(os.getenv("HTTP_ASYNC_POOL_SIZE", "200"))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    # requests has no session-wide timeout, so apply the default to every call that doesn't pass one
+    def request(self, method, url, **kwargs): # type: ignore
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+def _build_session() -> requests.Session:
+    retry = Retry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        # a read timeout means the request was sent: a POST would be re-run and billed again, outside the token bucket
+        read=0,
+        other=0,
+        status=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,  # LLM calls are POSTs, retry them too
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = TimeoutSession()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Process-wide keep-alive session with per-host pooling, timeouts and retry/backoff.
+    Built lazily in each process so pooled sockets are never shared across a gunicorn or celery fork.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = _build_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def _reset_after_fork() -> None:
+    # the lock may have been held by another thread at fork time
+    global _session, _session_pid, _lock
+    _lock = threading.Lock()
+    _session = None
+    _session_pid = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# an AsyncClient's connections belong to the event loop that opened them, so keep one client per loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=ASYNC_POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+            transport=httpx.AsyncHTTPTransport(retries=MAX_RETRIES),  # connection failures only
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def async_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    get_session()'s retry policy for the async client: retryable statuses are retried with
+    exponential backoff, honouring Retry-After, and the last response is returned as is.
+    Transport errors are raised as requests' RequestException, so sync and async callers handle the same errors.
+    """
+    client = get_async_client()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            raise RequestException(f"{type(e).__name__}: {e}") from e
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return response
+        retry_after = response.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.isdigit() else BACKOFF_FACTOR * 2 ** attempt
+        await response.aclose()
+        await asyncio.sleep(delay)
+    return response # type: ignore
@@ -0,0 +1,380 @@
+import io
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
+from requests.exceptions import RequestException
+from PIL import Image, ImageOps, UnidentifiedImageError
+from .http_client import get_session
+
+PROXY_CACHE_DIR = os.getenv("IMAGE_PROXY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "notecraft-image-cache"))
+PROXY_CACHE_BYTES = int(os.getenv("IMAGE_PROXY_CACHE_BYTES", str(512 * 1024 * 1024)))
+PROXY_MAX_OBJECT_BYTES = int(os.getenv("IMAGE_PROXY_MAX_OBJECT_BYTES", str(20 * 1024 * 1024)))
+# how long a cached original is served before it is revalidated against the origin
+PROXY_FRESH_SECONDS = int(os.getenv("IMAGE_PROXY_FRESH_SECONDS", str(24 * 3600)))
+PROXY_CACHE_CONTROL = f"public, max-age={int(os.getenv('IMAGE_PROXY_MAX_AGE', str(7 * 24 * 3600)))}"
+CHUNK_SIZE = 64 * 1024
+
+TRANSFORM_WORKERS = int(os.getenv("IMAGE_TRANSFORM_WORKERS", "2"))
+TRANSFORM_TIMEOUT = float(os.getenv("IMAGE_TRANSFORM_TIMEOUT", "20"))
+DEFAULT_QUALITY = 75
+MIN_WIDTH, MAX_WIDTH = 16, 2048
+OUTPUT_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+}
+transform_pool = ThreadPoolExecutor(max_workers=TRANSFORM_WORKERS, thread_name_prefix="image-transform")
+
+
+class ProxyError(Exception):
+    """
+    status is the HTTP status the view answers with: 400 for a URL the proxy refuses, 500 otherwise.
+    """
+
+    def __init__(self, message: str, status: int = 500):
+        super().__init__(message)
+        self.status = status
+
+
+class DiskImageCache:
+    """
+    Byte-bounded LRU cache of image bodies on local disk, shared by every process on the host.
+    Each entry is <key>.bin plus <key>.json metadata; the body's mtime is bumped on every hit and the
+    oldest bodies are removed once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_object_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.evict_lock = threading.Lock()
+
+    @staticmethod
+    def key(url: str, variant: str = "") -> str:
+        return hashlib.sha256(f"{url}\x1f{variant}".encode("utf-8")).hexdigest()
+
+    def paths(self, key: str) -> Tuple[Path, Path]:
+        return self.directory / f"{key}.bin", self.directory / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Dict]:
+        body, meta = self.paths(key)
+        try:
+            data = json.loads(meta.read_text())
+            os.utime(body)
+            return data
+        except (OSError, ValueError):
+            return None
+
+    def touch(self, key: str, **updates) -> None:
+        body, meta = self.paths(key)
+        try:
+            data = {**json.loads(meta.read_text()), **updates}
+            self._write_meta(meta, data)
+            os.utime(body)
+        except (OSError, ValueError):
+            pass
+
+    def open(self, key: str):
+        return open(self.paths(key)[0], "rb")
+
+    def _write_meta(self, path: Path, data: Dict) -> None:
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(data))
+        os.replace(tmp, path)
+
+    def store_bytes(self, key: str, data: bytes, meta: Dict) -> None:
+        if len(data) > self.max_object_bytes:
+            return
+        body, meta_path = self.paths(key)
+        tmp = body.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, body)
+        self._write_meta(meta_path, {**meta, "size": len(data)})
+        self.evict()
+
+    def store_stream(self, key: str, chunks: Iterator[bytes], meta: Dict) -> Iterator[bytes]:
+        """
+        Pass chunks through to the caller while spooling them to disk. The entry only appears once
+        the whole body has been read, so a dropped client or upstream never leaves a partial image.
+        """
+        body, meta_path = self.paths(key)
+        tmp = body.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        size = 0
+        complete = False
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size <= self.max_object_bytes:
+                        f.write(chunk)
+                    yield chunk
+            complete = size <= self.max_object_bytes
+            if complete:
+                os.replace(tmp, body)
+                self._write_meta(meta_path, {**meta, "size": size})
+        finally:
+            if not complete:
+                tmp.unlink(missing_ok=True)
+        self.evict()
+
+    def evict(self) -> None:
+        if not self.evict_lock.acquire(blocking=False):
+            return
+        try:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".bin"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.name[:-len(".bin")]))
+                    total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, key in sorted(entries):
+                body, meta = self.paths(key)
+                body.unlink(missing_ok=True)
+                meta.unlink(missing_ok=True)
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        finally:
+            self.evict_lock.release()
+
+
+image_cache = DiskImageCache(PROXY_CACHE_DIR, PROXY_CACHE_BYTES, PROXY_MAX_OBJECT_BYTES)
+
+
+def validate_url(url: str) -> None:
+    if urlparse(url).scheme not in ("http", "https"):
+        raise ProxyError("Only http and https image URLs can be proxied", status=400)
+
+
+def _entry_etag(key: str, meta: Dict) -> str:
+    return meta.get("etag") or f'"{key[:32]}-{meta.get("size", 0)}"'
+
+
+def _add_headers(response: HttpResponse, meta: Dict, etag: str) -> HttpResponse:
+    if etag:
+        response["ETag"] = etag
+    if meta.get("last_modified"):
+        response["Last-Modified"] = meta["last_modified"]
+    response["Cache-Control"] = PROXY_CACHE_CONTROL
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+def _client_has(request, meta: Dict, etag: str) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        return etag in parse_etags(if_none_match) or if_none_match.strip() == "*"
+    return bool(meta.get("last_modified")) and request.headers.get("If-Modified-Since") == meta["last_modified"]
+
+
+def serve_cached(request, key: str, meta: Dict) -> HttpResponse:
+    etag = _entry_etag(key, meta)
+    if _client_has(request, meta, etag):
+        return _add_headers(HttpResponse(status=304), meta, etag)
+    response = FileResponse(image_cache.open(key), content_type=meta.get("content_type"))
+    return _add_headers(response, meta, etag)
+
+
+def _iter_upstream(upstream) -> Iterator[bytes]:
+    # closing returns the pooled connection even when the client hangs up mid-body
+    try:
+        yield from upstream.iter_content(CHUNK_SIZE)
+    finally:
+        upstream.close()
+
+
+def _client_validators(request) -> Dict:
+    return {name: request.headers[name] for name in ("If-None-Match", "If-Modified-Since") if request.headers.get(name)}
+
+
+def _open_upstream(url: str, key: str, meta: Optional[Dict], validators: Optional[Dict] = None):
+    """
+    Start fetching url, revalidating the cached copy if there is one, otherwise with the client's own
+    validators when given, in which case the returned response may be a bodiless 304.
+    Returns None when the cached copy should be served (304, or origin down with a stale copy).
+    """
+    headers = dict(validators or {})
+    if meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        upstream = get_session().get(url, stream=True, headers=headers)
+        if upstream.status_code == 304 and meta:
+            upstream.close()
+            image_cache.touch(key, fetched_at=time.time())
+            return None
+        upstream.raise_for_status()
+        return upstream
+    except RequestException as e:
+        if meta:
+            # origin is down, a stale copy beats an error
+            return None
+        raise ProxyError(f"Failed to fetch image: {e}")
+
+
+def _upstream_meta(url: str, upstream) -> Dict:
+    return {
+        "url": url,
+        "content_type": upstream.headers.get("Content-Type"),
+        "etag": upstream.headers.get("ETag"),
+        "last_modified": upstream.headers.get("Last-Modified"),
+        "fetched_at": time.time(),
+    }
+
+
+def _is_fresh(meta: Optional[Dict]) -> bool:
+    return bool(meta) and time.time() - meta.get("fetched_at", 0) < PROXY_FRESH_SECONDS # type: ignore
+
+
+def proxy_image(request, url: str) -> HttpResponse:
+    """
+    Serve an external image through the disk cache: fresh entries straight from disk, stale ones
+    revalidated upstream with the stored validators, misses streamed to the client while being cached.
+    """
+    validate_url(url)
+    key = image_cache.key(url)
+    meta = image_cache.get(key)
+    if _is_fresh(meta):
+        try:
+            return serve_cached(request, key, meta) # type: ignore
+        except OSError:
+            # evicted between reading the metadata and opening the body
+            meta = None
+
+    # on a miss the client's validators go upstream, so a revalidating client still gets its 304
+    upstream = _open_upstream(url, key, meta, validators=None if meta else _client_validators(request))
+    if upstream is None:
+        return serve_cached(request, key, meta) # type: ignore
+
+    new_meta = _upstream_meta(url, upstream)
+    if upstream.status_code == 304:
+        upstream.close()
+        return _add_headers(HttpResponse(status=304), new_meta, new_meta["etag"])
+    body = _iter_upstream(upstream)
+    # requests decodes Content-Encoding, so the upstream length only holds for identity bodies
+    length = None if upstream.headers.get("Content-Encoding") else upstream.headers.get("Content-Length")
+    if not (length and int(length) > image_cache.max_object_bytes):
+        body = image_cache.store_stream(key, body, new_meta)
+    response = StreamingHttpResponse(body, content_type=new_meta["content_type"])
+    if length:
+        response["Content-Length"] = length
+    if new_meta["etag"]:
+        response["ETag"] = new_meta["etag"]
+    if new_meta["last_modified"]:
+        response["Last-Modified"] = new_meta["last_modified"]
+    response["Cache-Control"] = PROXY_CACHE_CONTROL
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+def fetch_original(url: str) -> Tuple[str, Dict]:
+    """
+    Make sure the original image is cached and fresh, downloading it whole if needed.
+    """
+    key = image_cache.key(url)
+    meta = image_cache.get(key)
+    if _is_fresh(meta):
+        return key, meta # type: ignore
+    upstream = _open_upstream(url, key, meta)
+    if upstream is None:
+        return key, meta # type: ignore
+    new_meta = _upstream_meta(url, upstream)
+    data = bytearray()
+    for chunk in _iter_upstream(upstream):
+        data.extend(chunk)
+        if len(data) > image_cache.max_object_bytes:
+            upstream.close()
+            raise ProxyError("Image is too large to transform")
+    image_cache.store_bytes(key, bytes(data), new_meta)
+    return key, {**new_meta, "size": len(data)}
+
+
+def parse_variant(params) -> Optional[Dict]:
+    """
+    Read w / q / format from the query string. None means serve the original untouched.
+    """
+    if not any(params.get(name) for name in ("w", "q", "format")):
+        return None
+    width = int(params.get("w") or 0)
+    quality = int(params.get("q") or DEFAULT_QUALITY)
+    fmt = (params.get("format") or "webp").lower()
+    if width and not MIN_WIDTH <= width <= MAX_WIDTH:
+        raise ValueError(f"w must be between {MIN_WIDTH} and {MAX_WIDTH}")
+    if not 1 <= quality <= 100:
+        raise ValueError("q must be between 1 and 100")
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(OUTPUT_FORMATS)}")
+    return {"width": width, "quality": quality, "format": fmt}
+
+
+def transform_image(data: bytes, width: int, quality: int, fmt: str) -> bytes:
+    pil_format = OUTPUT_FORMATS[fmt][0]
+    with Image.open(io.BytesIO(data)) as img:
+        if width and img.format == "JPEG":
+            # let libjpeg decode at a reduced scale instead of full size
+            img.draft("RGB", (width, max(1, width * img.height // img.width)))
+        frame = ImageOps.exif_transpose(img)
+        if width and frame.width > width:
+            frame = frame.resize((width, max(1, round(frame.height * width / frame.width))), Image.Resampling.LANCZOS)
+        if pil_format == "JPEG" and frame.mode not in ("RGB", "L"):
+            frame = frame.convert("RGB")
+        elif frame.mode == "P":
+            frame = frame.convert("RGBA")
+        out = io.BytesIO()
+        if pil_format == "PNG":
+            frame.save(out, pil_format, optimize=True)
+        else:
+            frame.save(out, pil_format, quality=quality)
+        return out.getvalue()
+
+
+def proxy_image_variant(request, url: str, variant: Dict) -> HttpResponse:
+    """
+    Resized / transcoded copy of an external image. Each variant is cached apart from the original
+    and rendered on a bounded pool so a burst of large images can't take over the worker.
+    """
+    validate_url(url)
+    variant_id = f"w={variant['width']}&q={variant['quality']}&f={variant['format']}"
+    key = image_cache.key(url, variant_id)
+    meta = image_cache.get(key)
+    if _is_fresh(meta):
+        try:
+            return serve_cached(request, key, meta) # type: ignore
+        except OSError:
+            pass
+
+    original_key, original_meta = fetch_original(url)
+    with image_cache.open(original_key) as f:
+        data = f.read()
+    try:
+        future = transform_pool.submit(transform_image, data, variant["width"], variant["quality"], variant["format"])
+        output = future.result(timeout=TRANSFORM_TIMEOUT)
+    except (UnidentifiedImageError, TimeoutError, OSError, ValueError, Image.DecompressionBombError):
+        # not something Pillow can re-encode (svg, broken data) or the pool is backed up: hand back the original
+        return serve_cached(request, original_key, original_meta)
+    new_meta = {
+        "url": url,
+        "variant": variant_id,
+        "content_type": OUTPUT_FORMATS[variant["format"]][1],
+        "etag": f'"{key[:32]}-{len(output)}"',
+        "last_modified": original_meta.get("last_modified"),
+        "fetched_at": original_meta.get("fetched_at", time.time()),
+    }
+    image_cache.store_bytes(key, output, new_meta)
+    response = HttpResponse(output, content_type=new_meta["content_type"])
+    return _add_headers(response, new_meta, new_meta["etag"])
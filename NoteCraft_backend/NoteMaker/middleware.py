@@ -0,0 +1,22 @@
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+from .streaming import aiterate
+
+
+@sync_and_async_middleware
+def async_streaming_middleware(get_response):
+    """
+    Under ASGI Django reads a sync streaming body to the end before sending it, which buffers proxied
+    images and cached files whole in memory. Such bodies are handed to aiterate so they go out chunk by
+    chunk; under WSGI every response passes through untouched.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            response = await get_response(request)
+            if response.streaming and not response.is_async:
+                response.streaming_content = aiterate(response.streaming_content)
+            return response
+    else:
+        def middleware(request):
+            return get_response(request)
+    return middleware
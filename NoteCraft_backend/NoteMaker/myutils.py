@@ -1,20 +1,43 @@
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterator, Optional
 import os
 import requests
+import httpx
+import asyncio
 import json
 from dotenv import load_dotenv
-from pinecone import Pinecone
 from google_images_search import GoogleImagesSearch
 from requests.exceptions import RequestException
 from django.core.cache import cache
+import threading
 import random
+import re
+from .redis_cache import RedisLRUCache, hash_key
+from .http_client import get_session, get_async_client, async_request, CONNECT_TIMEOUT
+from .embeddings import embed_text
+from .retrievers import get_retriever
+from .rate_limit import openrouter_governor, estimate_tokens, count_tokens
 load_dotenv()
-global gis
-gis = GoogleImagesSearch(developer_key=os.getenv("GOOGLE_API_KEY"), custom_search_cx=os.getenv("CX"))
+_gis_local = threading.local()
+
+PLACEHOLDER_IMAGE = "https://via.placeholder.com/150"
+IMAGE_SEARCH_WORKERS = int(os.getenv("IMAGE_SEARCH_WORKERS", "8"))
+IMAGE_SEARCH_DEADLINE = float(os.getenv("IMAGE_SEARCH_DEADLINE", "20"))
+IMAGE_RESULTS_PER_QUERY = 10
+
+image_cache = RedisLRUCache(
+    "images",
+    ttl=int(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600))),
+    max_entries=int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "20000")),
+)
+
+def get_gis() -> GoogleImagesSearch:
+    # GoogleImagesSearch keeps the last results on the instance, so each thread needs its own
+    if not hasattr(_gis_local, "gis"):
+        _gis_local.gis = GoogleImagesSearch(developer_key=os.getenv("GOOGLE_API_KEY"), custom_search_cx=os.getenv("CX"))
+    return _gis_local.gis
 
 OR_API_KEY=os.getenv("OPEN_ROUTER_API_KEY")
-pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-index = pc.Index("notecraft")
+OR_READ_TIMEOUT = float(os.getenv("OPEN_ROUTER_READ_TIMEOUT", "180"))
 
 topics_query:str="Generate 10 subtopics that should be covered in this topic from an academic perspective. " \
 "If subtopics are already present in the content, retain them without modification. " \
@@ -24,14 +47,47 @@ topics_query:str="Generate 10 subtopics that should be covered in this topic fro
     "eg-{'namespace': 'cs_math', 'topics': ['machine_learning_algorithms', ....]}"\
     "namespace list-physics,chemistry,energy_sustainability,mathematics_applied_math,earth_sciences,psychology_cognitive_science,biology,medicine,agriculture_food_science,engineering,technology_innovation,cs_math,social_sciences,arts_humanities,business_management,history,law_policy,philosophy_ethics"
 
-def request_OpenRouter(query:str)->str:
-    response = requests.post(
-        url="https://openrouter.ai/api/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {OR_API_KEY}",
-            "Content-Type": "application/json",
-        },
-        data=json.dumps({
+rework_instruction:str="rework this part of text to get more clarity and elaborate the ouput should be in ```text box the new content should not be more than 3 times original lenght"
+
+REWORK_BATCH_CHARS = int(os.getenv("REWORK_BATCH_CHARS", "6000"))  # section text per prompt; replies run up to 3x that
+
+def pack_sections(sections:List[str], budget:int=REWORK_BATCH_CHARS)->List[List[int]]:
+    """
+    Group section indexes greedily, in order, so each group's text fits the budget; an oversized section goes alone.
+    So does a section that already contains "<<<", since it could fake or break the delimiters of a packed reply.
+    """
+    groups: List[List[int]] = []
+    size = 0
+    packable = False
+    for i, text in enumerate(sections):
+        fits = "<<<" not in text
+        if groups and packable and fits and size + len(text) <= budget:
+            groups[-1].append(i)
+            size += len(text)
+        else:
+            groups.append([i])
+            size = len(text)
+            packable = fits
+    return groups
+
+def batch_rework_prompt(sections:List[str])->str:
+    blocks = "\n".join(f"<<<SECTION {n}>>>\n{text}\n<<<END {n}>>>" for n, text in enumerate(sections, start=1))
+    return "Rework each of the following sections of text separately to get more clarity and elaborate. " \
+        "Each reworked section should not be more than 3 times its original length. " \
+        "Return every section in the same delimiters with the same number, <<<SECTION n>>> and <<<END n>>>, " \
+        "in order and nothing else.\n" + blocks
+
+def parse_batch_rework(response:str, count:int)->Dict[int,str]:
+    # sections the model dropped or mangled are simply missing from the result
+    found = {}
+    for match in re.finditer(r"<<<SECTION (\d+)>>>(.*?)<<<END \1>>>", response, re.S):
+        n = int(match.group(1))
+        if 1 <= n <= count and match.group(2).strip():
+            found[n - 1] = match.group(2).strip()
+    return found
+
+def _openrouter_payload(query:str, stream:bool=False)->str:
+    return json.dumps({
             "model": "qwen/qwq-32b:free",
             "messages": [
             {
@@ -41,54 +97,254 @@ def request_OpenRouter(query:str)->str:
             ],
             "parameters": {
         "language": "en"  # Specify language preference
-    }
-
+    },
+            "stream": stream,
+            # OpenRouter only reports token usage on a stream when asked, in the last chunk
+            "usage": {"include": True},
         })
+
+def request_OpenRouter(query:str)->str:
+    # queues on the shared quota instead of bursting into 429s
+    estimated = estimate_tokens(query)
+    openrouter_governor.acquire(estimated)
+    response = get_session().post(
+        url="https://openrouter.ai/api/v1/chat/completions",
+        headers={
+            "Authorization": f"Bearer {OR_API_KEY}",
+            "Content-Type": "application/json",
+        },
+        data=_openrouter_payload(query),
+        timeout=(CONNECT_TIMEOUT, OR_READ_TIMEOUT)
+        )
+    response.raise_for_status()
+    body = response.json()
+    content = body['choices'][0]['message']['content']
+    openrouter_governor.settle(estimated, body["usage"]["total_tokens"] if body.get("usage") else count_tokens(query, content))
+    return content
+
+async def arequest_OpenRouter(query:str)->str:
+    """
+    request_OpenRouter for async views, on the shared async client and the same quota.
+    """
+    estimated = estimate_tokens(query)
+    await openrouter_governor.acquire_async(estimated)
+    response = await async_request(
+        "POST",
+        "https://openrouter.ai/api/v1/chat/completions",
+        headers={
+            "Authorization": f"Bearer {OR_API_KEY}",
+            "Content-Type": "application/json",
+        },
+        content=_openrouter_payload(query),
+        timeout=httpx.Timeout(OR_READ_TIMEOUT, connect=CONNECT_TIMEOUT)
         )
-    return response.json()['choices'][0]['message']['content']
+    if response.is_error:
+        raise RequestException(f"{response.status_code} error from OpenRouter: {response.text[:200]}")
+    # an HTML page or empty body on a 200 is an upstream failure like any other
+    try:
+        body = response.json()
+        content = body['choices'][0]['message']['content']
+    except (ValueError, IndexError, KeyError, TypeError) as e:
+        raise RequestException(f"Unexpected response from OpenRouter: {response.text[:200]}") from e
+    await openrouter_governor.settle_async(estimated, body["usage"]["total_tokens"] if body.get("usage")
+                                           else count_tokens(query, content))
+    return content
+
+def stream_OpenRouter(query:str)->Iterator[str]:
+    """
+    Same request as request_OpenRouter with stream: true, yielding content deltas as they arrive.
+    """
+    estimated = estimate_tokens(query)
+    openrouter_governor.acquire(estimated)
+    response = get_session().post(
+        url="https://openrouter.ai/api/v1/chat/completions",
+        headers={
+            "Authorization": f"Bearer {OR_API_KEY}",
+            "Content-Type": "application/json",
+        },
+        data=_openrouter_payload(query, stream=True),
+        stream=True,
+        timeout=(CONNECT_TIMEOUT, OR_READ_TIMEOUT)
+        )
+    response.raise_for_status()
+    response.encoding = "utf-8"
+    usage = None
+    received = []
+    try:
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                # blank keep-alives and ": OPENROUTER PROCESSING" comments carry no data
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    raise RequestException(chunk["error"].get("message", "OpenRouter stream error"))
+                if chunk.get("usage"):
+                    # sent with the final chunk
+                    usage = chunk["usage"]["total_tokens"]
+                if not chunk.get("choices"):
+                    continue
+                content = chunk["choices"][0].get("delta", {}).get("content")
+                if content:
+                    received.append(content)
+                    yield content
+    finally:
+        # no usage chunk (the client left early, or none was sent): count what was received instead
+        openrouter_governor.settle(estimated, usage if usage is not None else count_tokens(query, "".join(received)))
+
+def extract_block(text:str, fence:str)->str:
+    start = text.find(f"```{fence}") + len(f"```{fence}")
+    end = text.find("```", start)
+    return text[start:end].strip()
 
+def parse_topics(response:str)->Dict:
+    return json.loads(extract_block(response, "json"))
 
+def notes_prompt(topics:List[str], context:Dict)->str:
+    return "Objective: Act as an expert academic note-taking assistant. " \
+        f"Generate comprehensive, well-structured notes on {topics} with all tpics covered if context given later is irrelevent to topics, ignore it\
+        InstructionsStructure: Organize notes hierarchically with headings, subheadings and keep theword count high,\
+        Focus on clarity, accuracy, and relevance do not add double new line or meta text ever\
+        to include images write &&&image:(description of image)&&& at the place where you want to add the image this should be done in between the text\
+        example- &&&image:(diagram of the human eye)&&& use 2-3 images per heading at max\
+        output should be in ```markdown box keep the markup syntax the notes should have plenty text \
+        examples where applicable.Context: {context}"
 
-def get_context(topic:str,namespace:str)->Dict:
 
+def embed_query(text:str)->List[float]:
+    return embed_text(text, input_type="query").tolist()
+
+def get_context(topic:str,namespace:str,user_namespace:Optional[str]=None)->Dict:
+    """
+    Top matches from the subject namespace, plus the user's own uploads when user_namespace is given.
+    """
     try:
-        query_embedding=pc.inference.embed(
-                model="llama-text-embed-v2",
-                inputs=[topic],
-                parameters={"input_type": "query"},
-            )[0].values
-        results = index.query(
-                namespace=namespace,
-                vector=query_embedding,
-                top_k=3,
-                include_metadata=True
-            )
-        if results.matches: # type: ignore
-                # Fetch relevant documents from Pinecone
+        query_embedding=embed_query(topic)
+        matches = get_retriever().query(query_embedding, namespace=namespace, top_k=3)
+        if user_namespace:
+            own = get_retriever().query(query_embedding, namespace=user_namespace, top_k=3)
+            matches = sorted(matches + own, key=lambda match: match["score"], reverse=True)[:4]
+        if matches:
+                # Fetch relevant documents from the vector store
                 relevant_docs = [
-                    match.metadata["text"] for match in results.matches # type: ignore
+                    match["text"] for match in matches
                 ]
                 return {"message": "Relevant documents found", "documents": relevant_docs}
         else:
             return{"message":"No relevant documents found"}
     except Exception as e:
             print(e)
-            return {"message": "Error querying Pinecone", "error": str(e)}
+            return {"message": "Error querying vector store", "error": str(e)}
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+def search_images(query: str) -> List[str]:
+    """
+    Return every result URL for the query, from the shared cache when possible.
+    A single API call fetches the full page so new_image can pick alternatives without searching again.
+    """
+    key = hash_key(normalize_query(query))
+    cached = image_cache.get(key)
+    if cached is not None:
+        return json.loads(cached)
+    gis = get_gis()
+    gis.search(search_params={'q': query, 'num': IMAGE_RESULTS_PER_QUERY})
+    urls = [result.url for result in gis.results()]
+    if urls:
+        image_cache.set(key, json.dumps(urls).encode("utf-8"))
+    return urls
 
+# GoogleImagesSearch's defaults for an image search (searchType, start, safe), so both paths cache the same results
+IMAGE_SEARCH_PARAMS = {"searchType": "image", "num": IMAGE_RESULTS_PER_QUERY, "start": 1, "safe": "off"}
+IMAGE_VALIDATE_TIMEOUT = 5
+# the browser User-Agent GoogleImagesSearch sends when it checks a result
+IMAGE_VALIDATE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 6.2; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/27.0.1453.94 Safari/537.36"
+}
+
+async def _avalid_image(url: str) -> bool:
+    # the library's validate_images check: a direct 200 image response that states its length
+    try:
+        response = await get_async_client().head(url, timeout=IMAGE_VALIDATE_TIMEOUT, follow_redirects=False,
+                                                 headers=IMAGE_VALIDATE_HEADERS)
+    except httpx.HTTPError:
+        return False
+    return (response.status_code == 200 and "image" in response.headers.get("Content-Type", "")
+            and bool(response.headers.get("Content-Length")))
+
+async def asearch_images(query: str) -> List[str]:
+    """
+    search_images for async views. Calls the Custom Search JSON API that GoogleImagesSearch wraps
+    directly, since that library is blocking, with the same parameters and result validation;
+    results share search_images' cache entries.
+    """
+    key = hash_key(normalize_query(query))
+    # the shared cache is sync, so its Redis calls run off the event loop
+    cached = await asyncio.to_thread(image_cache.get, key)
+    if cached is not None:
+        return json.loads(cached)
+    response = await async_request("GET", "https://www.googleapis.com/customsearch/v1", params={
+        "key": os.getenv("GOOGLE_API_KEY"),
+        "cx": os.getenv("CX"),
+        "q": query,
+        **IMAGE_SEARCH_PARAMS,
+    })
+    if response.is_error:
+        raise RequestException(f"{response.status_code} error from image search")
+    try:
+        links = [item["link"] for item in response.json().get("items", [])]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise RequestException(f"Unexpected response from image search: {response.text[:200]}") from e
+    valid = await asyncio.gather(*(_avalid_image(link) for link in links))
+    urls = [link for link, ok in zip(links, valid) if ok]
+    if urls:
+        await asyncio.to_thread(image_cache.set, key, json.dumps(urls).encode("utf-8"))
+    return urls
+
+async def anew_image(query:str)->str:
+    urls = await asearch_images(query)
+    alternatives = urls[1:] or urls
+    return random.choice(alternatives) if alternatives else PLACEHOLDER_IMAGE
 
 def google_search_image(query: str) -> str:
 
     try:
-        gis.search(search_params={'q': query, 'num': 1})
-        image_url = gis.results()[0].url if gis.results() else "https://via.placeholder.com/150"
+        urls = search_images(query)
+        image_url = urls[0] if urls else PLACEHOLDER_IMAGE
 
         return image_url
     except (IndexError, RequestException):
-        return "https://via.placeholder.com/150"
+        return PLACEHOLDER_IMAGE
 
 def new_image(query:str)->str:
-    gis.search(search_params={'q': query, 'num': 5})
-    image_url = gis.results()[random.randint(0,5)].url if gis.results() else "https://via.placeholder.com/150"
+    urls = search_images(query)
+    # the first result is the one the notes already show
+    alternatives = urls[1:] or urls
+    image_url = random.choice(alternatives) if alternatives else PLACEHOLDER_IMAGE
     return image_url
+
+def image_queries(notes: str) -> List[str]:
+    return [line.split("image:", 1)[1].strip() for line in notes.split("&&&") if line.startswith("image:")]
+
+def fill_images(notes: str, urls: List[str]) -> str:
+    """
+    Replace the &&&image:...&&& markers, in order, with markdown images pointing at urls.
+    """
+    processed_notes = []
+    url_iter = iter(urls)
+    for line in notes.split("&&&"):
+        if line.startswith("image:"):
+            image_query = line.split("image:", 1)[1].strip()
+            processed_notes.append(f"![{image_query}]({next(url_iter, PLACEHOLDER_IMAGE)})")
+        else:
+            processed_notes.append(line)
+    return "".join(processed_notes)
+
 if __name__ == "__main__":
     print(google_search_image("Eiffel Tower"))
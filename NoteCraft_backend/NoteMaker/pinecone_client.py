@@ -0,0 +1,24 @@
+import os
+import threading
+from typing import Optional
+from dotenv import load_dotenv
+from pinecone import Pinecone
+load_dotenv()
+
+_client: Optional[Pinecone] = None
+_client_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+def get_pinecone() -> Pinecone:
+    """
+    The one Pinecone client the embedder and the retriever share. Built on first use, so the app
+    imports without PINECONE_API_KEY, and rebuilt per pid so pooled connections never cross a fork.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+                _client_pid = os.getpid()
+    return _client
@@ -0,0 +1,215 @@
+import os
+import time
+import asyncio
+import random
+from typing import Dict
+import redis
+from redis.commands.core import Script, AsyncScript
+from requests.exceptions import RequestException
+from .redis_cache import get_redis, get_async_redis
+
+OR_RPM = int(os.getenv("OPEN_ROUTER_RPM", "20"))
+OR_TPM = int(os.getenv("OPEN_ROUTER_TPM", "200000"))
+OR_MAX_QUEUE_WAIT = float(os.getenv("OPEN_ROUTER_MAX_QUEUE_WAIT", "60"))
+OR_EXPECTED_COMPLETION_TOKENS = int(os.getenv("OPEN_ROUTER_EXPECTED_COMPLETION_TOKENS", "1500"))
+
+# Refills both buckets continuously over a minute and takes from them together, or not at all.
+# Redis' clock is used so web and worker hosts agree on the time. Returns {wait_seconds, requests, tokens}.
+TAKE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local caps = {tonumber(ARGV[1]), tonumber(ARGV[2])}
+local costs = {tonumber(ARGV[3]), tonumber(ARGV[4])}
+local force = ARGV[5] == '1'
+local levels = {}
+local wait = 0
+for i = 1, 2 do
+    local state = redis.call('HMGET', KEYS[i], 'level', 'ts')
+    local level = tonumber(state[1]) or caps[i]
+    local ts = tonumber(state[2]) or now
+    local rate = caps[i] / 60
+    level = math.min(caps[i], level + math.max(0, now - ts) * rate)
+    levels[i] = level
+    -- a cost above the capacity waits for a full bucket rather than forever
+    local need = math.min(costs[i], caps[i])
+    if level < need then
+        wait = math.max(wait, (need - level) / rate)
+    end
+end
+if force or wait == 0 then
+    for i = 1, 2 do
+        levels[i] = math.min(caps[i], levels[i] - costs[i])
+    end
+    wait = 0
+end
+for i = 1, 2 do
+    redis.call('HSET', KEYS[i], 'level', tostring(levels[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[i], 120)
+end
+return {tostring(wait), tostring(levels[1]), tostring(levels[2])}
+"""
+
+RECORD_WAIT_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], 'acquired', 1)
+local waited = tonumber(ARGV[1])
+if waited > 0 then
+    redis.call('HINCRBY', KEYS[1], 'waited', 1)
+    redis.call('HINCRBY', KEYS[1], 'wait_ms_total', waited)
+    if waited > tonumber(redis.call('HGET', KEYS[1], 'wait_ms_max') or '0') then
+        redis.call('HSET', KEYS[1], 'wait_ms_max', waited)
+    end
+end
+"""
+
+
+class RateLimitTimeout(RequestException):
+    """
+    The quota did not free up within max_wait. A RequestException, so callers' retry handling applies.
+    """
+
+
+class TokenBucketGovernor:
+    """
+    Requests-per-minute and tokens-per-minute quota shared by every process through Redis.
+    acquire() blocks until both buckets can pay for a call; settle() corrects the token estimate
+    once the real usage is known. Redis being down lets calls through rather than failing them.
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int, max_wait: float):
+        self.prefix = f"notecraft:ratelimit:{name}"
+        self.keys = [f"{self.prefix}:rpm", f"{self.prefix}:tpm"]
+        self.stats_key = f"{self.prefix}:stats"
+        self.queued_key = f"{self.prefix}:queued"
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait = max_wait
+        # Script objects only hold the sha; the client is passed per call so forks get their own connection
+        self._take = Script(None, TAKE_SCRIPT.encode())
+        self._record = Script(None, RECORD_WAIT_SCRIPT.encode())
+        self._take_async = AsyncScript(None, TAKE_SCRIPT.encode()) # type: ignore
+        self._record_async = AsyncScript(None, RECORD_WAIT_SCRIPT.encode()) # type: ignore
+
+    def _call(self, requests: int, tokens: int, force: bool = False):
+        wait, rpm_level, tpm_level = self._take(keys=self.keys, args=[self.rpm, self.tpm, requests, tokens, int(force)],
+                                                client=get_redis())
+        return float(wait), float(rpm_level), float(tpm_level)
+
+    def acquire(self, tokens: int) -> float:
+        """
+        Wait for one request and `tokens` tokens of quota, returns the seconds spent waiting.
+        """
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        queued = False
+        try:
+            while True:
+                wait, _, _ = self._call(1, tokens)
+                if wait == 0:
+                    break
+                if not queued:
+                    get_redis().incr(self.queued_key)
+                    queued = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    get_redis().hincrby(self.stats_key, "timeouts", 1)
+                    raise RateLimitTimeout(f"OpenRouter quota still exhausted after {self.max_wait:.0f}s")
+                # jitter keeps a crowd of waiters from all retrying on the same tick
+                time.sleep(min(remaining, wait + random.uniform(0, 0.25)))
+            waited = time.monotonic() - started
+            self._record(keys=[self.stats_key], args=[int(waited * 1000)], client=get_redis())
+            return waited
+        except redis.RedisError as e:
+            print(f"Rate limiter {self.prefix} unavailable: {e}")
+            return time.monotonic() - started
+        finally:
+            if queued:
+                try:
+                    get_redis().decr(self.queued_key)
+                except redis.RedisError:
+                    pass
+
+    async def acquire_async(self, tokens: int) -> float:
+        """
+        acquire() for async views: waits on the event loop instead of blocking a thread.
+        """
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        queued = False
+        r = get_async_redis()
+        try:
+            while True:
+                wait, _, _ = await self._take_async(keys=self.keys, args=[self.rpm, self.tpm, 1, tokens, 0], client=r)
+                if float(wait) == 0:
+                    break
+                if not queued:
+                    await r.incr(self.queued_key)
+                    queued = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    await r.hincrby(self.stats_key, "timeouts", 1)
+                    raise RateLimitTimeout(f"OpenRouter quota still exhausted after {self.max_wait:.0f}s")
+                await asyncio.sleep(min(remaining, float(wait) + random.uniform(0, 0.25)))
+            waited = time.monotonic() - started
+            await self._record_async(keys=[self.stats_key], args=[int(waited * 1000)], client=r)
+            return waited
+        except redis.RedisError as e:
+            print(f"Rate limiter {self.prefix} unavailable: {e}")
+            return time.monotonic() - started
+        finally:
+            if queued:
+                try:
+                    await r.decr(self.queued_key)
+                except redis.RedisError:
+                    pass
+
+    async def settle_async(self, estimated: int, actual: int) -> None:
+        if actual == estimated:
+            return
+        try:
+            await self._take_async(keys=self.keys, args=[self.rpm, self.tpm, 0, actual - estimated, 1],
+                                   client=get_async_redis())
+        except redis.RedisError as e:
+            print(f"Rate limiter {self.prefix} unavailable: {e}")
+
+    def settle(self, estimated: int, actual: int) -> None:
+        if actual == estimated:
+            return
+        try:
+            self._call(0, actual - estimated, force=True)
+        except redis.RedisError as e:
+            print(f"Rate limiter {self.prefix} unavailable: {e}")
+
+    def stats(self) -> Dict:
+        try:
+            _, rpm_level, tpm_level = self._call(0, 0)
+            r = get_redis()
+            counters = {k.decode(): int(v) for k, v in r.hgetall(self.stats_key).items()} # type: ignore
+            acquired = counters.get("acquired", 0)
+            return {
+                "rpm_limit": self.rpm,
+                "tpm_limit": self.tpm,
+                "rpm_available": round(rpm_level, 2),
+                "tpm_available": round(tpm_level),
+                "queued": int(r.get(self.queued_key) or 0), # type: ignore
+                "acquired": acquired,
+                "waited": counters.get("waited", 0),
+                "timeouts": counters.get("timeouts", 0),
+                "avg_wait_ms": counters.get("wait_ms_total", 0) / acquired if acquired else 0.0,
+                "max_wait_ms": counters.get("wait_ms_max", 0),
+            }
+        except redis.RedisError as e:
+            return {"error": str(e)}
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English prompts, plus the reply we expect back
+    return len(text) // 4 + OR_EXPECTED_COMPLETION_TOKENS
+
+
+
+def count_tokens(prompt: str, completion: str) -> int:
+    # the same ~4 characters per token, for settling a call whose usage was not reported
+    return len(prompt) // 4 + len(completion) // 4
+
+
+openrouter_governor = TokenBucketGovernor("openrouter", rpm=OR_RPM, tpm=OR_TPM, max_wait=OR_MAX_QUEUE_WAIT)
@@ -0,0 +1,151 @@
+import os
+import time
+import asyncio
+import hashlib
+import weakref
+from typing import Dict, List, Optional
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+load_dotenv()
+
+_client: Optional[redis.Redis] = None
+_client_pid: Optional[int] = None
+
+def get_redis() -> redis.Redis:
+    # connections must not be shared across a fork (gunicorn / celery prefork), so rebuild per pid
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        _client_pid = os.getpid()
+    return _client
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aioredis.Redis]" = weakref.WeakKeyDictionary()
+
+def get_async_redis() -> aioredis.Redis:
+    # asyncio connections are bound to the loop they were opened on
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = aioredis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        _async_clients[loop] = client
+    return client
+
+def hash_key(*parts: str) -> str:
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class RedisLRUCache:
+    """
+    Byte-value cache shared by every web and worker process.
+    Entries expire after `ttl` seconds and the least recently used ones are dropped past `max_entries`.
+    """
+
+    def __init__(self, name: str, ttl: int, max_entries: int):
+        self.prefix = f"notecraft:{name}"
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lru_key = f"{self.prefix}:lru"
+        self.stats_key = f"{self.prefix}:stats"
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:v:{key}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            r = get_redis()
+            value = r.get(self._key(key))
+            pipe = r.pipeline(transaction=False)
+            if value is None:
+                pipe.hincrby(self.stats_key, "misses", 1)
+            else:
+                pipe.hincrby(self.stats_key, "hits", 1)
+                pipe.zadd(self.lru_key, {key: time.time()})
+            pipe.execute()
+            return value # type: ignore
+        except redis.RedisError as e:
+            print(f"Cache {self.prefix} unavailable: {e}")
+            return None
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        try:
+            r = get_redis()
+            values = r.mget([self._key(k) for k in keys])
+            hits = [k for k, v in zip(keys, values) if v is not None] # type: ignore
+            now = time.time()
+            pipe = r.pipeline(transaction=False)
+            if hits:
+                pipe.hincrby(self.stats_key, "hits", len(hits))
+                pipe.zadd(self.lru_key, {k: now for k in hits})
+            if len(hits) < len(keys):
+                pipe.hincrby(self.stats_key, "misses", len(keys) - len(hits))
+            pipe.execute()
+            return values # type: ignore
+        except redis.RedisError as e:
+            print(f"Cache {self.prefix} unavailable: {e}")
+            return [None] * len(keys)
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        if not items:
+            return
+        try:
+            r = get_redis()
+            now = time.time()
+            pipe = r.pipeline(transaction=False)
+            for key, value in items.items():
+                pipe.set(self._key(key), value, ex=self.ttl)
+            pipe.zadd(self.lru_key, {k: now for k in items})
+            pipe.execute()
+            self._evict(r)
+        except redis.RedisError as e:
+            print(f"Cache {self.prefix} unavailable: {e}")
+
+    def set(self, key: str, value: bytes) -> None:
+        try:
+            r = get_redis()
+            pipe = r.pipeline(transaction=False)
+            pipe.set(self._key(key), value, ex=self.ttl)
+            pipe.zadd(self.lru_key, {key: time.time()})
+            pipe.execute()
+            self._evict(r)
+        except redis.RedisError as e:
+            print(f"Cache {self.prefix} unavailable: {e}")
+
+    def delete(self, key: str) -> None:
+        try:
+            r = get_redis()
+            r.delete(self._key(key))
+            r.zrem(self.lru_key, key)
+        except redis.RedisError as e:
+            print(f"Cache {self.prefix} unavailable: {e}")
+
+    def _evict(self, r: redis.Redis) -> None:
+        # values expire on their own, this only keeps the LRU index in step and enforces the size bound
+        r.zremrangebyscore(self.lru_key, 0, time.time() - self.ttl)
+        overflow = r.zcard(self.lru_key) - self.max_entries # type: ignore
+        if overflow <= 0:
+            return
+        oldest = r.zrange(self.lru_key, 0, overflow - 1)
+        if oldest:
+            pipe = r.pipeline(transaction=False)
+            pipe.delete(*[self._key(k.decode()) for k in oldest]) # type: ignore
+            pipe.zrem(self.lru_key, *oldest) # type: ignore
+            pipe.execute()
+
+    def stats(self) -> Dict:
+        try:
+            r = get_redis()
+            counters = r.hgetall(self.stats_key)
+            hits = int(counters.get(b"hits", 0)) # type: ignore
+            misses = int(counters.get(b"misses", 0)) # type: ignore
+            total = hits + misses
+            return {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / total if total else 0.0,
+                "size": r.zcard(self.lru_key),
+            }
+        except redis.RedisError as e:
+            return {"error": str(e)}
@@ -0,0 +1,301 @@
+import os
+import json
+import fcntl
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+import numpy as np
+from dotenv import load_dotenv
+from .pinecone_client import get_pinecone
+load_dotenv()
+
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "pinecone")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", str(Path(__file__).resolve().parent.parent / "vector_index"))
+IVF_MIN_ROWS = int(os.getenv("LOCAL_IVF_MIN_ROWS", "50000"))
+IVF_NPROBE = int(os.getenv("LOCAL_IVF_NPROBE", "8"))
+UPSERT_BATCH = 100  # Pinecone upsert limit
+
+
+class Retriever(ABC):
+    """
+    Vector search over a namespace. query() returns the metadata of the top_k matches, best first,
+    each with a "score" added.
+    """
+
+    @abstractmethod
+    def query(self, vector: List[float], namespace: str, top_k: int = 3) -> List[Dict]:
+        ...
+
+    @abstractmethod
+    def upsert(self, namespace: str, records: List[Dict]) -> None:
+        """
+        records are {"id", "values", "metadata"} dicts, ids of the form "<doc_id>#<chunk_index>".
+        """
+
+    @abstractmethod
+    def delete_document(self, namespace: str, doc_id: str) -> int:
+        """
+        Remove every chunk of doc_id from namespace, returns how many were deleted.
+        """
+
+
+class PineconeRetriever(Retriever):
+    def __init__(self, index_name: str = "notecraft"):
+        self.index = get_pinecone().Index(index_name)
+
+    def query(self, vector: List[float], namespace: str, top_k: int = 3) -> List[Dict]:
+        results = self.index.query(
+                namespace=namespace,
+                vector=vector,
+                top_k=top_k,
+                include_metadata=True
+            )
+        return [{**match.metadata, "score": match.score} for match in results.matches] # type: ignore
+
+    def upsert(self, namespace: str, records: List[Dict]) -> None:
+        for i in range(0, len(records), UPSERT_BATCH):
+            self.index.upsert(vectors=records[i:i + UPSERT_BATCH], namespace=namespace)
+
+    def delete_document(self, namespace: str, doc_id: str) -> int:
+        # list() pages through ids by prefix, so a large document is removed one page at a time
+        deleted = 0
+        for ids in self.index.list(prefix=f"{doc_id}#", namespace=namespace):
+            self.index.delete(ids=ids, namespace=namespace)
+            deleted += len(ids)
+        return deleted
+
+
+class LocalNamespace:
+    """
+    One namespace of the local index, as written by LocalIndexWriter:
+      <ns>.json        header with dim and count
+      <ns>.f32         count x dim unit-norm float32 rows, memory-mapped
+      <ns>.meta.jsonl  one metadata object per row, with the record id under "_id" when known
+      <ns>.ivf.npz     optional centroids plus rows grouped by list (order, offsets)
+    """
+
+    def __init__(self, directory: Path, namespace: str):
+        header_path = directory / f"{namespace}.json"
+        self.mtime = header_path.stat().st_mtime_ns
+        header = json.loads(header_path.read_text())
+        self.vectors = np.memmap(directory / f"{namespace}.f32", dtype=np.float32, mode="r",
+                                 shape=(header["count"], header["dim"]))
+        with open(directory / f"{namespace}.meta.jsonl") as f:
+            self.metadata = [json.loads(line) for line in f]
+        self.ids = [item.pop("_id", None) for item in self.metadata]
+        ivf_path = directory / f"{namespace}.ivf.npz"
+        self.ivf = dict(np.load(ivf_path)) if ivf_path.exists() else None
+
+    def search(self, q: np.ndarray, top_k: int, nprobe: int) -> List[Dict]:
+        if self.ivf is None:
+            rows = None
+            scores = self.vectors @ q
+        else:
+            centroids, order, offsets = self.ivf["centroids"], self.ivf["order"], self.ivf["offsets"]
+            probe = np.argsort(centroids @ q)[::-1][:nprobe]
+            # sorted row ids keep the memmap reads sequential
+            rows = np.sort(np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe]))
+            scores = self.vectors[rows] @ q
+        if scores.size == 0:
+            return []
+        k = min(top_k, scores.size)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        ids = best if rows is None else rows[best]
+        return [{**self.metadata[i], "score": float(scores[j])} for i, j in zip(ids, best)]
+
+
+class LocalRetriever(Retriever):
+    """
+    In-process retriever over memory-mapped per-namespace matrices, for offline runs and tests.
+    Writes rebuild the namespace's files next to the live ones and swap them in under an exclusive
+    file lock; readers load under a shared lock and reload when the header changes.
+    """
+
+    def __init__(self, directory: str = LOCAL_INDEX_DIR, nprobe: int = IVF_NPROBE, ivf_min_rows: int = IVF_MIN_ROWS):
+        self.directory = Path(directory)
+        self.nprobe = nprobe
+        self.ivf_min_rows = ivf_min_rows
+        self.namespaces: Dict[str, LocalNamespace] = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _file_lock(self, namespace: str, operation: int) -> Iterator[None]:
+        with open(self.directory / f"{namespace}.lock", "a") as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _namespace(self, namespace: str) -> Optional[LocalNamespace]:
+        try:
+            mtime = (self.directory / f"{namespace}.json").stat().st_mtime_ns
+        except FileNotFoundError:
+            self.namespaces.pop(namespace, None)
+            return None
+        ns = self.namespaces.get(namespace)
+        if ns is None or ns.mtime != mtime:
+            with self.lock, self._file_lock(namespace, fcntl.LOCK_SH):
+                ns = self.namespaces.get(namespace)
+                if ns is None or ns.mtime != mtime:
+                    try:
+                        ns = self.namespaces[namespace] = LocalNamespace(self.directory, namespace)
+                    except FileNotFoundError:
+                        # the last row was deleted in between
+                        self.namespaces.pop(namespace, None)
+                        return None
+        return ns
+
+    def _rows(self, namespace: str) -> Dict[str, tuple]:
+        """
+        id -> (vector, metadata) of every row in namespace, in index order. Rows written without an id
+        (older LocalIndexWriter runs) are keyed by doc_id#chunk_index when their metadata has both.
+        """
+        header = self.directory / f"{namespace}.json"
+        if not header.exists():
+            return {}
+        ns = LocalNamespace(self.directory, namespace)
+        rows = {}
+        for i, (row_id, metadata) in enumerate(zip(ns.ids, ns.metadata)):
+            if row_id is None:
+                row_id = f"{metadata.get('doc_id')}#{metadata.get('chunk_index')}" if "doc_id" in metadata else f"#{i}"
+            rows[row_id] = (np.array(ns.vectors[i]), metadata)
+        return rows
+
+    def _rewrite(self, namespace: str, rows: Dict[str, tuple]) -> None:
+        files = [f"{namespace}{suffix}" for suffix in (".f32", ".meta.jsonl", ".ivf.npz", ".json")]
+        staging = Path(tempfile.mkdtemp(prefix=".rewrite-", dir=self.directory))
+        try:
+            if rows:
+                writer = LocalIndexWriter(str(staging), ivf_min_rows=self.ivf_min_rows)
+                writer.add(namespace, np.stack([vector for vector, _ in rows.values()]),
+                           [metadata for _, metadata in rows.values()], ids=list(rows))
+                writer.close()
+            # the header goes last, it is what readers check for changes
+            for name in files:
+                if (staging / name).exists():
+                    os.replace(staging / name, self.directory / name)
+                else:
+                    (self.directory / name).unlink(missing_ok=True)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def upsert(self, namespace: str, records: List[Dict]) -> None:
+        if not records:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self.lock, self._file_lock(namespace, fcntl.LOCK_EX):
+            rows = self._rows(namespace)
+            for record in records:
+                rows[record["id"]] = (np.asarray(record["values"], dtype=np.float32), record.get("metadata", {}))
+            self._rewrite(namespace, rows)
+            self.namespaces.pop(namespace, None)
+
+    def delete_document(self, namespace: str, doc_id: str) -> int:
+        if not (self.directory / f"{namespace}.json").exists():
+            return 0
+        with self.lock, self._file_lock(namespace, fcntl.LOCK_EX):
+            rows = self._rows(namespace)
+            kept = {row_id: row for row_id, row in rows.items() if not row_id.startswith(f"{doc_id}#")}
+            if len(kept) < len(rows):
+                self._rewrite(namespace, kept)
+                self.namespaces.pop(namespace, None)
+            return len(rows) - len(kept)
+
+    def query(self, vector: List[float], namespace: str, top_k: int = 3) -> List[Dict]:
+        ns = self._namespace(namespace)
+        if ns is None:
+            return []
+        q = np.asarray(vector, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1.0
+        return ns.search(q, top_k, self.nprobe)
+
+
+def train_ivf(vectors: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0) -> Dict[str, np.ndarray]:
+    """
+    Spherical k-means on a sample, then assign every row to its nearest centroid.
+    """
+    rng = np.random.default_rng(seed)
+    sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), nlist * 64), replace=False))]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroid = members.mean(axis=0)
+                centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+    assign = np.concatenate([
+        np.argmax(vectors[i:i + 65536] @ centroids.T, axis=1) for i in range(0, len(vectors), 65536)
+    ])
+    order = np.argsort(assign, kind="stable").astype(np.int64)
+    offsets = np.searchsorted(assign[order], np.arange(nlist + 1)).astype(np.int64)
+    return {"centroids": centroids, "order": order, "offsets": offsets}
+
+
+class LocalIndexWriter:
+    """
+    Streams vectors into LocalRetriever's file layout. Existing namespaces are overwritten on first add;
+    close() writes the headers and trains the IVF partitioning for namespaces of IVF_MIN_ROWS or more.
+    """
+
+    def __init__(self, directory: str = LOCAL_INDEX_DIR, ivf_min_rows: int = IVF_MIN_ROWS):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ivf_min_rows = ivf_min_rows
+        self.namespaces: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+
+    def add(self, namespace: str, vectors: np.ndarray, metadata: List[Dict], ids: Optional[List[str]] = None) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self.lock:
+            if namespace not in self.namespaces:
+                self.namespaces[namespace] = {
+                    "vectors": open(self.directory / f"{namespace}.f32", "wb"),
+                    "metadata": open(self.directory / f"{namespace}.meta.jsonl", "w"),
+                    "count": 0,
+                    "dim": vectors.shape[1],
+                }
+            ns = self.namespaces[namespace]
+            if vectors.shape[1] != ns["dim"]:
+                raise ValueError(f"Dimension mismatch for {namespace}: {vectors.shape[1]} != {ns['dim']}")
+            ns["vectors"].write(vectors.tobytes())
+            for i, item in enumerate(metadata):
+                ns["metadata"].write(json.dumps({**item, "_id": ids[i]} if ids else item) + "\n")
+            ns["count"] += len(vectors)
+
+    def close(self) -> None:
+        with self.lock:
+            for namespace, ns in self.namespaces.items():
+                ns["vectors"].close()
+                ns["metadata"].close()
+                (self.directory / f"{namespace}.json").write_text(json.dumps({"dim": ns["dim"], "count": ns["count"]}))
+                ivf_path = self.directory / f"{namespace}.ivf.npz"
+                if ns["count"] >= self.ivf_min_rows:
+                    vectors = np.memmap(self.directory / f"{namespace}.f32", dtype=np.float32, mode="r",
+                                        shape=(ns["count"], ns["dim"]))
+                    np.savez(ivf_path, **train_ivf(vectors, nlist=int(np.sqrt(ns["count"]))))
+                elif ivf_path.exists():
+                    ivf_path.unlink()
+            self.namespaces.clear()
+
+
+_retriever: Optional[Retriever] = None
+_retriever_pid: Optional[int] = None
+_retriever_lock = threading.Lock()
+
+def get_retriever() -> Retriever:
+    # rebuilt per pid like get_session(), so forked gunicorn and celery workers never share one
+    global _retriever, _retriever_pid
+    if _retriever is None or _retriever_pid != os.getpid():
+        with _retriever_lock:
+            if _retriever is None or _retriever_pid != os.getpid():
+                _retriever = LocalRetriever() if RETRIEVER_BACKEND == "local" else PineconeRetriever()
+                _retriever_pid = os.getpid()
+    return _retriever
@@ -0,0 +1,113 @@
+import os
+import json
+import uuid
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import redis
+from .redis_cache import RedisLRUCache, get_redis
+from .myutils import embed_query
+
+NOTE_CACHE_THRESHOLD = float(os.getenv("NOTE_CACHE_THRESHOLD", "0.92"))
+
+
+class SemanticNoteCache:
+    """
+    Finished notes keyed by query embedding.
+    Notes live in a RedisLRUCache (TTL + size bound, hit/miss counters); unit-normalised float32 query
+    vectors sit in one hash, at most max_entries of them. Each process keeps that hash as a matrix and
+    only re-reads it when the version counter moves, so a lookup is one GET and a matrix-vector product.
+    """
+
+    def __init__(self, threshold: float, ttl: int, max_entries: int):
+        self.threshold = threshold
+        self.store = RedisLRUCache("notes", ttl=ttl, max_entries=max_entries)
+        self.vectors_key = f"{self.store.prefix}:vectors"
+        self.version_key = f"{self.store.prefix}:vectors:version"
+        # (version, ids, matrix) as last read from Redis
+        self._snapshot: Optional[Tuple[bytes, List[str], np.ndarray]] = None
+
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def embed(self, query: str) -> Optional[np.ndarray]:
+        # a failed embedding only costs us the cache, never the generation
+        try:
+            return self._unit(embed_query(query))
+        except Exception as e:
+            print(f"Note cache embedding failed: {e}")
+            return None
+
+    def _vectors(self, r: redis.Redis) -> Tuple[List[str], np.ndarray]:
+        version = r.get(self.version_key) or b"0"
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] == version:
+            return snapshot[1], snapshot[2]
+        pipe = r.pipeline()
+        pipe.get(self.version_key)
+        pipe.hgetall(self.vectors_key)
+        version, raw = pipe.execute()
+        ids = [k.decode() for k in raw.keys()]
+        matrix = np.frombuffer(b"".join(raw.values()), dtype=np.float32).reshape(len(ids), -1) if ids else np.empty((0, 0))
+        self._snapshot = (version or b"0", ids, matrix)
+        return ids, matrix
+
+    def lookup(self, vector: np.ndarray) -> Optional[Dict]:
+        try:
+            r = get_redis()
+            ids, matrix = self._vectors(r)
+            if not ids:
+                r.hincrby(self.store.stats_key, "misses", 1)
+                return None
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                r.hincrby(self.store.stats_key, "misses", 1)
+                return None
+        except (redis.RedisError, ValueError) as e:
+            print(f"Note cache lookup failed: {e}")
+            return None
+        value = self.store.get(ids[best])
+        if value is None:
+            # notes expired or were evicted, drop the stale vector
+            try:
+                pipe = get_redis().pipeline()
+                pipe.hdel(self.vectors_key, ids[best])
+                pipe.incr(self.version_key)
+                pipe.execute()
+            except redis.RedisError as e:
+                print(f"Note cache cleanup failed: {e}")
+            return None
+        entry = json.loads(value)
+        entry["similarity"] = float(similarities[best])
+        return entry
+
+    def put(self, vector: np.ndarray, query: str, notes: str) -> None:
+        entry_id = uuid.uuid4().hex
+        self.store.set(entry_id, json.dumps({"query": query, "notes": notes}).encode("utf-8"))
+        try:
+            r = get_redis()
+            r.hset(self.vectors_key, entry_id, vector.astype(np.float32).tobytes())
+            live = {k.decode() for k in r.zrange(self.store.lru_key, 0, -1)} # type: ignore
+            stale = [k for k in r.hkeys(self.vectors_key) if k.decode() not in live] # type: ignore
+            pipe = r.pipeline()
+            if stale:
+                pipe.hdel(self.vectors_key, *stale)
+            pipe.incr(self.version_key)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Note cache store failed: {e}")
+
+    def stats(self) -> Dict:
+        stats = self.store.stats()
+        stats["threshold"] = self.threshold
+        return stats
+
+
+note_cache = SemanticNoteCache(
+    threshold=NOTE_CACHE_THRESHOLD,
+    ttl=int(os.getenv("NOTE_CACHE_TTL", str(24 * 3600))),
+    max_entries=int(os.getenv("NOTE_CACHE_MAX_ENTRIES", "1000")),
+)
@@ -0,0 +1,83 @@
+import os
+from typing import Optional
+import redis
+from redis.commands.core import Script
+from celery import states
+from celery.result import AsyncResult
+from NoteCraft_backend.celery import app
+from .redis_cache import get_redis, hash_key
+from .myutils import normalize_query
+
+# how long a running generation holds its key without reporting progress; each pipeline stage renews it,
+# so it has to cover the slowest stage (an LLM call after queueing on the rate limiter)
+FLIGHT_LEASE_SECONDS = int(os.getenv("SINGLE_FLIGHT_LEASE", "300"))
+# the lease a claim starts with, while the leader waits in the queue; the worker cuts it to
+# FLIGHT_LEASE_SECONDS when the task starts. A backlog must not make a queued leader look lost,
+# so this has to cover the longest queue wait; a leader that never runs is replaced once it lapses.
+FLIGHT_QUEUED_SECONDS = int(os.getenv("SINGLE_FLIGHT_QUEUED_LEASE", "1800"))
+
+# only the task that holds the key may renew or drop it
+EXTEND_SCRIPT = Script(None, b"""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+RELEASE_SCRIPT = Script(None, b"""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def flight_key(query: str, user_namespace: Optional[str] = None, use_cache: bool = True) -> str:
+    parts = [normalize_query(query), user_namespace or "", "cache" if use_cache else "fresh"]
+    return f"notecraft:inflight:{hash_key(*parts)}"
+
+
+def claim_flight(key: str, task_id: str) -> Optional[str]:
+    """
+    Try to become the leader for key under task_id. Returns the leader's task id when another
+    generation is already in flight, None when the caller should start its own.
+    A leader that failed or was revoked is replaced; if Redis is down every request leads.
+    """
+    try:
+        r = get_redis()
+        for _ in range(2):
+            if r.set(key, task_id, nx=True, ex=FLIGHT_QUEUED_SECONDS):
+                return None
+            leader = r.get(key)
+            if leader is None:
+                continue
+            leader = leader.decode() # type: ignore
+            if not _leader_lost(r, key, leader):
+                return leader
+            RELEASE_SCRIPT(keys=[key], args=[leader], client=r)
+        return None
+    except redis.RedisError as e:
+        print(f"Single-flight unavailable: {e}")
+        return None
+
+
+def _leader_lost(r, key: str, leader: str) -> bool:
+    # PENDING is also a leader still in the queue, so only its lease running out gives it up
+    return AsyncResult(leader, app=app).state in (states.FAILURE, states.REVOKED)
+
+
+def extend_flight(key: Optional[str], task_id: str) -> None:
+    if not key:
+        return
+    try:
+        EXTEND_SCRIPT(keys=[key], args=[task_id, FLIGHT_LEASE_SECONDS], client=get_redis())
+    except redis.RedisError as e:
+        print(f"Single-flight unavailable: {e}")
+
+
+def release_flight(key: Optional[str], task_id: str) -> None:
+    if not key:
+        return
+    try:
+        RELEASE_SCRIPT(keys=[key], args=[task_id], client=get_redis())
+    except redis.RedisError as e:
+        print(f"Single-flight unavailable: {e}")
@@ -0,0 +1,262 @@
+import json
+import time
+import asyncio
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple, TypeVar
+from rest_framework.renderers import BaseRenderer
+from .semantic_cache import note_cache
+from .myutils import (
+    get_context, google_search_image, request_OpenRouter, stream_OpenRouter,
+    parse_topics, notes_prompt, topics_query,
+    PLACEHOLDER_IMAGE, IMAGE_SEARCH_WORKERS, IMAGE_SEARCH_DEADLINE,
+)
+
+MARKDOWN_FENCE = "```markdown"
+FENCE = "```"
+MARKER = "&&&"
+IMAGE_PREFIX = "image:"
+PENDING_IMAGE = "image-pending:{}"
+# items a producer thread may run ahead of a slow client
+AITERATE_BUFFER = 32
+
+T = TypeVar("T")
+
+
+class NoteStreamParser:
+    """
+    Incremental version of the ```markdown extraction and &&&image:...&&& split done in generate_notes_task.
+    feed() returns ("markdown", text) and ("image", query) events; anything that could be the start of a
+    fence or marker is held back until the next chunk decides it, as is trailing whitespace so the
+    output matches the strip() of the non-streaming path.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.state = "preamble"
+        self.started = False
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        self.buffer += text
+        events: List[Tuple[str, str]] = []
+        while True:
+            if self.state == "preamble":
+                idx = self.buffer.find(MARKDOWN_FENCE)
+                if idx == -1:
+                    return events
+                self.buffer = self.buffer[idx + len(MARKDOWN_FENCE):]
+                self.state = "body"
+            elif self.state == "body":
+                if not self.started:
+                    self.buffer = self.buffer.lstrip()
+                    if not self.buffer:
+                        return events
+                    self.started = True
+                fence = self.buffer.find(FENCE)
+                marker = self.buffer.find(MARKER)
+                if fence != -1 and (marker == -1 or fence < marker):
+                    self._emit_text(events, self.buffer[:fence].rstrip())
+                    self.buffer = ""
+                    self.state = "done"
+                    return events
+                if marker != -1:
+                    self._emit_text(events, self.buffer[:marker])
+                    close = self.buffer.find(MARKER, marker + len(MARKER))
+                    if close == -1:
+                        self.buffer = self.buffer[marker:]
+                        return events
+                    self._emit_segment(events, self.buffer[marker + len(MARKER):close])
+                    self.buffer = self.buffer[close + len(MARKER):]
+                    continue
+                cut = len(self.buffer[:len(self.buffer) - self._partial_suffix(self.buffer)].rstrip())
+                self._emit_text(events, self.buffer[:cut])
+                self.buffer = self.buffer[cut:]
+                return events
+            else:
+                return events
+
+    def finish(self) -> List[Tuple[str, str]]:
+        events: List[Tuple[str, str]] = []
+        if self.state == "body":
+            if self.buffer.startswith(MARKER):
+                self._emit_segment(events, self.buffer[len(MARKER):].rstrip())
+            else:
+                self._emit_text(events, self.buffer.rstrip())
+        self.buffer = ""
+        self.state = "done"
+        return events
+
+    @staticmethod
+    def _partial_suffix(text: str) -> int:
+        # length of the longest tail that is a prefix of ``` or &&&
+        for size in (2, 1):
+            tail = text[-size:]
+            if len(tail) == size and (FENCE.startswith(tail) or MARKER.startswith(tail)):
+                return size
+        return 0
+
+    @staticmethod
+    def _emit_text(events: List[Tuple[str, str]], text: str) -> None:
+        if text:
+            events.append(("markdown", text))
+
+    @staticmethod
+    def _emit_segment(events: List[Tuple[str, str]], segment: str) -> None:
+        if segment.startswith(IMAGE_PREFIX):
+            events.append(("image", segment.split(IMAGE_PREFIX, 1)[1].strip()))
+        else:
+            NoteStreamParser._emit_text(events, segment)
+
+
+def sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class EventStreamRenderer(BaseRenderer):
+    # lets DRF accept "Accept: text/event-stream"; only plain Responses (errors) go through render()
+    media_type = "text/event-stream"
+    format = "sse"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None): # type: ignore
+        return sse("error", data).encode(self.charset)
+
+
+class _Finished:
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+async def aiterate(iterator: Iterator[T], buffer: int = AITERATE_BUFFER) -> AsyncIterator[T]:
+    """
+    Serve a blocking iterator from async code. Under ASGI Django reads a sync streaming body to the end
+    before sending a byte, so a thread drives the iterator and hands each item to the event loop as it
+    is produced. When the consumer stops, the thread closes the iterator after its current item.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    slots = threading.Semaphore(buffer)
+    stopped = threading.Event()
+
+    def send(item) -> None:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            pass  # the loop is gone, so is the consumer
+
+    def produce() -> None:
+        error = None
+        try:
+            for item in iterator:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                send(item)
+        except Exception as e:
+            error = e
+        finally:
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+            send(_Finished(error))
+
+    threading.Thread(target=produce, name="aiterate", daemon=True).start()
+    try:
+        while True:
+            item = await queue.get()
+            if isinstance(item, _Finished):
+                if item.error:
+                    raise item.error
+                return
+            slots.release()
+            yield item
+    finally:
+        stopped.set()
+        slots.release()
+
+
+def stream_notes(query: str, use_cache: bool = True, user_namespace: Optional[str] = None) -> Iterator[str]:
+    """
+    Server-Sent Events for one note generation.
+    markdown events carry text as it is generated; images appear as ![query](image-pending:<id>)
+    and are followed by an image event with the real url once the lookup resolves.
+    Notes built on a user's own uploads (user_namespace) bypass the shared note cache both ways.
+    """
+    prompt_1 = query + topics_query
+    try:
+        query_vector = None if user_namespace else note_cache.embed(query)
+        if query_vector is not None and use_cache:
+            cached = note_cache.lookup(query_vector)
+            if cached:
+                yield sse("markdown", {"text": cached["notes"]})
+                yield sse("done", {"success": True, "cached": True})
+                return
+
+        yield sse("stage", {"stage": "topics"})
+        fresponse = parse_topics(request_OpenRouter(prompt_1))
+        yield sse("stage", {"stage": "context"})
+        context = get_context(prompt_1, namespace=fresponse['namespace'], user_namespace=user_namespace)
+        yield sse("stage", {"stage": "notes"})
+
+        parser = NoteStreamParser()
+        chunks: List[str] = []
+        urls: Dict[int, str] = {}
+        executor = ThreadPoolExecutor(max_workers=IMAGE_SEARCH_WORKERS)
+        pending: Dict[Future, Tuple[int, str]] = {}
+        image_ids = itertools.count()
+
+        def markdown(text: str) -> str:
+            chunks.append(text)
+            return sse("markdown", {"text": text})
+
+        def image(image_id: int, image_query: str, url: str) -> str:
+            urls[image_id] = url
+            return sse("image", {"id": image_id, "query": image_query, "url": url})
+
+        def handle(events: List[Tuple[str, str]]) -> Iterator[str]:
+            for kind, value in events:
+                if kind == "markdown":
+                    yield markdown(value)
+                else:
+                    image_id = next(image_ids)
+                    pending[executor.submit(google_search_image, value)] = (image_id, value)
+                    yield markdown(f"![{value}]({PENDING_IMAGE.format(image_id)})")
+
+        def flush_images(block_until: float = 0) -> Iterator[str]:
+            while pending:
+                done = [f for f in pending if f.done()]
+                if not done:
+                    if time.monotonic() >= block_until:
+                        return
+                    time.sleep(0.05)
+                    continue
+                for future in done:
+                    image_id, image_query = pending.pop(future)
+                    try:
+                        url = future.result()
+                    except Exception:
+                        url = PLACEHOLDER_IMAGE
+                    yield image(image_id, image_query, url)
+
+        try:
+            for delta in stream_OpenRouter(notes_prompt(fresponse['topics'], context)):
+                yield from handle(parser.feed(delta))
+                yield from flush_images()
+            yield from handle(parser.finish())
+            yield from flush_images(block_until=time.monotonic() + IMAGE_SEARCH_DEADLINE)
+            for image_id, image_query in list(pending.values()):
+                yield image(image_id, image_query, PLACEHOLDER_IMAGE)
+            pending.clear()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # stored before "done": clients close the stream on it, which ends this generator
+        if query_vector is not None:
+            notes = "".join(chunks)
+            for image_id, url in urls.items():
+                notes = notes.replace(f"({PENDING_IMAGE.format(image_id)})", f"({url})")
+            note_cache.put(query_vector, query, notes)
+        yield sse("done", {"success": True})
+    except Exception as e:
+        yield sse("error", {"success": False, "error": str(e)})
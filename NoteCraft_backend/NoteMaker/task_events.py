@@ -0,0 +1,227 @@
+import os
+import json
+import asyncio
+import hashlib
+import weakref
+from typing import Dict, List, Optional, Set, Tuple
+import redis
+from asgiref.sync import sync_to_async
+from celery import states
+from celery.result import AsyncResult
+from celery.signals import task_postrun
+from django.conf import settings
+from NoteCraft_backend.celery import app
+from .redis_cache import get_redis, get_async_redis
+
+EVENTS_PREFIX = "/events/tasks/"
+HEARTBEAT_SECONDS = float(os.getenv("TASK_EVENTS_HEARTBEAT", "15"))
+
+
+def task_channel(task_id: str) -> str:
+    return f"notecraft:task:{task_id}"
+
+
+def task_snapshot(task_id: str) -> Dict:
+    # same body TaskStatusView returns, so polling and push clients share one handler
+    result = AsyncResult(task_id, app=app)
+    value = None
+    if result.ready():
+        value = result.result if result.successful() else str(result.result)
+    return {
+        "task_id": task_id,
+        "state": result.state,
+        "progress": result.info if result.state == "PROGRESS" else None,
+        "result": value
+    }
+
+
+def etag_key(task_id: str) -> str:
+    return f"notecraft:etag:{task_id}"
+
+
+def snapshot_etag(snapshot: Dict) -> str:
+    return '"' + hashlib.sha1(json.dumps(snapshot, sort_keys=True, default=str).encode("utf-8")).hexdigest() + '"'
+
+
+def stored_etag(task_id: str) -> Optional[str]:
+    """
+    ETag of a finished task, kept next to the result so a matching If-None-Match never reads
+    or decompresses the result itself.
+    """
+    try:
+        etag = get_redis().get(etag_key(task_id))
+        return etag.decode() if etag else None # type: ignore
+    except redis.RedisError:
+        return None
+
+
+def store_etag(task_id: str, etag: str) -> None:
+    try:
+        get_redis().set(etag_key(task_id), etag, ex=int(settings.CELERY_RESULT_EXPIRES.total_seconds()))
+    except redis.RedisError as e:
+        print(f"Failed to store etag for task {task_id}: {e}")
+
+
+def publish_task_event(task_id: str, state: str, progress: Optional[Dict] = None, result=None) -> None:
+    try:
+        get_redis().publish(task_channel(task_id), json.dumps({
+            "task_id": task_id,
+            "state": state,
+            "progress": progress,
+            "result": result,
+        }))
+    except (redis.RedisError, TypeError) as e:
+        print(f"Failed to publish event for task {task_id}: {e}")
+
+
+@task_postrun.connect
+def publish_task_result(task_id=None, task=None, retval=None, state=None, **kwargs):
+    # clients only watch job ids; chain steps, chord members and tasks queued by a task run under another root
+    root_id = getattr(getattr(task, "request", None), "root_id", None)
+    if root_id and root_id != task_id:
+        return
+    # replaced tasks end as IGNORED; their id is finished later by the task that took it over
+    if state in states.READY_STATES:
+        result = retval if state == states.SUCCESS else str(retval)
+        store_etag(task_id, snapshot_etag({"task_id": task_id, "state": state, "progress": None, "result": result}))
+        publish_task_event(task_id, state, result=result)
+
+
+class TaskEventHub:
+    """
+    One Redis subscription shared by every SSE client of a process. A channel is subscribed while at
+    least one client waits on it, and each message is fanned out to the waiting clients' queues.
+    If Redis fails the clients get None and end their streams, EventSource reconnects them.
+    """
+
+    def __init__(self):
+        self.pubsub = get_async_redis().pubsub()
+        self.queues: Dict[str, Set[asyncio.Queue]] = {}
+        self.subscribed: Dict[str, asyncio.Future] = {}
+        self.reader: Optional[asyncio.Task] = None
+
+    async def subscribe(self, task_id: str) -> asyncio.Queue:
+        channel = task_channel(task_id)
+        queue: asyncio.Queue = asyncio.Queue()
+        self.queues.setdefault(channel, set()).add(queue)
+        if channel not in self.subscribed:
+            self.subscribed[channel] = asyncio.ensure_future(self.pubsub.subscribe(channel))
+        try:
+            await asyncio.shield(self.subscribed[channel])
+        except BaseException:
+            await self.unsubscribe(task_id, queue)
+            raise
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.create_task(self._read())
+        return queue
+
+    async def unsubscribe(self, task_id: str, queue: asyncio.Queue) -> None:
+        channel = task_channel(task_id)
+        waiting = self.queues.get(channel, set())
+        waiting.discard(queue)
+        if waiting or channel not in self.queues:
+            return
+        del self.queues[channel]
+        self.subscribed.pop(channel, None)
+        try:
+            await self.pubsub.unsubscribe(channel)
+        except redis.RedisError as e:
+            print(f"Failed to unsubscribe from {channel}: {e}")
+
+    async def _read(self) -> None:
+        try:
+            while self.queues:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                channel = message["channel"].decode() if isinstance(message["channel"], bytes) else message["channel"]
+                for queue in self.queues.get(channel, ()):
+                    queue.put_nowait(message["data"])
+        except redis.RedisError as e:
+            print(f"Task event subscription failed: {e}")
+            for waiting in self.queues.values():
+                for queue in waiting:
+                    queue.put_nowait(None)
+            self.queues.clear()
+            self.subscribed.clear()
+            self.pubsub = get_async_redis().pubsub()
+
+
+# pubsub connections are bound to the loop they were opened on, like get_async_redis
+_hubs: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, TaskEventHub]" = weakref.WeakKeyDictionary()
+
+
+def get_event_hub() -> TaskEventHub:
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = TaskEventHub()
+    return hub
+
+
+def _cors_headers(scope) -> List[Tuple[bytes, bytes]]:
+    origin = dict(scope["headers"]).get(b"origin", b"").decode()
+    if origin in settings.CORS_ALLOWED_ORIGINS:
+        return [(b"access-control-allow-origin", origin.encode()), (b"access-control-allow-credentials", b"true")]
+    return []
+
+
+async def _send_event(send, payload: Dict) -> None:
+    await send({"type": "http.response.body", "body": f"data: {json.dumps(payload)}\n\n".encode(), "more_body": True})
+
+
+async def task_events(scope, receive, send) -> None:
+    """
+    ASGI endpoint streaming a task's state as Server-Sent Events until it is ready.
+    The Redis channel is subscribed before the current state is read so no transition can slip between.
+    """
+    task_id = scope["path"][len(EVENTS_PREFIX):].strip("/")
+    if scope["method"] != "GET" or not task_id or "/" in task_id:
+        await send({"type": "http.response.start", "status": 404, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": b"Not found"})
+        return
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ] + _cors_headers(scope),
+    })
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    hub = get_event_hub()
+    queue = None
+    try:
+        queue = await hub.subscribe(task_id)
+        snapshot = await sync_to_async(task_snapshot, thread_sensitive=False)(task_id)
+        await _send_event(send, snapshot)
+        if snapshot["state"] in states.READY_STATES:
+            return
+        while not disconnected.is_set():
+            try:
+                data = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                await send({"type": "http.response.body", "body": b": keep-alive\n\n", "more_body": True})
+                continue
+            if data is None:
+                return
+            payload = json.loads(data)
+            await _send_event(send, payload)
+            if payload["state"] in states.READY_STATES:
+                return
+    finally:
+        watcher.cancel()
+        if queue is not None:
+            await hub.unsubscribe(task_id, queue)
+        if not disconnected.is_set():
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -1,43 +1,158 @@
 # tasks.py
-import json
-from .myutils import get_context, google_search_image, request_OpenRouter
-from celery import shared_task
+import time
+from typing import Callable, Dict, List, Optional
+from requests.exceptions import RequestException
+from .myutils import (
+    get_context, google_search_image, request_OpenRouter, parse_topics, notes_prompt, extract_block,
+    image_queries, fill_images, PLACEHOLDER_IMAGE, IMAGE_SEARCH_DEADLINE,
+)
+from .semantic_cache import note_cache
+from .task_events import publish_task_event
+from .single_flight import extend_flight, release_flight
+from celery import shared_task, chain, chord, group
+from celery.exceptions import SoftTimeLimitExceeded
 
-@shared_task
-def generate_notes_task(prompt_1:str) -> dict:
+STAGE_RETRIES = 3
+# LLM replies that don't parse are retried like network errors
+RETRYABLE = (RequestException, ValueError, KeyError)
+
+
+def report_progress(task, job_id: str, stage: str, percent: int) -> None:
+    meta = {"stage": stage, "percent": percent}
+    task.update_state(task_id=job_id, state="PROGRESS", meta=meta)
+    publish_task_event(job_id, "PROGRESS", progress=meta)
+
+
+def run_stage(task, state: Dict, stage: str, percent: int, fn: Callable[[Dict], Dict]) -> Dict:
+    """
+    Run one pipeline step on the checkpointed state from the previous step.
+    Retries re-run only this step; once retries are spent the error is carried down the chain.
+    """
+    if "error" in state or "notes" in state:
+        return state
+    report_progress(task, state["job_id"], stage, percent)
+    extend_flight(state.get("flight_key"), state["job_id"])
     try:
-        response_1 = request_OpenRouter(prompt_1)
-        # Extract JSON
-        start = response_1.find("```json") + len("```json")
-        end = response_1.find("```", start)
-        json_str = response_1[start:end].strip()
-        fresponse = json.loads(json_str)
-        
-        context = get_context(prompt_1, namespace=fresponse['namespace'])
-
-        prompt_2:str= "Objective: Act as an expert academic note-taking assistant. " \
-        f"Generate comprehensive, well-structured notes on {fresponse['topics']} with all tpics covered if context given later is irrelevent to topics, ignore it\
-        InstructionsStructure: Organize notes hierarchically with headings, subheadings and keep theword count high,\
-        Focus on clarity, accuracy, and relevance do not add double new line or meta text ever\
-        to include images write &&&image:(description of image)&&& at the place where you want to add the image this should be done in between the text\
-        example- &&&image:(diagram of the human eye)&&& use 2-3 images per heading at max\
-        output should be in ```markdown box keep the markup syntax the notes should have plenty text \
-        examples where applicable.Context: {context}"
-        notes = request_OpenRouter(prompt_2)
-        start = notes.find("```markdown") + len("```markdown")
-        end = notes.find("```", start)
-        notes = notes[start:end].strip()
-
-        arr = notes.split("&&&")
-        processed_notes = []
-        for line in arr:
-            if line.startswith("image:"):
-                image_query = line.split("image:", 1)[1].strip()
-                image_url = google_search_image(image_query)
-                processed_notes.append(f"![{image_query}]({image_url})")
-            else:
-                processed_notes.append(line)
-
-        return {"success": True, "notes": "".join(processed_notes)}
+        return fn(state)
+    except RETRYABLE as e:
+        if task.request.retries < STAGE_RETRIES:
+            raise task.retry(exc=e, countdown=2 ** task.request.retries)
+        return {**state, "error": str(e)}
     except Exception as e:
-        return {"success": False, "error": str(e)}
+        return {**state, "error": str(e)}
+
+
+def _topics(state: Dict) -> Dict:
+    if state["query"] and state["use_cache"] and not state.get("user_namespace"):
+        vector = note_cache.embed(state["query"])
+        cached = note_cache.lookup(vector) if vector is not None else None
+        if cached:
+            return {**state, "notes": cached["notes"], "cached": True}
+    return {**state, "topics": parse_topics(request_OpenRouter(state["prompt_1"]))}
+
+
+def _context(state: Dict) -> Dict:
+    context = get_context(state["prompt_1"], namespace=state["topics"]['namespace'], user_namespace=state.get("user_namespace"))
+    return {**state, "context": context}
+
+
+def _draft(state: Dict) -> Dict:
+    draft = extract_block(request_OpenRouter(notes_prompt(state["topics"]['topics'], state["context"])), "markdown")
+    return {**state, "draft": draft}
+
+
+@shared_task(bind=True, max_retries=STAGE_RETRIES)
+def topics_stage(self, state: Dict) -> Dict:
+    return run_stage(self, state, "topics", 10, _topics)
+
+
+@shared_task(bind=True, max_retries=STAGE_RETRIES)
+def context_stage(self, state: Dict) -> Dict:
+    return run_stage(self, state, "context", 30, _context)
+
+
+@shared_task(bind=True, max_retries=STAGE_RETRIES)
+def notes_stage(self, state: Dict) -> Dict:
+    return run_stage(self, state, "notes", 40, _draft)
+
+
+# no hard time_limit: a killed lookup would fail the whole chord, a soft one just means no image
+@shared_task(soft_time_limit=IMAGE_SEARCH_DEADLINE)
+def image_lookup_task(query: str, deadline: Optional[float] = None, flight_key: Optional[str] = None,
+                      job_id: Optional[str] = None) -> str:
+    """
+    deadline is the wall-clock time the whole image stage must finish by; a lookup still
+    queued past it returns the placeholder instead of searching. images_stage sets each
+    signature's soft_time_limit to the time left until it, see lookup_signature.
+    """
+    if deadline is not None and time.time() >= deadline:
+        return PLACEHOLDER_IMAGE
+    # the chord can outlast a single lease, so each lookup renews the generation's claim
+    if job_id:
+        extend_flight(flight_key, job_id)
+    try:
+        return google_search_image(query)
+    except SoftTimeLimitExceeded:
+        # out of budget, the chord still completes with the placeholder
+        return PLACEHOLDER_IMAGE
+    except Exception:
+        return PLACEHOLDER_IMAGE
+
+
+def lookup_signature(query: str, deadline: float, state: Dict):
+    # the soft limit is what is left of the shared deadline, not a fresh budget per lookup
+    remaining = max(1.0, deadline - time.time())
+    return image_lookup_task.s(query, deadline, state.get("flight_key"), state["job_id"]).set(soft_time_limit=remaining)
+
+
+@shared_task
+def assemble_notes_task(urls: List[str], state: Dict) -> dict:
+    notes = fill_images(state["draft"], urls)
+    try:
+        # notes drawn from a user's own uploads stay out of the shared cache
+        if state["query"] and not state.get("user_namespace"):
+            vector = note_cache.embed(state["query"])
+            if vector is not None:
+                note_cache.put(vector, state["query"], notes)
+    finally:
+        # released only once the notes are cached, so a request in between joins this flight or hits the cache
+        release_flight(state.get("flight_key"), state["job_id"])
+    return {"success": True, "notes": notes}
+
+
+@shared_task(bind=True)
+def images_stage(self, state: Dict) -> dict:
+    """
+    Last step, it runs under the job id. Image lookups fan out as a group and the chord callback
+    takes over this task's id, so the job's result is whatever assemble_notes_task returns.
+    """
+    if "error" in state or "notes" in state:
+        release_flight(state.get("flight_key"), state["job_id"])
+    if "error" in state:
+        return {"success": False, "error": state["error"]}
+    if "notes" in state:
+        return {"success": True, "notes": state["notes"], "cached": state.get("cached", False)}
+    report_progress(self, state["job_id"], "images", 70)
+    extend_flight(state.get("flight_key"), state["job_id"])
+    queries = image_queries(state["draft"])
+    if not queries:
+        raise self.replace(assemble_notes_task.s([], state))
+    deadline = time.time() + IMAGE_SEARCH_DEADLINE
+    lookups = group(lookup_signature(q, deadline, state) for q in queries)
+    raise self.replace(chord(lookups, assemble_notes_task.s(state)))
+
+
+def notes_pipeline(job_id: str, prompt_1: str, query: str = "", use_cache: bool = True,
+                   user_namespace: Optional[str] = None, flight_key: Optional[str] = None):
+    state = {"job_id": job_id, "prompt_1": prompt_1, "query": query, "use_cache": use_cache,
+             "user_namespace": user_namespace, "flight_key": flight_key}
+    return chain(topics_stage.s(state), context_stage.s(), notes_stage.s(), images_stage.s())
+
+
+@shared_task(bind=True)
+def generate_notes_task(self, prompt_1:str, query:str="", use_cache:bool=True, user_namespace:Optional[str]=None,
+                        flight_key:Optional[str]=None) -> dict:
+    # entry point kept for callers and queued messages; the pipeline's final task inherits this task's id
+    # out of the queue, so the claim drops from the queued lease to the running one
+    extend_flight(flight_key, self.request.id)
+    raise self.replace(notes_pipeline(self.request.id, prompt_1, query, use_cache, user_namespace, flight_key))
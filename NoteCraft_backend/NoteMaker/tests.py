@@ -1,3 +1,1388 @@
-from django.test import TestCase
+import io
+import re
+import os
+import json
+import asyncio
+import time
+import queue
+import tempfile
+import importlib.util
+import itertools
+import threading
+from types import SimpleNamespace
+from unittest import skipUnless
+from unittest.mock import patch
+import httpx
+import fakeredis  # requirements-dev.txt
+import numpy as np
+import requests
+from django.http import FileResponse
+from django.test import SimpleTestCase
+from concurrent.futures import Future
+from . import myutils, redis_cache, http_client, streaming, embeddings, pinecone_client
+from .myutils import image_queries, fill_images, PLACEHOLDER_IMAGE
+from .redis_cache import RedisLRUCache, hash_key
+from .streaming import NoteStreamParser
+from .semantic_cache import SemanticNoteCache
 
-# Create your tests here.
+
+
+class FakeRedisMixin:
+    """
+    Points get_redis() and get_async_redis() at one in-memory fakeredis server for the test.
+    """
+
+    def setUp(self):
+        super().setUp() # type: ignore
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=self.server)
+        for patcher in (
+            patch.object(redis_cache, "_client", self.redis),
+            patch.object(redis_cache, "_client_pid", os.getpid()),
+            patch.object(redis_cache, "_async_clients", {}),
+            patch.object(redis_cache.aioredis.Redis, "from_url",
+                         side_effect=lambda *args, **kwargs: fakeredis.FakeAsyncRedis(server=self.server)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop) # type: ignore
+
+
+class ImagePlaceholderTests(SimpleTestCase):
+    notes = "# Eye\nintro &&&image:(diagram of the human eye)&&& middle &&&image: retina cells&&& end"
+
+    def test_image_queries_in_order(self):
+        self.assertEqual(image_queries(self.notes), ["(diagram of the human eye)", "retina cells"])
+
+    def test_image_queries_none(self):
+        self.assertEqual(image_queries("plain notes"), [])
+
+    def test_fill_images_replaces_markers_in_order(self):
+        filled = fill_images(self.notes, ["https://a/1.png", "https://a/2.png"])
+        self.assertEqual(filled, "# Eye\nintro ![(diagram of the human eye)](https://a/1.png) middle "
+                                 "![retina cells](https://a/2.png) end")
+
+    def test_fill_images_falls_back_to_placeholder(self):
+        filled = fill_images(self.notes, ["https://a/1.png"])
+        self.assertIn(f"![retina cells]({PLACEHOLDER_IMAGE})", filled)
+        self.assertNotIn("&&&", filled)
+
+    def test_get_gis_is_per_thread(self):
+        with patch.object(myutils, "GoogleImagesSearch", side_effect=lambda **kwargs: object()), \
+                patch.object(myutils, "_gis_local", threading.local()):
+            main = myutils.get_gis()
+            self.assertIs(myutils.get_gis(), main)
+            other = []
+            thread = threading.Thread(target=lambda: other.append(myutils.get_gis()))
+            thread.start()
+            thread.join()
+            self.assertIsNot(other[0], main)
+
+
+class RedisLRUCacheTests(FakeRedisMixin, SimpleTestCase):
+    def test_get_set_and_stats(self):
+        cache = RedisLRUCache("test", ttl=60, max_entries=10)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", b"1")
+        self.assertEqual(cache.get("a"), b"1")
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5, "size": 1})
+
+    def test_values_expire_with_ttl(self):
+        cache = RedisLRUCache("test", ttl=60, max_entries=10)
+        cache.set("a", b"1")
+        self.assertTrue(0 < self.redis.ttl(cache._key("a")) <= 60)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = RedisLRUCache("test", ttl=60, max_entries=2)
+        clock = itertools.count(time.time())
+        with patch.object(redis_cache, "time", SimpleNamespace(time=lambda: next(clock))):
+            cache.set("a", b"1")
+            cache.set("b", b"2")
+            cache.get("a")  # b is now the oldest
+            cache.set("c", b"3")
+        self.assertEqual(cache.get_many(["a", "b", "c"]), [b"1", None, b"3"])
+
+    def test_get_many_and_set_many(self):
+        cache = RedisLRUCache("test", ttl=60, max_entries=10)
+        cache.set_many({"a": b"1", "b": b"2"})
+        self.assertEqual(cache.get_many(["a", "x", "b"]), [b"1", None, b"2"])
+
+
+class SearchImagesCacheTests(FakeRedisMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.gis = SimpleNamespace(search=lambda search_params: None,
+                                   results=lambda: [SimpleNamespace(url="https://a/1.png"),
+                                                    SimpleNamespace(url="https://a/2.png")])
+        patcher = patch.object(myutils, "get_gis", return_value=self.gis)
+        self.get_gis = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_results_are_cached_by_normalized_query(self):
+        self.assertEqual(myutils.search_images("The Eiffel Tower!"), ["https://a/1.png", "https://a/2.png"])
+        self.assertEqual(myutils.search_images("the eiffel  tower"), ["https://a/1.png", "https://a/2.png"])
+        self.assertEqual(self.get_gis.call_count, 1)
+        cached = myutils.image_cache.get(hash_key("the eiffel tower"))
+        self.assertEqual(json.loads(cached), ["https://a/1.png", "https://a/2.png"]) # type: ignore
+
+    def test_google_search_image_takes_first_and_new_image_an_alternative(self):
+        self.assertEqual(myutils.google_search_image("eye"), "https://a/1.png")
+        self.assertEqual(myutils.new_image("eye"), "https://a/2.png")
+
+    def test_empty_results_are_not_cached(self):
+        self.gis.results = lambda: []
+        self.assertEqual(myutils.google_search_image("nothing"), PLACEHOLDER_IMAGE)
+        self.assertIsNone(myutils.image_cache.get(hash_key("nothing")))
+
+
+class HttpClientTests(SimpleTestCase):
+    def test_session_is_shared_within_a_process(self):
+        with patch.object(http_client, "_session", None), patch.object(http_client, "_session_pid", None):
+            session = http_client.get_session()
+            self.assertIs(http_client.get_session(), session)
+            with patch.object(http_client, "_session_pid", -1):
+                self.assertIsNot(http_client.get_session(), session)
+
+    def test_session_retries_and_pools(self):
+        adapter = http_client._build_session().get_adapter("https://openrouter.ai")
+        self.assertEqual(adapter.max_retries.total, http_client.MAX_RETRIES)
+        self.assertEqual(set(adapter.max_retries.status_forcelist), set(http_client.RETRY_STATUSES))
+        self.assertIsNone(adapter.max_retries.allowed_methods)
+
+    def test_read_timeouts_are_not_retried(self):
+        from urllib3.exceptions import MaxRetryError, NewConnectionError, ReadTimeoutError
+        retry = http_client._build_session().get_adapter("https://openrouter.ai").max_retries
+        with self.assertRaises(MaxRetryError):
+            retry.increment("POST", "/api/v1/chat/completions", error=ReadTimeoutError(None, "/", "read timed out"))
+        retried = retry.increment("POST", "/api/v1/chat/completions", error=NewConnectionError(None, "refused"))
+        self.assertEqual(retried.connect, http_client.MAX_RETRIES - 1)
+
+    def test_default_timeout_applies_unless_given(self):
+        with patch.object(requests.Session, "request") as request:
+            session = http_client.TimeoutSession()
+            session.get("https://example.com")
+            self.assertEqual(request.call_args.kwargs["timeout"], http_client.DEFAULT_TIMEOUT)
+            session.get("https://example.com", timeout=3)
+            self.assertEqual(request.call_args.kwargs["timeout"], 3)
+
+
+
+def parse_stream(chunks):
+    parser = NoteStreamParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.finish())
+    markdown = "".join(value for kind, value in events if kind == "markdown")
+    return markdown, [value for kind, value in events if kind == "image"]
+
+
+class NoteStreamParserTests(SimpleTestCase):
+    response = ("Sure, here are your notes:\n```markdown\n\n# Optics\nLight bends. &&&image:(ray diagram)&&& "
+                "Lenses focus `light` && more.\n&&&image: prism&&&\n\n```\ntrailing chatter")
+
+    def expected(self):
+        draft = myutils.extract_block(self.response, "markdown")
+        return "".join(part for part in draft.split("&&&") if not part.startswith("image:")), image_queries(draft)
+
+    def test_whole_response_matches_non_streaming_extraction(self):
+        self.assertEqual(parse_stream([self.response]), self.expected())
+
+    def test_every_split_point_gives_the_same_result(self):
+        expected = self.expected()
+        for i in range(1, len(self.response)):
+            with self.subTest(split=i):
+                self.assertEqual(parse_stream([self.response[:i], self.response[i:]]), expected)
+
+    def test_character_by_character(self):
+        self.assertEqual(parse_stream(list(self.response)), self.expected())
+
+    def test_unterminated_fence_and_marker_are_flushed_on_finish(self):
+        markdown, images = parse_stream(["```markdown\nnotes &&&image: cell"])
+        self.assertEqual((markdown, images), ("notes ", ["cell"]))
+
+    def test_nothing_before_the_fence_is_emitted(self):
+        self.assertEqual(parse_stream(["no fence here &&&image: x&&&"]), ("", []))
+
+
+def sse_events(stream):
+    events = []
+    for message in stream:
+        lines = message.strip().split("\n")
+        events.append((lines[0][len("event: "):], json.loads(lines[1][len("data: "):])))
+    return events
+
+
+class StreamNotesTests(SimpleTestCase):
+    def setUp(self):
+        for name, value in (
+            ("request_OpenRouter", lambda prompt: '```json\n{"namespace": "physics", "topics": ["optics"]}\n```'),
+            ("get_context", lambda *args, **kwargs: {"message": "No relevant documents found"}),
+            ("stream_OpenRouter", lambda prompt: iter(["```mark", "down\nLight &&&ima", "ge: prism&&& bends\n```"])),
+            ("google_search_image", lambda query: f"https://img/{query}.png"),
+        ):
+            patcher = patch.object(streaming, name, side_effect=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(streaming, "note_cache")
+        self.note_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.note_cache.embed.return_value = None
+
+    def test_events_in_order(self):
+        events = sse_events(streaming.stream_notes("optics"))
+        self.assertEqual([kind for kind, _ in events[:3]], ["stage", "stage", "stage"])
+        markdown = "".join(data["text"] for kind, data in events if kind == "markdown")
+        self.assertEqual(markdown, f"Light ![prism]({streaming.PENDING_IMAGE.format(0)}) bends")
+        self.assertIn(("image", {"id": 0, "query": "prism", "url": "https://img/prism.png"}), events)
+        self.assertEqual(events[-1], ("done", {"success": True}))
+
+    def test_notes_are_cached_before_done(self):
+        self.note_cache.embed.return_value = np.ones(4, dtype=np.float32)
+        self.note_cache.lookup.return_value = None
+        for message in streaming.stream_notes("optics"):
+            if message.startswith("event: done"):
+                break  # the client hangs up as soon as it sees done
+        self.note_cache.put.assert_called_once()
+        self.assertEqual(self.note_cache.put.call_args.args[2], "Light ![prism](https://img/prism.png) bends")
+
+    def test_view_sends_events_before_generation_finishes(self):
+        release = threading.Event()
+
+        def slow_notes(prompt):
+            yield "```markdown\nLight"
+            release.wait(5)
+            yield " bends\n```"
+
+        async def read():
+            response = await self.async_client.get("/generate_note_stream/", {"query": "optics"})
+            chunks = aiter(response.streaming_content)
+            sent = b""
+            while b"Light" not in sent:
+                sent += await asyncio.wait_for(anext(chunks), 5)
+            early = not release.is_set()
+            release.set()
+            rest = b"".join([chunk async for chunk in chunks])
+            return early, rest
+
+        with patch.object(streaming, "stream_OpenRouter", side_effect=slow_notes):
+            early, rest = asyncio.run(read())
+        self.assertTrue(early)
+        self.assertIn(b"bends", rest)
+        self.assertTrue(rest.endswith(b'event: done\ndata: {"success": true}\n\n'))
+
+    def test_aiterate_closes_the_iterator_when_the_consumer_stops(self):
+        closed = threading.Event()
+
+        def numbers():
+            try:
+                yield from itertools.count()
+            finally:
+                closed.set()
+
+        async def take_two():
+            items = streaming.aiterate(numbers(), buffer=1)
+            taken = [await anext(items), await anext(items)]
+            await items.aclose()
+            return taken
+
+        self.assertEqual(asyncio.run(take_two()), [0, 1])
+        self.assertTrue(closed.wait(5))
+
+    def test_errors_become_an_error_event(self):
+        with patch.object(streaming, "request_OpenRouter", side_effect=requests.RequestException("boom")):
+            events = sse_events(streaming.stream_notes("optics"))
+        self.assertEqual(events, [("stage", {"stage": "topics"}), ("error", {"success": False, "error": "boom"})])
+
+
+class SemanticNoteCacheTests(FakeRedisMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = SemanticNoteCache(threshold=0.9, ttl=60, max_entries=10)
+
+    @staticmethod
+    def unit(*values):
+        return SemanticNoteCache._unit(list(values))
+
+    def test_hit_at_or_above_threshold(self):
+        self.cache.put(self.unit(1, 0, 0), "optics", "notes on optics")
+        entry = self.cache.lookup(self.unit(1, 0.1, 0))
+        self.assertEqual(entry["notes"], "notes on optics") # type: ignore
+        self.assertGreaterEqual(entry["similarity"], 0.9) # type: ignore
+
+    def test_miss_below_threshold(self):
+        self.cache.put(self.unit(1, 0, 0), "optics", "notes on optics")
+        self.assertIsNone(self.cache.lookup(self.unit(1, 1, 0)))  # cosine 0.71
+
+    def test_best_match_wins(self):
+        self.cache.put(self.unit(1, 0, 0), "optics", "optics")
+        self.cache.put(self.unit(0, 1, 0), "acoustics", "acoustics")
+        self.assertEqual(self.cache.lookup(self.unit(0.1, 1, 0))["notes"], "acoustics") # type: ignore
+
+    def test_vectors_are_read_once_per_version(self):
+        self.cache.put(self.unit(1, 0, 0), "optics", "optics")
+        self.cache.lookup(self.unit(1, 0, 0))
+        snapshot = self.cache._snapshot
+        self.cache.lookup(self.unit(1, 0, 0))
+        self.assertIs(self.cache._snapshot, snapshot)
+        self.cache.put(self.unit(0, 1, 0), "acoustics", "acoustics")
+        self.cache.lookup(self.unit(1, 0, 0))
+        self.assertEqual(len(self.cache._snapshot[1]), 2) # type: ignore
+
+    def test_put_from_another_process_is_seen(self):
+        self.assertIsNone(self.cache.lookup(self.unit(0, 0, 1)))
+        SemanticNoteCache(threshold=0.9, ttl=60, max_entries=10).put(self.unit(0, 0, 1), "heat", "heat notes")
+        self.assertEqual(self.cache.lookup(self.unit(0, 0, 1))["notes"], "heat notes") # type: ignore
+
+    def test_vector_of_evicted_notes_is_dropped(self):
+        self.cache.put(self.unit(1, 0, 0), "optics", "optics")
+        entry_id = self.redis.hkeys(self.cache.vectors_key)[0].decode()
+        self.cache.store.delete(entry_id)
+        self.assertIsNone(self.cache.lookup(self.unit(1, 0, 0)))
+        self.assertEqual(self.redis.hlen(self.cache.vectors_key), 0)
+        self.assertEqual(self.cache._vectors(self.redis)[0], [])
+
+
+def fake_embed(model, inputs, parameters):
+    # one vector per input, derived from its length so each text is recognisable
+    return [SimpleNamespace(values=[float(len(text)), 1.0]) for text in inputs]
+
+
+class PineconeClientTests(SimpleTestCase):
+    def test_client_is_built_on_first_use_and_shared(self):
+        with patch.object(pinecone_client, "Pinecone") as pinecone, \
+                patch.object(pinecone_client, "_client", None), patch.object(pinecone_client, "_client_pid", None):
+            pinecone.assert_not_called()
+            client = pinecone_client.get_pinecone()
+            self.assertIs(pinecone_client.get_pinecone(), client)
+            self.assertEqual(pinecone.call_count, 1)
+
+
+class EmbeddingTests(FakeRedisMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = SimpleNamespace(inference=SimpleNamespace(embed=None))
+        patcher = patch.object(embeddings, "get_pinecone", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dispatch_groups_by_input_type_and_sends_each_text_once(self):
+        calls = []
+        self.client.inference.embed = lambda model, inputs, parameters: calls.append((parameters["input_type"], inputs)) \
+            or fake_embed(model, inputs, parameters)
+        batch = [("ab", "query", Future()), ("abc", "passage", Future()), ("ab", "query", Future())]
+        embeddings.EmbeddingBatcher(window=0, max_batch=8)._dispatch(batch)
+        self.assertEqual(sorted(calls), [("passage", ["abc"]), ("query", ["ab"])])
+        self.assertEqual([list(f.result()) for _, _, f in batch], [[2.0, 1.0], [3.0, 1.0], [2.0, 1.0]])
+
+    def test_dispatch_failure_reaches_every_waiter(self):
+        def fail(**kwargs):
+            raise RuntimeError("quota")
+        self.client.inference.embed = fail
+        batch = [("a", "query", Future()), ("b", "query", Future())]
+        embeddings.EmbeddingBatcher(window=0, max_batch=8)._dispatch(batch)
+        for _, _, future in batch:
+            self.assertRaises(RuntimeError, future.result)
+
+    def test_embed_texts_only_sends_cache_misses(self):
+        sent = []
+        self.client.inference.embed = lambda model, inputs, parameters: sent.extend(inputs) or fake_embed(model, inputs, parameters)
+        first = embeddings.embed_texts(["one", "three"], input_type="passage")
+        second = embeddings.embed_texts(["three", "fifteen"], input_type="passage")
+        self.assertEqual(sorted(sent), ["fifteen", "one", "three"])
+        self.assertEqual([v.tolist() for v in first + second], [[3.0, 1.0], [5.0, 1.0], [5.0, 1.0], [7.0, 1.0]])
+        self.assertEqual(second[0].dtype, np.float32)
+
+    def test_input_type_is_part_of_the_cache_key(self):
+        sent = []
+        self.client.inference.embed = lambda model, inputs, parameters: sent.append(parameters["input_type"]) \
+            or fake_embed(model, inputs, parameters)
+        embeddings.embed_text("same", input_type="query")
+        embeddings.embed_text("same", input_type="passage")
+        self.assertEqual(sent, ["query", "passage"])
+
+
+def encoding_available() -> bool:
+    from .chunking import get_encoding
+    try:
+        get_encoding()
+    except Exception:
+        return False
+    return True
+
+
+@skipUnless(all(importlib.util.find_spec(name) for name in ("llama_index", "wikipedia")),
+            "script.py needs llama_index and wikipedia")
+class IngestionPipelineTests(SimpleTestCase):
+    def setUp(self):
+        import script
+        self.script = script
+
+    @skipUnless(encoding_available(), "tokenizer files not available")
+    def test_split_documents_tags_chunks_with_their_document(self):
+        chunks = self.script.split_documents([{"text": "alpha beta " * 30, "source": "arxiv", "namespace": "physics"}],
+                                             chunk_tokens=16, overlap=4)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(len({chunk["doc_id"] for chunk in chunks}), 1)
+        self.assertEqual([chunk["chunk_index"] for chunk in chunks], list(range(len(chunks))))
+        self.assertTrue(all(chunk["namespace"] == "physics" and chunk["text"] for chunk in chunks))
+
+    def test_build_records_carry_chunk_text_and_stable_ids(self):
+        chunk = {"doc_id": "d1", "chunk_index": 3, "start": 0, "end": 5, "text": "hello", "source": "wikipedia",
+                 "namespace": "history", "extra": "dropped"}
+        record, = self.script.build_records([chunk], [np.array([0.5, 0.5], dtype=np.float32)])
+        self.assertEqual(record["id"], "d1#3")
+        self.assertEqual(record["values"], [0.5, 0.5])
+        self.assertEqual(set(record["metadata"]), set(self.script.METADATA_FIELDS))
+
+    def test_embed_stage_sends_full_batches_and_forwards_the_end(self):
+        in_q, out_q = queue.Queue(), queue.Queue()
+        for i in range(5):
+            in_q.put({"doc_id": "d", "chunk_index": i, "start": 0, "end": 1, "text": f"t{i}", "source": "s", "namespace": "n"})
+        in_q.put(None)
+        calls = []
+        with patch.object(self.script, "EMBED_MAX_BATCH", 2), \
+                patch.object(self.script, "embed_texts", side_effect=lambda texts, input_type: calls.append(texts)
+                             or [np.zeros(2, dtype=np.float32) for _ in texts]):
+            self.script.embed_stage(in_q, out_q)
+        self.assertEqual(calls, [["t0", "t1"], ["t2", "t3"], ["t4"]])
+        batches = [out_q.get() for _ in range(4)]
+        self.assertIsNone(batches[-1])
+        self.assertEqual([r["id"] for batch in batches[:-1] for r in batch], [f"d#{i}" for i in range(5)])
+
+    def test_upsert_stage_batches_per_namespace(self):
+        in_q = queue.Queue()
+        in_q.put([{"id": f"{ns}#{i}", "values": [1.0], "metadata": {"namespace": ns}} for i in range(5) for ns in ("a", "b")])
+        in_q.put(None)
+        sent = []
+        with patch.object(self.script, "UPSERT_BATCH", 2):
+            self.script.upsert_stage(in_q, self.script.Progress(),
+                                     sink=lambda namespace, records: sent.append((namespace, [r["id"] for r in records])))
+        self.assertTrue(all(len(ids) <= 2 and all(i.startswith(ns) for i in ids) for ns, ids in sent))
+        self.assertEqual(sorted(i for _, ids in sent for i in ids), sorted(f"{ns}#{i}" for i in range(5) for ns in "ab"))
+
+    def test_local_sink_writes_the_local_index(self):
+        from .retrievers import LocalRetriever
+        with tempfile.TemporaryDirectory() as directory:
+            writer = self.script.LocalIndexWriter(directory)
+            self.script.local_sink(writer)("physics", [
+                {"id": "d#0", "values": [1.0, 0.0], "metadata": {"text": "light", "namespace": "physics"}},
+                {"id": "d#1", "values": [0.0, 1.0], "metadata": {"text": "sound", "namespace": "physics"}},
+            ])
+            writer.close()
+            match, = LocalRetriever(directory).query([0.1, 1.0], "physics", top_k=1)
+        self.assertEqual(match["text"], "sound")
+
+
+class LocalRetrieverTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def write(self, namespace, vectors, ivf_min_rows=1_000_000):
+        from .retrievers import LocalIndexWriter
+        writer = LocalIndexWriter(self.directory, ivf_min_rows=ivf_min_rows)
+        writer.add(namespace, vectors, [{"text": str(i)} for i in range(len(vectors))])
+        writer.close()
+
+    def test_retriever_interface_is_abstract(self):
+        from .retrievers import Retriever
+        with self.assertRaises(TypeError):
+            Retriever() # type: ignore
+
+    def test_retriever_is_rebuilt_after_a_fork(self):
+        from . import retrievers
+        with patch.object(retrievers, "RETRIEVER_BACKEND", "local"), \
+                patch.object(retrievers, "_retriever", None), patch.object(retrievers, "_retriever_pid", None):
+            retriever = retrievers.get_retriever()
+            self.assertIs(retrievers.get_retriever(), retriever)
+            with patch.object(retrievers, "_retriever_pid", -1):
+                self.assertIsNot(retrievers.get_retriever(), retriever)
+
+    def test_exact_search_ranks_by_cosine(self):
+        from .retrievers import LocalRetriever
+        self.write("ns", np.array([[1, 0, 0], [0, 1, 0], [1, 1, 0]], dtype=np.float32))
+        matches = LocalRetriever(self.directory).query([2.0, 1.0, 0.0], "ns", top_k=2)
+        self.assertEqual([m["text"] for m in matches], ["2", "0"])
+        self.assertAlmostEqual(matches[0]["score"], 3 / np.sqrt(10), places=5)
+
+    def test_missing_namespace_returns_nothing(self):
+        from .retrievers import LocalRetriever
+        self.assertEqual(LocalRetriever(self.directory).query([1.0], "absent"), [])
+
+    def test_ivf_recall_matches_brute_force(self):
+        from .retrievers import LocalRetriever
+        rng = np.random.default_rng(1)
+        vectors = rng.standard_normal((2000, 16)).astype(np.float32)
+        self.write("ns", vectors, ivf_min_rows=100)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "ns.ivf.npz")))
+        retriever = LocalRetriever(self.directory, nprobe=16)
+        unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        hits = 0
+        for q in rng.standard_normal((20, 16)):
+            expected = set(np.argsort(-(unit @ q))[:10].astype(str))
+            hits += len(expected & {m["text"] for m in retriever.query(q.tolist(), "ns", top_k=10)})
+        self.assertGreaterEqual(hits / 200, 0.8)
+
+
+class CharEncoding:
+    """
+    Stand-in for a tiktoken encoding: every character is a token, so offsets are easy to check.
+    """
+
+    def encode(self, text, disallowed_special=()):
+        return [ord(c) for c in text]
+
+    def decode_with_offsets(self, tokens):
+        return "".join(map(chr, tokens)), list(range(len(tokens)))
+
+
+class ChunkingTests(SimpleTestCase):
+    def setUp(self):
+        from . import chunking
+        self.chunking = chunking
+        self.real_encoding = chunking.get_encoding
+        patcher = patch.object(chunking, "get_encoding", return_value=CharEncoding())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_windows_overlap_and_offsets(self):
+        text = "abcdefghij"
+        chunks = self.chunking.chunk_text(text, chunk_tokens=4, overlap=1)
+        self.assertEqual([c["text"] for c in chunks], ["abcd", "defg", "ghij"])
+        self.assertEqual([c["chunk_index"] for c in chunks], [0, 1, 2])
+        self.assertTrue(all(text[c["start"]:c["end"]] == c["text"] for c in chunks))
+
+    def test_short_and_empty_text(self):
+        self.assertEqual([c["text"] for c in self.chunking.chunk_text("ab", 4, 1)], ["ab"])
+        self.assertEqual(self.chunking.chunk_text("", 4, 1), [])
+
+    def test_overlap_must_be_smaller_than_window(self):
+        with self.assertRaises(ValueError):
+            self.chunking.chunk_text("abc", chunk_tokens=2, overlap=2)
+
+    def test_chunk_document_copies_fields(self):
+        chunks = self.chunking.chunk_document({"text": "abcdef", "source": "arxiv", "doc_id": "d"}, 3, 0)
+        self.assertEqual([(c["text"], c["source"], c["doc_id"]) for c in chunks], [("abc", "arxiv", "d"), ("def", "arxiv", "d")])
+
+    @skipUnless(encoding_available(), "tokenizer files not available")
+    def test_real_encoding_round_trips(self):
+        text = "Photosynthesis converts light into chemical energy. " * 40
+        with patch.object(self.chunking, "get_encoding", self.real_encoding):
+            chunks = self.chunking.chunk_text(text, chunk_tokens=32, overlap=8)
+        self.assertTrue(all(text[c["start"]:c["end"]] == c["text"] for c in chunks))
+        self.assertEqual(chunks[-1]["end"], len(text))
+
+
+class NotesPipelineTests(SimpleTestCase):
+    def setUp(self):
+        from . import tasks
+        self.tasks = tasks
+        for name in ("report_progress", "extend_flight", "release_flight"):
+            patcher = patch.object(tasks, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.state = {"job_id": "job", "prompt_1": "p", "query": "", "use_cache": False,
+                      "user_namespace": None, "flight_key": None}
+
+    def fake_task(self, retries):
+        return SimpleNamespace(request=SimpleNamespace(retries=retries),
+                               retry=lambda exc, countdown: RuntimeError(f"retry in {countdown}"))
+
+    def test_run_stage_checkpoints_state(self):
+        state = self.tasks.run_stage(self.fake_task(0), self.state, "topics", 10, lambda s: {**s, "topics": ["t"]})
+        self.assertEqual(state["topics"], ["t"])
+        self.assertIs(self.tasks.run_stage(self.fake_task(0), {**state, "error": "x"}, "context", 30, None)["error"], "x")
+
+    def test_run_stage_retries_then_carries_the_error(self):
+        def fail(state):
+            raise ValueError("unparseable")
+        with self.assertRaisesRegex(RuntimeError, "retry in 2"):
+            self.tasks.run_stage(self.fake_task(1), self.state, "topics", 10, fail)
+        state = self.tasks.run_stage(self.fake_task(self.tasks.STAGE_RETRIES), self.state, "topics", 10, fail)
+        self.assertEqual(state["error"], "unparseable")
+
+    def test_image_lookup_past_the_deadline_returns_the_placeholder(self):
+        with patch.object(self.tasks, "google_search_image") as search:
+            self.assertEqual(self.tasks.image_lookup_task.run("cell", time.time() - 1), PLACEHOLDER_IMAGE)
+            search.assert_not_called()
+            search.return_value = "https://img"
+            self.assertEqual(self.tasks.image_lookup_task.run("cell", time.time() + 60), "https://img")
+
+    def test_images_stage_fans_out_with_one_shared_deadline(self):
+        draft = "intro &&&image: cell&&& and &&&image: atom&&&"
+        with patch.object(self.tasks.images_stage, "replace", side_effect=lambda sig: RuntimeError(sig)) as replace:
+            with self.assertRaises(RuntimeError):
+                self.tasks.images_stage.run({**self.state, "draft": draft})
+        lookups = replace.call_args.args[0].tasks
+        self.assertEqual([sig.args[0] for sig in lookups], ["cell", "atom"])
+        self.assertEqual(len({sig.args[1] for sig in lookups}), 1)
+        self.assertGreater(lookups[0].args[1], time.time())
+        self.assertLessEqual(lookups[0].options["soft_time_limit"], lookups[0].args[1] - time.time() + 0.01)
+
+    def test_lookup_budget_is_what_is_left_of_the_deadline(self):
+        deadline = time.time() + 4
+        signature = self.tasks.lookup_signature("cell", deadline, self.state)
+        self.assertAlmostEqual(signature.options["soft_time_limit"], 4, delta=0.5)
+        late = self.tasks.lookup_signature("cell", time.time() - 10, self.state)
+        self.assertEqual(late.options["soft_time_limit"], 1.0)
+        self.assertIsNone(self.tasks.image_lookup_task.time_limit)
+
+    def test_soft_time_limit_means_no_image(self):
+        with patch.object(self.tasks, "google_search_image", side_effect=self.tasks.SoftTimeLimitExceeded()):
+            self.assertEqual(self.tasks.image_lookup_task.run("cell", time.time() + 60), PLACEHOLDER_IMAGE)
+
+    def test_images_stage_without_images_replaces_itself_with_assembly(self):
+        with patch.object(self.tasks.images_stage, "replace", side_effect=lambda sig: RuntimeError(sig)) as replace:
+            with self.assertRaises(RuntimeError):
+                self.tasks.images_stage.run({**self.state, "draft": "no images"})
+        signature = replace.call_args.args[0]
+        self.assertEqual(signature.task, self.tasks.assemble_notes_task.name)
+        self.assertEqual(signature.args[0], [])
+
+
+class TaskEventsTests(FakeRedisMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        from . import task_events
+        self.task_events = task_events
+
+    def run_events(self, path, method="GET", publish=None):
+        sent = []
+
+        async def receive():
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+
+        async def main():
+            publisher = asyncio.create_task(publish()) if publish else None
+            scope = {"type": "http", "path": path, "method": method, "headers": []}
+            await asyncio.wait_for(self.task_events.task_events(scope, receive, send), timeout=5)
+            if publisher:
+                await publisher
+
+        asyncio.run(main())
+        events = [json.loads(m["body"][len(b"data: "):]) for m in sent
+                  if m["type"] == "http.response.body" and m["body"].startswith(b"data: ")]
+        return sent, events
+
+    def test_publish_task_result_stores_etag_and_publishes(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.task_events.task_channel("t1"))
+        self.task_events.publish_task_result(task_id="t1", retval={"success": True}, state="SUCCESS")
+        # the first read consumes the subscribe confirmation
+        message = pubsub.get_message(timeout=1) or pubsub.get_message(timeout=1)
+        self.assertEqual(json.loads(message["data"])["result"], {"success": True})
+        expected = self.task_events.snapshot_etag({"task_id": "t1", "state": "SUCCESS", "progress": None,
+                                                   "result": {"success": True}})
+        self.assertEqual(self.task_events.stored_etag("t1"), expected)
+
+    def test_subtasks_publish_nothing(self):
+        subtask = SimpleNamespace(request=SimpleNamespace(root_id="job"))
+        self.task_events.publish_task_result(task_id="t1", task=subtask, retval="url", state="SUCCESS")
+        self.assertIsNone(self.task_events.stored_etag("t1"))
+        job = SimpleNamespace(request=SimpleNamespace(root_id="job"))
+        self.task_events.publish_task_result(task_id="job", task=job, retval={"success": True}, state="SUCCESS")
+        self.assertIsNotNone(self.task_events.stored_etag("job"))
+
+    def test_replaced_tasks_publish_nothing(self):
+        self.task_events.publish_task_result(task_id="t1", retval=None, state="IGNORED")
+        self.assertIsNone(self.task_events.stored_etag("t1"))
+
+    def test_unknown_paths_are_404(self):
+        sent, _ = self.run_events("/events/tasks/", method="GET")
+        self.assertEqual(sent[0]["status"], 404)
+        sent, _ = self.run_events("/events/tasks/t1", method="POST")
+        self.assertEqual(sent[0]["status"], 404)
+
+    def test_ready_task_sends_one_snapshot(self):
+        snapshot = {"task_id": "t1", "state": "SUCCESS", "progress": None, "result": {"notes": "n"}}
+        with patch.object(self.task_events, "task_snapshot", return_value=snapshot):
+            sent, events = self.run_events("/events/tasks/t1")
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertEqual(events, [snapshot])
+        self.assertFalse(sent[-1]["more_body"])
+
+    def test_pending_task_streams_until_ready(self):
+        pending = {"task_id": "t1", "state": "PENDING", "progress": None, "result": None}
+
+        async def publish():
+            await asyncio.sleep(0.1)
+            await asyncio.to_thread(self.task_events.publish_task_event, "t1", "PROGRESS", {"stage": "notes", "percent": 40})
+            await asyncio.to_thread(self.task_events.publish_task_event, "t1", "SUCCESS", None, {"notes": "n"})
+
+        with patch.object(self.task_events, "task_snapshot", return_value=pending):
+            _, events = self.run_events("/events/tasks/t1", publish=publish)
+        self.assertEqual([e["state"] for e in events], ["PENDING", "PROGRESS", "SUCCESS"])
+        self.assertEqual(events[1]["progress"]["percent"], 40)
+
+
+    def test_clients_share_one_subscription(self):
+        pending = {"task_id": "t1", "state": "PENDING", "progress": None, "result": None}
+        channel = self.task_events.task_channel("t1")
+        sent = [[], []]
+
+        async def receive():
+            await asyncio.Event().wait()
+
+        def client(messages):
+            async def send(message):
+                messages.append(message)
+            scope = {"type": "http", "path": "/events/tasks/t1", "method": "GET", "headers": []}
+            return asyncio.create_task(self.task_events.task_events(scope, receive, send))
+
+        async def main():
+            hub = self.task_events.get_event_hub()
+            clients = [client(messages) for messages in sent]
+            while len(hub.queues.get(channel, ())) < 2:
+                await asyncio.sleep(0.01)
+            self.assertEqual(list(hub.subscribed), [channel])
+            await asyncio.to_thread(self.task_events.publish_task_event, "t1", "SUCCESS", None, {"notes": "n"})
+            await asyncio.wait_for(asyncio.gather(*clients), 5)
+            return hub
+
+        with patch.object(self.task_events, "task_snapshot", return_value=pending):
+            hub = asyncio.run(main())
+        for messages in sent:
+            self.assertIn(b'"state": "SUCCESS"', messages[-2]["body"])
+        self.assertEqual(hub.queues, {})
+        self.assertEqual(hub.subscribed, {})
+
+
+class ZjsonSerializerTests(SimpleTestCase):
+    def test_round_trip_through_kombu(self):
+        from kombu.serialization import dumps, loads
+        result = {"success": True, "notes": "# Notes\n" + "photosynthesis " * 500}
+        content_type, encoding, data = dumps(result, serializer="zjson")
+        self.assertLess(len(data), len(json.dumps(result)) / 5)
+        self.assertEqual(loads(data, content_type, encoding), result)
+
+    def test_loads_accepts_latin1_text(self):
+        from NoteCraft_backend.celery import zjson_dumps, zjson_loads
+        self.assertEqual(zjson_loads(zjson_dumps([1, "é"]).decode("latin-1")), [1, "é"])
+
+
+class TaskStatusViewTests(FakeRedisMixin, SimpleTestCase):
+    done = {"task_id": "t1", "state": "SUCCESS", "progress": None, "result": {"notes": "n"}}
+
+    def get(self, snapshot, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        with patch("NoteMaker.views.task_snapshot", return_value=snapshot) as read:
+            return self.client.get("/task_status/t1/", **headers), read
+
+    def test_ready_task_revalidates_without_reading_the_result(self):
+        response, _ = self.get(self.done)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        response, read = self.get(self.done, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        read.assert_not_called()
+
+    def test_running_task_etag_follows_progress(self):
+        running = {"task_id": "t1", "state": "PROGRESS", "progress": {"stage": "notes", "percent": 40}, "result": None}
+        etag = self.get(running)[0]["ETag"]
+        self.assertEqual(self.get(running, etag)[0].status_code, 304)
+        moved = {**running, "progress": {"stage": "images", "percent": 70}}
+        self.assertEqual(self.get(moved, etag)[0].status_code, 200)
+        self.assertIsNone(redis_cache.get_redis().get("notecraft:etag:t1"))
+
+
+class FakeUpstream:
+    def __init__(self, status_code=200, body=b"", headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}")
+
+    def close(self):
+        self.closed = True
+
+
+class ImageProxyTests(SimpleTestCase):
+    url = "https://example.com/cell.png"
+
+    def setUp(self):
+        from . import image_proxy
+        self.image_proxy = image_proxy
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = image_proxy.DiskImageCache(tmp.name, max_bytes=1000, max_object_bytes=400)
+        self.upstream = FakeUpstream(body=b"x" * 300, headers={"Content-Type": "image/png", "ETag": '"v1"'})
+        self.sent_headers = []
+
+        def get(url, stream, headers):
+            self.sent_headers.append(headers)
+            return self.upstream
+
+        for patcher in (patch.object(image_proxy, "image_cache", self.cache),
+                        patch.object(image_proxy, "get_session", return_value=SimpleNamespace(get=get))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def request(self, **headers):
+        from django.test import RequestFactory
+        return RequestFactory().get("/proxy-image/", **{f"HTTP_{k.upper().replace('-', '_')}": v for k, v in headers.items()})
+
+    def get_async(self):
+        async def get():
+            response = await self.async_client.get("/proxy-image/", {"url": self.url})
+            return response, response.is_async, b"".join([chunk async for chunk in response.streaming_content])
+        return asyncio.run(get())
+
+    def test_asgi_streams_misses_and_cached_files(self):
+        response, is_async, body = self.get_async()
+        self.assertTrue(is_async)
+        self.assertEqual(body, self.upstream.body)
+        self.assertTrue(self.upstream.closed)
+        response, is_async, body = self.get_async()
+        self.assertIsInstance(response, FileResponse)
+        self.assertTrue(is_async)
+        self.assertEqual(response["Content-Length"], "300")
+        self.assertEqual(body, self.upstream.body)
+
+    def test_eviction_drops_least_recently_used(self):
+        now = time.time()
+        for age, name in ((30, "a"), (20, "b"), (10, "c")):
+            self.cache.store_bytes(name, b"x" * 300, {})
+            os.utime(self.cache.paths(name)[0], (now - age, now - age))
+        self.cache.get("a")
+        self.cache.store_bytes("d", b"x" * 300, {})
+        self.assertEqual([name for name in "abcd" if self.cache.get(name) is not None], ["a", "c", "d"])
+        self.cache.store_bytes("big", b"x" * 401, {})
+        self.assertIsNone(self.cache.get("big"))
+
+    def test_interrupted_stream_is_not_cached(self):
+        stream = self.cache.store_stream("k", iter([b"ab", b"cd"]), {})
+        next(stream)
+        stream.close()
+        self.assertIsNone(self.cache.get("k"))
+        self.assertEqual(list(os.scandir(self.cache.directory)), [])
+
+    def test_miss_streams_and_caches_then_hit_revalidates_from_disk(self):
+        response = self.image_proxy.proxy_image(self.request(), self.url)
+        self.assertEqual(b"".join(response.streaming_content), self.upstream.body)
+        self.assertEqual(response["ETag"], '"v1"')
+        response = self.image_proxy.proxy_image(self.request(if_none_match='"v1"'), self.url)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(self.sent_headers), 1)
+
+    def test_miss_forwards_client_validators(self):
+        self.upstream = FakeUpstream(status_code=304, headers={"ETag": '"v1"'})
+        response = self.image_proxy.proxy_image(self.request(if_none_match='"v1"'), self.url)
+        self.assertEqual(self.sent_headers, [{"If-None-Match": '"v1"'}])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], '"v1"')
+        self.assertTrue(self.upstream.closed)
+
+    def test_stale_entry_is_revalidated_with_stored_etag(self):
+        self.cache.store_bytes(self.cache.key(self.url), b"old", {"etag": '"v0"', "content_type": "image/png", "fetched_at": 0})
+        self.upstream = FakeUpstream(status_code=304)
+        response = self.image_proxy.proxy_image(self.request(), self.url)
+        self.assertEqual(self.sent_headers, [{"If-None-Match": '"v0"'}])
+        self.assertEqual(b"".join(response.streaming_content), b"old")
+
+    def test_view_rejects_non_http_urls_with_400(self):
+        response = self.client.get("/proxy-image/", {"url": "file:///etc/passwd"})
+        self.assertEqual(response.status_code, 400)
+        self.upstream = FakeUpstream(status_code=503)
+        response = self.client.get("/proxy-image/", {"url": self.url})
+        self.assertEqual(response.status_code, 500)
+
+
+class ImageVariantTests(SimpleTestCase):
+    def setUp(self):
+        from . import image_proxy
+        self.image_proxy = image_proxy
+
+    def image_bytes(self, size=(400, 200), mode="RGB", fmt="PNG"):
+        from PIL import Image
+        out = io.BytesIO()
+        Image.new(mode, size).save(out, fmt)
+        return out.getvalue()
+
+    def test_parse_variant(self):
+        parse = self.image_proxy.parse_variant
+        self.assertIsNone(parse({}))
+        self.assertEqual(parse({"w": "320"}), {"width": 320, "quality": 75, "format": "webp"})
+        self.assertEqual(parse({"q": "60", "format": "JPEG"}), {"width": 0, "quality": 60, "format": "jpeg"})
+        for params in ({"w": "8"}, {"w": "5000"}, {"q": "0"}, {"format": "gif"}, {"w": "wide"}):
+            with self.assertRaises(ValueError):
+                parse(params)
+
+    def test_transform_resizes_and_keeps_aspect(self):
+        from PIL import Image
+        output = self.image_proxy.transform_image(self.image_bytes(), 100, 75, "webp")
+        with Image.open(io.BytesIO(output)) as img:
+            self.assertEqual((img.format, img.size), ("WEBP", (100, 50)))
+
+    def test_transform_never_upscales(self):
+        from PIL import Image
+        output = self.image_proxy.transform_image(self.image_bytes((50, 50)), 200, 75, "png")
+        with Image.open(io.BytesIO(output)) as img:
+            self.assertEqual(img.size, (50, 50))
+
+    def test_transparent_image_to_jpeg(self):
+        from PIL import Image
+        output = self.image_proxy.transform_image(self.image_bytes(mode="RGBA"), 0, 80, "jpeg")
+        with Image.open(io.BytesIO(output)) as img:
+            self.assertEqual((img.format, img.mode), ("JPEG", "RGB"))
+
+    def test_variant_is_cached_apart_from_the_original(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cache = self.image_proxy.DiskImageCache(tmp.name, max_bytes=10 ** 7, max_object_bytes=10 ** 6)
+        upstream = FakeUpstream(body=self.image_bytes(), headers={"Content-Type": "image/png"})
+        session = SimpleNamespace(get=lambda url, stream, headers: upstream)
+        variant = {"width": 100, "quality": 75, "format": "webp"}
+        from django.test import RequestFactory
+        with patch.object(self.image_proxy, "image_cache", cache), \
+                patch.object(self.image_proxy, "get_session", return_value=session):
+            response = self.image_proxy.proxy_image_variant(RequestFactory().get("/"), "https://x/a.png", variant)
+            self.assertEqual(response["Content-Type"], "image/webp")
+            response = self.image_proxy.proxy_image_variant(
+                RequestFactory().get("/", HTTP_IF_NONE_MATCH=response["ETag"]), "https://x/a.png", variant)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(list(cache.directory.glob("*.bin"))), 2)
+
+    def test_undecodable_image_falls_back_to_the_original(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cache = self.image_proxy.DiskImageCache(tmp.name, max_bytes=10 ** 7, max_object_bytes=10 ** 6)
+        upstream = FakeUpstream(body=b"<svg/>", headers={"Content-Type": "image/svg+xml"})
+        session = SimpleNamespace(get=lambda url, stream, headers: upstream)
+        from django.test import RequestFactory
+        with patch.object(self.image_proxy, "image_cache", cache), \
+                patch.object(self.image_proxy, "get_session", return_value=session):
+            response = self.image_proxy.proxy_image_variant(RequestFactory().get("/"), "https://x/a.svg",
+                                                            {"width": 100, "quality": 75, "format": "webp"})
+        self.assertEqual(response["Content-Type"], "image/svg+xml")
+        self.assertEqual(b"".join(response.streaming_content), b"<svg/>")
+
+
+class LocalRetrieverWriteTests(SimpleTestCase):
+    def setUp(self):
+        from .retrievers import LocalRetriever
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.writer = LocalRetriever(tmp.name)
+        self.reader = LocalRetriever(tmp.name)
+
+    def records(self, doc_id, vectors):
+        return [{"id": f"{doc_id}#{i}", "values": v, "metadata": {"doc_id": doc_id, "chunk_index": i, "text": f"{doc_id}-{i}"}}
+                for i, v in enumerate(vectors)]
+
+    def texts(self, vector, top_k=10):
+        return [m["text"] for m in self.reader.query(vector, "user-1", top_k=top_k)]
+
+    def test_upsert_is_visible_to_a_loaded_reader(self):
+        self.writer.upsert("user-1", self.records("a", [[1.0, 0.0]]))
+        self.assertEqual(self.texts([1.0, 0.0]), ["a-0"])
+        self.writer.upsert("user-1", self.records("b", [[0.0, 1.0], [0.6, 0.8]]))
+        self.assertEqual(self.texts([0.0, 1.0]), ["b-0", "b-1", "a-0"])
+
+    def test_upsert_replaces_rows_with_the_same_id(self):
+        self.writer.upsert("user-1", self.records("a", [[1.0, 0.0], [0.0, 1.0]]))
+        self.writer.upsert("user-1", [{"id": "a#1", "values": [1.0, 0.1], "metadata": {"text": "new"}}])
+        self.assertEqual(self.texts([1.0, 0.0]), ["a-0", "new"])
+
+    def test_delete_document_removes_only_its_chunks(self):
+        self.writer.upsert("user-1", self.records("a", [[1.0, 0.0], [0.9, 0.1]]) + self.records("ab", [[0.0, 1.0]]))
+        self.assertEqual(self.texts([1.0, 0.0]), ["a-0", "a-1", "ab-0"])
+        self.assertEqual(self.writer.delete_document("user-1", "a"), 2)
+        self.assertEqual(self.texts([1.0, 0.0]), ["ab-0"])
+        self.assertEqual(self.writer.delete_document("user-1", "a"), 0)
+        self.assertEqual(self.writer.delete_document("user-1", "ab"), 1)
+        self.assertEqual(self.texts([1.0, 0.0]), [])
+        self.assertEqual(self.writer.delete_document("missing", "a"), 0)
+
+    def test_rows_written_by_the_bulk_writer_can_be_deleted(self):
+        from .retrievers import LocalIndexWriter
+        writer = LocalIndexWriter(str(self.writer.directory))
+        writer.add("user-1", np.eye(2, dtype=np.float32), [{"doc_id": "a", "chunk_index": 0, "text": "a-0"},
+                                                          {"doc_id": "b", "chunk_index": 0, "text": "b-0"}])
+        writer.close()
+        self.assertEqual(self.writer.delete_document("user-1", "a"), 1)
+        self.assertEqual(self.texts([1.0, 1.0]), ["b-0"])
+
+
+class TokenBucketGovernorTests(FakeRedisMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        from .rate_limit import TokenBucketGovernor
+        self.governor = TokenBucketGovernor("test", rpm=2, tpm=1000, max_wait=0)
+
+    def test_requests_are_taken_until_the_bucket_is_empty(self):
+        from .rate_limit import RateLimitTimeout
+        self.assertLess(self.governor.acquire(100), 0.05)
+        self.governor.acquire(100)
+        with self.assertRaises(RateLimitTimeout):
+            self.governor.acquire(100)
+        stats = self.governor.stats()
+        self.assertEqual((stats["acquired"], stats["timeouts"], stats["queued"]), (2, 1, 0))
+        self.assertLess(stats["rpm_available"], 1)
+
+    def test_tokens_limit_independently_and_all_or_nothing(self):
+        from .rate_limit import RateLimitTimeout
+        self.governor.acquire(900)
+        with self.assertRaises(RateLimitTimeout):
+            self.governor.acquire(200)
+        # the failed call took no request either
+        self.assertGreaterEqual(self.governor.stats()["rpm_available"], 1)
+
+    def test_settle_returns_or_charges_the_difference(self):
+        self.governor.acquire(900)
+        self.governor.settle(900, 100)
+        self.assertAlmostEqual(self.governor.stats()["tpm_available"], 900, delta=5)
+        self.governor.settle(100, 1500)
+        self.assertLess(self.governor.stats()["tpm_available"], 0)
+
+    def test_waiters_are_let_through_once_the_bucket_refills(self):
+        self.governor.max_wait = 5
+        self.governor.rpm = 600  # one request every 0.1s
+        self.governor._call(600, 0, force=True)
+        self.assertGreater(self.governor.acquire(10), 0.05)
+
+
+class OpenRouterUsageTests(SimpleTestCase):
+    def stream(self, lines):
+        response = type("Response", (), {"raise_for_status": lambda self: None,
+                                         "iter_lines": lambda self, decode_unicode: iter(lines),
+                                         "__enter__": lambda self: self, "__exit__": lambda self, *exc: None})()
+        session = SimpleNamespace(post=lambda **kwargs: self.sent.append(json.loads(kwargs["data"])) or response)
+        return patch.object(myutils, "get_session", return_value=session)
+
+    def setUp(self):
+        self.sent = []
+        patcher = patch.object(myutils, "openrouter_governor")
+        self.governor = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def chunk(self, content=None, usage=None):
+        body = {"choices": [{"delta": {"content": content}}] if content else []}
+        if usage:
+            body["usage"] = {"total_tokens": usage}
+        return "data: " + json.dumps(body)
+
+    def test_stream_asks_for_usage_and_settles_with_it(self):
+        with self.stream([": OPENROUTER PROCESSING", self.chunk("ab"), self.chunk("cd"), self.chunk(usage=42), "data: [DONE]"]):
+            self.assertEqual("".join(myutils.stream_OpenRouter("q" * 40)), "abcd")
+        self.assertEqual(self.sent[0]["usage"], {"include": True})
+        estimated = myutils.estimate_tokens("q" * 40)
+        self.governor.acquire.assert_called_once_with(estimated)
+        self.governor.settle.assert_called_once_with(estimated, 42)
+
+    def test_stream_without_usage_settles_from_a_local_count(self):
+        with self.stream([self.chunk("x" * 80), "data: [DONE]"]):
+            list(myutils.stream_OpenRouter("q" * 40))
+        self.governor.settle.assert_called_once_with(myutils.estimate_tokens("q" * 40), 10 + 20)
+
+    def test_abandoned_stream_settles_what_was_received(self):
+        with self.stream([self.chunk("x" * 40), self.chunk("y" * 40), "data: [DONE]"]):
+            deltas = myutils.stream_OpenRouter("")
+            next(deltas)
+            deltas.close()
+        self.governor.settle.assert_called_once_with(myutils.estimate_tokens(""), 10)
+
+
+class SingleFlightTests(FakeRedisMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        from . import single_flight
+        self.sf = single_flight
+        self.states = {}
+        patcher = patch.object(single_flight, "AsyncResult",
+                               side_effect=lambda task_id, app: SimpleNamespace(state=self.states.get(task_id, "PENDING")))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.key = single_flight.flight_key("  Photosynthesis ")
+
+    def test_followers_join_a_live_leader(self):
+        self.assertEqual(self.key, self.sf.flight_key("photosynthesis"))
+        self.assertIsNone(self.sf.claim_flight(self.key, "leader"))
+        self.states["leader"] = "PROGRESS"
+        self.assertEqual(self.sf.claim_flight(self.key, "follower"), "leader")
+
+    def test_failed_or_revoked_leader_is_replaced(self):
+        for state in ("FAILURE", "REVOKED"):
+            self.redis.set(self.key, "leader", ex=self.sf.FLIGHT_LEASE_SECONDS)
+            self.states["leader"] = state
+            self.assertIsNone(self.sf.claim_flight(self.key, "follower"))
+            self.assertEqual(self.redis.get(self.key), b"follower")
+            self.redis.delete(self.key)
+
+    def test_queued_leader_keeps_its_claim_until_the_queued_lease_lapses(self):
+        self.assertIsNone(self.sf.claim_flight(self.key, "leader"))
+        self.assertGreater(self.redis.ttl(self.key), self.sf.FLIGHT_LEASE_SECONDS)
+        # still PENDING long after the claim: queued behind a backlog, not lost
+        self.redis.expire(self.key, 1)
+        self.assertEqual(self.sf.claim_flight(self.key, "follower"), "leader")
+        self.redis.delete(self.key)
+        self.assertIsNone(self.sf.claim_flight(self.key, "follower"))
+
+    def test_starting_cuts_the_claim_to_the_running_lease(self):
+        from . import tasks
+        self.sf.claim_flight(self.key, "job")
+        with patch.object(tasks.generate_notes_task, "replace", side_effect=lambda sig: RuntimeError(sig)):
+            result = tasks.generate_notes_task.apply(args=("p",), kwargs={"flight_key": self.key}, task_id="job")
+        self.assertIsInstance(result.result, RuntimeError)
+        self.assertLessEqual(self.redis.ttl(self.key), self.sf.FLIGHT_LEASE_SECONDS)
+
+    def test_only_the_holder_extends_or_releases(self):
+        self.sf.claim_flight(self.key, "leader")
+        self.redis.expire(self.key, 10)
+        self.sf.extend_flight(self.key, "other")
+        self.assertLessEqual(self.redis.ttl(self.key), 10)
+        self.sf.extend_flight(self.key, "leader")
+        self.assertGreater(self.redis.ttl(self.key), 10)
+        self.sf.release_flight(self.key, "other")
+        self.assertEqual(self.redis.get(self.key), b"leader")
+        self.sf.release_flight(self.key, "leader")
+        self.assertIsNone(self.redis.get(self.key))
+
+    def test_assembly_caches_before_releasing(self):
+        from unittest.mock import MagicMock
+        from . import tasks
+        calls = MagicMock()
+        with patch.object(tasks, "note_cache", calls.note_cache), patch.object(tasks, "release_flight", calls.release_flight):
+            tasks.assemble_notes_task.run(["https://img"], {"draft": "a &&&image: x&&&", "query": "light",
+                                                            "job_id": "job", "flight_key": self.key})
+        self.assertEqual([name for name, _, _ in calls.mock_calls],
+                         ["note_cache.embed", "note_cache.put", "release_flight"])
+
+    def test_image_lookups_renew_the_lease(self):
+        from . import tasks
+        self.sf.claim_flight(self.key, "job")
+        self.redis.expire(self.key, 10)
+        with patch.object(tasks, "google_search_image", return_value="https://img"):
+            tasks.image_lookup_task.run("prism", time.time() + 60, self.key, "job")
+        self.assertGreater(self.redis.ttl(self.key), 10)
+
+
+class AsyncRequestTests(SimpleTestCase):
+    async def test_async_request_retries_retryable_statuses(self):
+        statuses = iter([503, 429, 200])
+
+        def handler(request):
+            return httpx.Response(next(statuses), headers={"Retry-After": "0"}, text="ok")
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            with patch.object(http_client, "get_async_client", return_value=client):
+                response = await http_client.async_request("POST", "https://example.com")
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_request_returns_last_response_when_retries_run_out(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(502)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            with patch.object(http_client, "get_async_client", return_value=client), \
+                    patch.object(http_client, "BACKOFF_FACTOR", 0):
+                response = await http_client.async_request("GET", "https://example.com")
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(len(calls), http_client.MAX_RETRIES + 1)
+
+    async def test_async_request_does_not_retry_client_errors(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(404)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            with patch.object(http_client, "get_async_client", return_value=client):
+                response = await http_client.async_request("GET", "https://example.com")
+        self.assertEqual((response.status_code, len(calls)), (404, 1))
+
+    async def test_transport_errors_become_request_exceptions(self):
+        def handler(request):
+            raise httpx.ConnectTimeout("timed out", request=request)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            with patch.object(http_client, "get_async_client", return_value=client):
+                with self.assertRaises(requests.RequestException):
+                    await http_client.async_request("GET", "https://example.com")
+
+
+class ImageSearchParityTests(FakeRedisMixin, SimpleTestCase):
+    """
+    search_images goes through GoogleImagesSearch, asearch_images calls the API itself; given the same
+    API page and HEAD answers they must send the same search and cache the same URL list.
+    """
+    items = [
+        {"link": "https://a/1.png", "image": {"contextLink": "https://a"}},
+        {"link": "https://a/page.html", "image": {"contextLink": "https://a"}},
+        {"link": "https://a/2.jpg", "image": {"contextLink": "https://a"}},
+    ]
+
+    def head_headers(self, url):
+        if url.endswith(".html"):
+            return {"Content-Type": "text/html", "Content-Length": "10"}
+        return {"Content-Type": "image/png", "Content-Length": "10"}
+
+    def test_async_params_match_the_library(self):
+        from google_images_search.google_api import GoogleCustomSearch
+        expected = GoogleCustomSearch("key", "cx")._search_params({"q": "prism", "num": myutils.IMAGE_RESULTS_PER_QUERY})
+        self.assertEqual({"q": "prism", **myutils.IMAGE_SEARCH_PARAMS}, expected)
+
+    def test_both_paths_return_the_same_urls(self):
+        from google_images_search.google_api import GoogleCustomSearch
+        sent = []
+
+        def query_api(gcs, search_params, cache_discovery=True):
+            sent.append(dict(search_params))
+            # the library pages until it has num valid results; an empty page ends the search
+            return {"items": self.items} if search_params["start"] == 1 else {}
+
+        head = lambda url, **kwargs: SimpleNamespace(status_code=200, headers=self.head_headers(url))
+        with patch.object(GoogleCustomSearch, "_query_google_api", query_api), \
+                patch("google_images_search.google_api.requests.head", side_effect=head), \
+                patch.object(myutils, "_gis_local", threading.local()):
+            sync_urls = myutils.search_images("prism")
+        redis_cache.get_redis().flushall()
+
+        def handler(request):
+            if request.method == "HEAD":
+                return httpx.Response(200, headers=self.head_headers(str(request.url)))
+            sent.append(dict(request.url.params))
+            return httpx.Response(200, json={"items": self.items})
+
+        async def search():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                with patch.object(http_client, "get_async_client", return_value=client), \
+                        patch.object(myutils, "get_async_client", return_value=client):
+                    return await myutils.asearch_images("prism")
+
+        async_urls = asyncio.run(search())
+        self.assertEqual(sync_urls, ["https://a/1.png", "https://a/2.jpg"])
+        self.assertEqual(async_urls, sync_urls)
+        library_params, api_params = sent[0], sent[-1]
+        self.assertEqual({k: str(v) for k, v in library_params.items()},
+                         {k: v for k, v in api_params.items() if k not in ("key", "cx")})
+
+
+class ModifyTextViewTests(FakeRedisMixin, SimpleTestCase):
+    def post(self, path, body, handler):
+        async def post():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                with patch.object(http_client, "get_async_client", return_value=client), \
+                        patch.object(myutils, "get_async_client", return_value=client):
+                    return await self.async_client.post(path, body, content_type="application/json")
+
+        return asyncio.run(post())
+
+    def test_transport_error_returns_the_openrouter_error(self):
+        def handler(request):
+            raise httpx.ConnectError("connection refused", request=request)
+
+        response = self.post("/modify_text/", {"text": "cells"}, handler)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()["message"], "Error in response from OpenRouter")
+        self.assertIn("ConnectError", response.json()["error"])
+
+    def test_non_json_reply_returns_the_openrouter_error(self):
+        for body in (b"<html>maintenance</html>", b"", b'{"choices": []}'):
+            response = self.post("/modify_text/", {"text": "cells"}, lambda request: httpx.Response(200, content=body))
+            self.assertEqual(response.status_code, 500)
+            self.assertIn("Unexpected response from OpenRouter", response.json()["error"])
+
+    def test_non_json_image_search_returns_an_error(self):
+        response = self.post("/modify_image/", {"imgText": "cells"},
+                             lambda request: httpx.Response(200, content=b"<html>quota</html>"))
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("Unexpected response from image search", response.json()["error"])
+
+
+class BatchReworkTests(SimpleTestCase):
+    def test_pack_sections_keeps_order_within_the_budget(self):
+        self.assertEqual(myutils.pack_sections(["aaaa", "bbb", "cc", "dddd"], budget=7), [[0, 1], [2, 3]])
+
+    def test_oversized_section_is_packed_alone(self):
+        self.assertEqual(myutils.pack_sections(["aa", "x" * 20, "bb", "cc"], budget=10), [[0], [1], [2, 3]])
+
+    def test_section_with_delimiters_is_packed_alone(self):
+        sections = ["aa", "see <<<END 1>>> here", "bb", "cc"]
+        self.assertEqual(myutils.pack_sections(sections, budget=100), [[0], [1], [2, 3]])
+
+    def test_parse_skips_mangled_and_out_of_range_sections(self):
+        response = "<<<SECTION 1>>>\none\n<<<END 1>>>\n<<<SECTION 2>>>\ntwo\n<<<END 3>>>\n" \
+            "<<<SECTION 3>>>\n\n<<<END 3>>>\n<<<SECTION 9>>>\nnine\n<<<END 9>>>"
+        self.assertEqual(myutils.parse_batch_rework(response, 3), {0: "one"})
+
+
+class ModifyTextBatchViewTests(SimpleTestCase):
+    def setUp(self):
+        self.prompts = []
+
+    async def fake_openrouter(self, prompt, drop=(), fail=False, broken=None):
+        self.prompts.append(prompt)
+        if fail:
+            raise requests.RequestException("upstream down")
+        if broken and broken in prompt:
+            raise ValueError("unreadable reply")
+        if prompt.endswith(myutils.rework_instruction):
+            return f"```text\n{prompt[:-len(myutils.rework_instruction)].upper()}\n```"
+        sections = re.findall(r"<<<SECTION (\d+)>>>\n(.*?)\n<<<END \1>>>", prompt, re.S)
+        return "\n".join(f"<<<SECTION {n}>>>\n{text.upper()}\n<<<END {n}>>>" for n, text in sections if text not in drop)
+
+    def post(self, sections, **behaviour):
+        async def openrouter(prompt):
+            return await self.fake_openrouter(prompt, **behaviour)
+
+        with patch("NoteMaker.views.arequest_OpenRouter", openrouter):
+            return asyncio.run(self.async_client.post("/modify_text_batch/", {"sections": sections}, content_type="application/json"))
+
+    def test_results_follow_the_order_sent(self):
+        response = self.post(["alpha", "beta", "gamma"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"], [
+            {"index": 0, "modifiedContent": "ALPHA"},
+            {"index": 1, "modifiedContent": "BETA"},
+            {"index": 2, "modifiedContent": "GAMMA"},
+        ])
+        self.assertEqual(len(self.prompts), 1)
+        self.assertNotIn("calls", response.json())
+
+    def test_dropped_section_is_retried_alone(self):
+        response = self.post(["alpha", "beta", "gamma"], drop=("beta",))
+        self.assertEqual([r["modifiedContent"] for r in response.json()["results"]], ["ALPHA", "BETA", "GAMMA"])
+        self.assertEqual(self.prompts[1], "beta" + myutils.rework_instruction)
+
+    def test_section_with_delimiters_is_sent_alone(self):
+        response = self.post(["alpha", "a <<<END 1>>> b", "gamma"])
+        self.assertEqual([r["modifiedContent"] for r in response.json()["results"]], ["ALPHA", "A <<<END 1>>> B", "GAMMA"])
+        self.assertEqual(len(self.prompts), 3)
+
+    def test_upstream_error_is_reported_per_section(self):
+        response = self.post(["alpha", "beta"], fail=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"], [
+            {"index": 0, "error": "upstream down"},
+            {"index": 1, "error": "upstream down"},
+        ])
+
+    def test_failed_group_does_not_fail_the_others(self):
+        response = self.post(["alpha", "beta", "x <<< y"], broken="x <<< y")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"], [
+            {"index": 0, "modifiedContent": "ALPHA"},
+            {"index": 1, "modifiedContent": "BETA"},
+            {"index": 2, "error": "unreadable reply"},
+        ])
+
+    def test_rejects_bad_sections(self):
+        self.assertEqual(self.post([]).status_code, 400)
+        self.assertEqual(self.post(["ok", 3]).status_code, 400)
@@ -1,19 +1,48 @@
 from rest_framework.response import Response
 from rest_framework.request import Request
 from rest_framework.views import APIView
-from typing import Dict
-from .myutils import request_OpenRouter,google_search_image,get_context,topics_query,new_image
+from typing import Dict, List, Optional
+from .myutils import request_OpenRouter,google_search_image,get_context,topics_query,new_image,image_cache
+from .myutils import arequest_OpenRouter,anew_image,extract_block,rework_instruction
+from .myutils import pack_sections,batch_rework_prompt,parse_batch_rework
+from .semantic_cache import note_cache
+from .rate_limit import openrouter_governor
+from .single_flight import flight_key, claim_flight, release_flight
 from requests.exceptions import RequestException
 import requests
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse, JsonResponse
+from django.views import View
+from rest_framework.renderers import JSONRenderer
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
+import os
 import json
+import asyncio
+import uuid
 from .tasks import generate_notes_task
+from .streaming import stream_notes, aiterate, EventStreamRenderer
+from .image_proxy import proxy_image, proxy_image_variant, parse_variant, ProxyError
+from .task_events import task_snapshot, snapshot_etag, stored_etag, store_etag
+from django.utils.http import parse_etags
+from celery import states
+from UserData.indexing import user_namespace
 from celery.result import AsyncResult
 from NoteCraft_backend.celery import app
 
+def not_modified(etag:str)->HttpResponse:
+    response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    response["ETag"] = etag
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+def own_namespace(request:Request, requested:bool) -> Optional[str]:
+    # uploads are only searched for the signed-in user who asked for them
+    if requested and request.user.is_authenticated:
+        return user_namespace(request.user.pk)
+    return None
+
 class HelloWorldView(APIView):
     def get(self, request:Request)->Response:
         return Response({"message": "Hello, world!"})
@@ -26,41 +55,145 @@ class GenerateNoteView(APIView):
             return Response({"error": "query parameter is required"}, status=400)
 
         prompt_1 = query + topics_query
+        # regenerate skips the semantic note cache lookup; the fresh notes are still cached
+        use_cache = not params.get("regenerate", False) # type: ignore
+        namespace = own_namespace(request, params.get("use_my_documents", False)) # type: ignore
+
+        # identical requests while one is generating share its task instead of starting another
+        task_id = str(uuid.uuid4())
+        key = flight_key(query, namespace, use_cache)
+        leader = claim_flight(key, task_id)
+        if leader:
+            return Response({"message": "Note generation already in progress", "task_id": leader, "coalesced": True})
+        try:
+            generate_notes_task.apply_async(args=[prompt_1], task_id=task_id, kwargs={
+                "query": query, "use_cache": use_cache, "user_namespace": namespace, "flight_key": key,
+            })
+        except Exception:
+            release_flight(key, task_id)
+            raise
+        return Response({"message": "Note generation started", "task_id": task_id})
+
+class GenerateNoteStreamView(APIView):
+    renderer_classes = [EventStreamRenderer, JSONRenderer]
+
+    def get(self, request:Request):
+        query = request.query_params.get("query", "")
+        if not query:
+            return Response({"error": "query parameter is required"}, status=400)
 
-        task = generate_notes_task.delay(prompt_1)
-        return Response({"message": "Note generation started", "task_id": task.id})
+        use_cache = request.query_params.get("regenerate", "") not in ("1", "true")
+        namespace = own_namespace(request, request.query_params.get("use_my_documents", "") in ("1", "true"))
+        # generation blocks, so it runs in a thread and each event is sent as soon as it exists
+        response = StreamingHttpResponse(aiterate(stream_notes(query, use_cache=use_cache, user_namespace=namespace)),
+                                         content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
 
 class TaskStatusView(APIView):
     def get(self, request:Request, task_id):
-        result = AsyncResult(task_id)
-        return Response({
-            "task_id": task_id,
-            "state": result.state,
-            "result": result.result if result.ready() else None
-        })
+        if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+        etag = stored_etag(task_id)
+        if etag and etag in if_none_match:
+            return not_modified(etag)
+
+        snapshot = task_snapshot(task_id)
+        if not etag:
+            etag = snapshot_etag(snapshot)
+            if snapshot["state"] in states.READY_STATES:
+                store_etag(task_id, etag)
+        if etag in if_none_match:
+            return not_modified(etag)
+        response = Response(snapshot)
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, no-cache"
+        return response
+
+
+REWORK_MAX_SECTIONS = int(os.getenv("REWORK_MAX_SECTIONS", "200"))
+REWORK_CONCURRENCY = int(os.getenv("REWORK_CONCURRENCY", "4"))
 
+def json_body(request) -> Dict:
+    try:
+        body = json.loads(request.body or b"{}")
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
 
-class ModifyTextView(APIView):
-    def post(self,request:Request)->Response:
-        change_text:str=request.data.get("text") # type: ignore
-        print(change_text)
+# Async Django views rather than DRF APIViews: under the uvicorn workers they await OpenRouter and
+# image search on the event loop instead of holding a worker for the whole round trip.
+@method_decorator(csrf_exempt, name='dispatch')
+class ModifyTextView(View):
+    async def post(self, request) -> JsonResponse:
+        change_text = json_body(request).get("text")
+        if not isinstance(change_text, str) or not change_text:
+            return JsonResponse({"error": "text is required"}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            response:str=request_OpenRouter(change_text+"rework this part of text to get more clarity and elaborate the ouput should be in ```text box the new content should not be more than 3 times original lenght")
-            start:int = response.find("```text") + len("```text")
-            end:int = response.find("```", start)
-            new_text:str = response[start:end].strip()
-            return Response({"message": "Text modified successfully","modifiedContent": new_text})
-        except (TypeError,RequestException) as e:
-            return Response({"message": "Error in response from OpenRouter","error": str(e)},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-class ModifyImageView(APIView):
-    def post(self,request:Request)->Response:
-        change_image:str=request.data.get("imgText") # type: ignore
+            response:str = await arequest_OpenRouter(change_text + rework_instruction)
+            new_text:str = extract_block(response, "text")
+            return JsonResponse({"message": "Text modified successfully","modifiedContent": new_text})
+        except (TypeError,KeyError,RequestException) as e:
+            return JsonResponse({"message": "Error in response from OpenRouter","error": str(e)},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ModifyTextBatchView(View):
+    """
+    Rework many sections in one request. Sections are packed into as few prompts as fit, the prompts run
+    concurrently, and any section the model drops from a packed reply is retried on its own.
+    Each result carries either modifiedContent or error, in the order the sections were sent.
+    """
+
+    async def post(self, request) -> JsonResponse:
+        sections = json_body(request).get("sections")
+        if not isinstance(sections, list) or not sections or not all(isinstance(s, str) and s for s in sections):
+            return JsonResponse({"error": "sections must be a non-empty list of strings"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(sections) > REWORK_MAX_SECTIONS:
+            return JsonResponse({"error": f"at most {REWORK_MAX_SECTIONS} sections per request"}, status=status.HTTP_400_BAD_REQUEST)
+
+        results: Dict[int, Dict] = {}
+        limit = asyncio.Semaphore(REWORK_CONCURRENCY)
+
+        async def rework(group: List[int]) -> List[int]:
+            # returns the sections that still need a call of their own
+            async with limit:
+                try:
+                    if len(group) == 1:
+                        response = await arequest_OpenRouter(sections[group[0]] + rework_instruction)
+                        reworked = {0: extract_block(response, "text")}
+                    else:
+                        response = await arequest_OpenRouter(batch_rework_prompt([sections[i] for i in group]))
+                        reworked = parse_batch_rework(response, len(group))
+                # a bad reply fails only its own group's sections
+                except (TypeError, KeyError, ValueError, IndexError, RequestException) as e:
+                    for i in group:
+                        results[i] = {"error": str(e)}
+                    return []
+            for n, i in enumerate(group):
+                if n in reworked:
+                    results[i] = {"modifiedContent": reworked[n]}
+            return [i for n, i in enumerate(group) if n not in reworked and len(group) > 1]
+
+        leftovers = await asyncio.gather(*(rework(group) for group in pack_sections(sections)))
+        retries = [i for missing in leftovers for i in missing]
+        await asyncio.gather(*(rework([i]) for i in retries))
+
+        return JsonResponse({
+            "message": "Text modified",
+            "results": [{"index": i, **results.get(i, {"error": "No output for this section"})} for i in range(len(sections))],
+        })
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ModifyImageView(View):
+    async def post(self, request) -> JsonResponse:
+        change_image = json_body(request).get("imgText")
+        if not isinstance(change_image, str) or not change_image:
+            return JsonResponse({"error": "imgText is required"}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            new_image_url:str=new_image(change_image)
-            return Response({"message": "Image modified successfully","modifiedContent": f"![{change_image}]({new_image_url})"})
-        except (TypeError,RequestException) as e:
-            return Response({"message": "Error in response from OpenRouter","error": str(e)},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            new_image_url:str = await anew_image(change_image)
+            return JsonResponse({"message": "Image modified successfully","modifiedContent": f"![{change_image}]({new_image_url})"})
+        except (TypeError,KeyError,RequestException) as e:
+            return JsonResponse({"message": "Error in response from OpenRouter","error": str(e)},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class ProxyImageView(APIView):
@@ -71,24 +204,28 @@ class ProxyImageView(APIView):
             return Response({"error": "Image URL is required"}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            # Fetch the image from the external URL
-            response = requests.get(image_url, stream=True)
-            response.raise_for_status()
-
-            # Set CORS headers
-            http_response = HttpResponse(
-                response.raw,
-                content_type=response.headers.get('Content-Type')
-            )
-            http_response['Access-Control-Allow-Origin'] = '*'
+            variant = parse_variant(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-            return http_response
-
-        except requests.RequestException as e:
-            return Response({"error": f"Failed to fetch image: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        try:
+            if variant:
+                return proxy_image_variant(request, image_url, variant)
+            return proxy_image(request, image_url)
+        except ProxyError as e:
+            return Response({"error": str(e)}, status=e.status)
+        except OSError as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 class CancelTaskView(APIView):
     def post(self, request: Request):
         task_id = request.data.get("task_id")  # type: ignore
         app.control.revoke(task_id, terminate=True)  
         return Response({"error": "Missing task_id"}, status=400)
+
+class CacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request:Request)->Response:
+        return Response({"notes": note_cache.stats(), "images": image_cache.stats(),
+                         "openrouter": openrouter_governor.stats()})
@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete
 
 
 class UserdataConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'UserData'
+
+    def ready(self):
+        from .models import Document
+        from .signals import remove_document_vectors
+        post_delete.connect(remove_document_vectors, sender=Document, dispatch_uid="remove_document_vectors")
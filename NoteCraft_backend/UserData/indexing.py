@@ -0,0 +1,51 @@
+from typing import Dict, List
+import fitz
+from NoteMaker.chunking import chunk_text
+from NoteMaker.embeddings import embed_texts
+from NoteMaker.retrievers import get_retriever, UPSERT_BATCH
+
+
+def user_namespace(user_id) -> str:
+    # each user's uploads live in their own namespace, next to the shared subject namespaces
+    return f"user-{user_id}"
+
+
+def extract_pages(pdf_path: str) -> List[str]:
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        return [page.get_text() for page in doc] # type: ignore
+
+
+def document_chunks(doc_id: str, namespace: str, pages: List[str]) -> List[Dict]:
+    chunks = []
+    for page_number, text in enumerate(pages, start=1):
+        for chunk in chunk_text(text):
+            chunks.append({
+                **chunk,
+                "chunk_index": len(chunks),
+                "page": page_number,
+                "doc_id": doc_id,
+                "namespace": namespace,
+                "source": "upload",
+            })
+    return chunks
+
+
+def index_document(doc_id: str, namespace: str, pdf_path: str) -> int:
+    """
+    Chunk the PDF page by page, embed and upsert one batch at a time. Returns the number of chunks indexed.
+    """
+    chunks = document_chunks(doc_id, namespace, extract_pages(pdf_path))
+    retriever = get_retriever()
+    for i in range(0, len(chunks), UPSERT_BATCH):
+        batch = chunks[i:i + UPSERT_BATCH]
+        vectors = embed_texts([chunk["text"] for chunk in batch], input_type="passage")
+        retriever.upsert(namespace, [{
+            "id": f"{doc_id}#{chunk['chunk_index']}",
+            "values": vector.tolist(),
+            "metadata": chunk,
+        } for chunk, vector in zip(batch, vectors)])
+    return len(chunks)
+
+
+def delete_document_vectors(doc_id: str, namespace: str) -> int:
+    return get_retriever().delete_document(namespace, doc_id)
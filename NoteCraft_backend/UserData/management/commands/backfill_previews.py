@@ -0,0 +1,31 @@
+import base64
+import io
+from django.core.management.base import BaseCommand
+from PIL import Image
+from UserData.models import Document
+from UserData.previews import encode_preview, upload_preview
+
+
+class Command(BaseCommand):
+    help = ("Re-encode the inline base64 first-page PNGs as small WebP previews in Cloudinary. "
+            "Safe to rerun; it must have completed before the release that drops first_page.")
+
+    def handle(self, *args, **options):
+        ids = list(Document.objects.exclude(first_page__in=["", "null"]).values_list("id", flat=True))
+        moved = failed = 0
+        for pk in ids:
+            # one row at a time, the inline PNGs are large
+            first_page = Document.objects.filter(pk=pk).values_list("first_page", flat=True).first()
+            if first_page is None:
+                continue
+            try:
+                with Image.open(io.BytesIO(base64.b64decode(first_page))) as img:
+                    preview_url = upload_preview(encode_preview(img))
+            except Exception as e:
+                # left in place, so a rerun picks it up
+                self.stderr.write(f"Document {pk}: {e}")
+                failed += 1
+                continue
+            Document.objects.filter(pk=pk).update(preview_url=preview_url, first_page="")
+            moved += 1
+        self.stdout.write(f"Moved {moved} previews, {failed} failed")
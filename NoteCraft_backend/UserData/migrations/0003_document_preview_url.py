@@ -0,0 +1,20 @@
+# Generated by Django 5.1.7 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("UserData", "0002_document_first_page"),
+    ]
+
+    operations = [
+        # existing previews are moved over by `manage.py backfill_previews`, which uploads to Cloudinary
+        # and so cannot run inside a migration; first_page stays until a later release
+        migrations.AddField(
+            model_name="document",
+            name="preview_url",
+            field=models.CharField(blank=True, default="", max_length=500),
+        ),
+    ]
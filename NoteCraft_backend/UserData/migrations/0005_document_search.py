@@ -0,0 +1,52 @@
+# Generated by Django 5.1.7 on 2026-10-18 11:40
+
+from django.db import migrations, models
+from ._sqlite_fts import create_index, drop_index
+
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    ALTER TABLE "UserData_document" ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(topic, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(content, '')), 'B')
+    ) STORED
+    """,
+    'CREATE INDEX "UserData_document_search_gin" ON "UserData_document" USING GIN (search_vector)',
+    'CREATE INDEX "UserData_document_topic_trgm" ON "UserData_document" USING GIN (topic gin_trgm_ops)',
+]
+POSTGRES_REVERSE = [
+    'DROP INDEX IF EXISTS "UserData_document_topic_trgm"',
+    'DROP INDEX IF EXISTS "UserData_document_search_gin"',
+    'ALTER TABLE "UserData_document" DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def forward(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        for sql in POSTGRES_FORWARD:
+            schema_editor.execute(sql)
+    create_index(schema_editor)
+
+
+def reverse(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        for sql in POSTGRES_REVERSE:
+            schema_editor.execute(sql)
+    drop_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("UserData", "0003_document_preview_url"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="content",
+            field=models.TextField(blank=True, default=""),
+        ),
+        # on SQLite, the FTS5 index described in _sqlite_fts.py
+        migrations.RunPython(forward, reverse),
+    ]
@@ -0,0 +1,77 @@
+"""
+The SQLite FTS5 index over UserData_document, built by 0005 and shared with migrations that remake the table.
+
+FTS rows are keyed by UserData_document_fts_rowid, an explicit INTEGER PRIMARY KEY per document id,
+because the document table's own rowid (its primary key is a UUID) may be renumbered by VACUUM.
+Django remakes a SQLite table for most AlterField/RemoveField operations and the triggers are dropped
+with the old table, so a migration that remakes UserData_document must call create_triggers() after it.
+"""
+
+FTS_TABLE = "UserData_document_fts"
+ROWID_TABLE = "UserData_document_fts_rowid"
+TRIGGERS = ("UserData_document_fts_ai", "UserData_document_fts_ad", "UserData_document_fts_au")
+
+_ROWID = f'(SELECT rowid FROM "{ROWID_TABLE}" WHERE document_id = {{row}}.id)'
+_INSERT = f'INSERT INTO "{FTS_TABLE}"(rowid, topic, content) VALUES ({_ROWID.format(row="new")}, new.topic, new.content);'
+# the table is contentless, so a row is removed by handing back the values it was indexed with
+_DELETE = (f'INSERT INTO "{FTS_TABLE}"("{FTS_TABLE}", rowid, topic, content) '
+           f'VALUES (\'delete\', {_ROWID.format(row="old")}, old.topic, old.content);')
+
+CREATE_TABLES = [
+    f'CREATE TABLE "{ROWID_TABLE}" (rowid INTEGER PRIMARY KEY AUTOINCREMENT, document_id char(32) NOT NULL UNIQUE)',
+    f"CREATE VIRTUAL TABLE \"{FTS_TABLE}\" USING fts5(topic, content, content='')",
+]
+CREATE_TRIGGERS = [
+    f'''
+    CREATE TRIGGER "UserData_document_fts_ai" AFTER INSERT ON "UserData_document" BEGIN
+        INSERT INTO "{ROWID_TABLE}"(document_id) VALUES (new.id);
+        {_INSERT}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER "UserData_document_fts_ad" AFTER DELETE ON "UserData_document" BEGIN
+        {_DELETE}
+        DELETE FROM "{ROWID_TABLE}" WHERE document_id = old.id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER "UserData_document_fts_au" AFTER UPDATE OF topic, content ON "UserData_document" BEGIN
+        {_DELETE}
+        {_INSERT}
+    END
+    ''',
+]
+POPULATE = [
+    f'INSERT INTO "{ROWID_TABLE}"(document_id) SELECT id FROM "UserData_document"',
+    f'INSERT INTO "{FTS_TABLE}"(rowid, topic, content) '
+    f'SELECT m.rowid, d.topic, d.content FROM "{ROWID_TABLE}" m JOIN "UserData_document" d ON d.id = m.document_id',
+]
+
+
+def _execute(schema_editor, statements) -> None:
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+def create_index(schema_editor) -> None:
+    _execute(schema_editor, CREATE_TABLES + POPULATE + CREATE_TRIGGERS)
+
+
+def drop_index(schema_editor) -> None:
+    _execute(schema_editor, [f'DROP TRIGGER IF EXISTS "{name}"' for name in TRIGGERS] + [
+        f'DROP TABLE IF EXISTS "{FTS_TABLE}"',
+        f'DROP TABLE IF EXISTS "{ROWID_TABLE}"',
+    ])
+
+
+def create_triggers(schema_editor) -> None:
+    _execute(schema_editor, [f'DROP TRIGGER IF EXISTS "{name}"' for name in TRIGGERS] + CREATE_TRIGGERS)
+
+
+def recreate_triggers(apps, schema_editor) -> None:
+    """
+    RunPython step for migrations that remake UserData_document.
+    """
+    create_triggers(schema_editor)
@@ -10,7 +10,15 @@ class Document(models.Model):
     pdf_public_id = models.CharField(max_length=500)  
     uploaded_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='documents')
     uploaded_at = models.DateTimeField(auto_now_add=True)
-    first_page=models.CharField()
+    preview_url = models.CharField(max_length=500, blank=True, default="")
+    # legacy inline base64 PNG, superseded by preview_url. `manage.py backfill_previews` moves and empties
+    # it; the column is dropped in a later release, once every deployment has run the backfill.
+    first_page = models.TextField()
+    # text extracted at upload; indexed for search together with the topic (see search.py)
+    content = models.TextField(blank=True, default="")
+    # SHA-256 of the PDF; uploads of identical bytes reuse the stored blob and preview.
+    # Nullable so SQLite adds the column in place instead of rebuilding the table under the FTS triggers.
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
 
     def __str__(self):
         return self.topic
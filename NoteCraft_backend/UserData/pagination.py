@@ -0,0 +1,65 @@
+import json
+import base64
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Optional, Tuple
+from uuid import UUID
+from django.db.models import Q, QuerySet
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def _dump(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (UUID, Decimal)):
+        return str(value)
+    return value
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps([_dump(v) for v in values]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def _after(keys: List[str], values: list) -> Q:
+    # rows strictly after the cursor in descending key order: (a < x) or (a = x and b < y) or ...
+    condition = Q()
+    for i, key in enumerate(keys):
+        step = Q(**{f"{key}__lt": values[i]})
+        for prev, value in zip(keys[:i], values[:i]):
+            step &= Q(**{prev: value})
+        condition |= step
+    return condition
+
+
+def keyset_page(queryset: QuerySet, keys: List[str], cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+    """
+    One page of queryset ordered by keys, all descending, the last of them unique.
+    Pages are found with a WHERE on the cursor's key values rather than OFFSET, so page 100 costs the same as page 1.
+    """
+    queryset = queryset.order_by(*[f"-{key}" for key in keys])
+    if cursor:
+        queryset = queryset.filter(_after(keys, decode_cursor(cursor, len(keys))))
+    rows = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([getattr(rows[-1], key) for key in keys])
+    return rows, next_cursor
+
+
+def page_size(value: Optional[str]) -> int:
+    if not value:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(int(value), MAX_PAGE_SIZE))
@@ -0,0 +1,40 @@
+import io
+import os
+import fitz
+import cloudinary.uploader
+from PIL import Image
+
+PREVIEW_WIDTH = int(os.getenv("PREVIEW_WIDTH", "320"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "70"))
+
+
+def encode_preview(img: Image.Image) -> bytes:
+    if img.width > PREVIEW_WIDTH:
+        img = img.resize((PREVIEW_WIDTH, max(1, round(img.height * PREVIEW_WIDTH / img.width))), Image.Resampling.LANCZOS)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    out = io.BytesIO()
+    img.save(out, "WEBP", quality=PREVIEW_QUALITY, method=6)
+    return out.getvalue()
+
+
+def render_preview(pdf_path: str) -> bytes:
+    """
+    First page as a small WebP. The page is rasterised at roughly the target width
+    instead of full resolution, so big pages stay cheap.
+    """
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        page = doc[0]
+        scale = min(1.0, 2 * PREVIEW_WIDTH / page.rect.width)
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale)) # type: ignore
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    return encode_preview(img)
+
+
+def upload_preview(image: bytes) -> str:
+    result = cloudinary.uploader.upload(
+        file=image,
+        resource_type="image",
+        folder="previews"
+    )
+    return result['secure_url']
@@ -0,0 +1,130 @@
+import os
+import re
+from typing import List, Optional, Tuple
+from uuid import UUID
+import fitz
+from django.db import connection
+from django.db.models import BooleanField, Case, DecimalField, IntegerField, QuerySet, Value, When
+from django.db.models.expressions import RawSQL
+from .models import Document
+from .pagination import decode_cursor, encode_cursor, keyset_page
+
+# tsvector values are capped at 1MB, and the first pages carry most of what people search for anyway
+SEARCH_TEXT_CHARS = int(os.getenv("SEARCH_TEXT_CHARS", "200000"))
+FTS_TABLE = "UserData_document_fts"
+# FTS rowid -> document id, see migrations/_sqlite_fts.py
+FTS_ROWID_TABLE = "UserData_document_fts_rowid"
+
+
+def extract_text(pdf_path: str, max_chars: int = SEARCH_TEXT_CHARS) -> str:
+    parts: List[str] = []
+    size = 0
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        for page in doc:
+            text = page.get_text() # type: ignore
+            parts.append(text)
+            size += len(text)
+            if size >= max_chars:
+                break
+    return "".join(parts)[:max_chars]
+
+
+def search_terms(query: str) -> List[str]:
+    return re.findall(r"\w+", query.lower())
+
+
+def _postgres_search(queryset: QuerySet, query: str, terms: List[str]) -> QuerySet:
+    # every word must match, the last one (or all of them) as a prefix: "neur netw" finds "neural networks"
+    tsquery = " & ".join(f"{t}:*" for t in terms)
+    return queryset.annotate(
+        # numeric, so the rank survives a round trip through a pagination cursor exactly
+        rank=RawSQL(
+            '''round((ts_rank_cd("UserData_document".search_vector, to_tsquery('simple', %s), 32)'''
+            ''' + similarity("UserData_document".topic, %s))::numeric, 6)''',
+            [tsquery, query],
+            output_field=DecimalField(max_digits=12, decimal_places=6),
+        )
+    ).filter(
+        RawSQL(
+            '''("UserData_document".search_vector @@ to_tsquery('simple', %s)'''
+            ''' OR "UserData_document".topic %% %s)''',
+            [tsquery, query],
+            output_field=BooleanField(),
+        )
+    ).order_by("-rank", "-uploaded_at")
+
+
+def _sqlite_matches(terms: List[str], after: Optional[list] = None, limit: Optional[int] = None) -> List[Tuple[str, int, float]]:
+    """
+    (document id, FTS rowid, rank) of matching documents, best first, the rank negated bm25 so higher is better.
+    after is a (rank, rowid) keyset bound, so a page is found inside the FTS query and not by slicing all matches.
+    """
+    match = " ".join(f'"{t}"*' for t in terms)
+    rank = f'-bm25("{FTS_TABLE}", 10.0, 1.0)'
+    sql = (f'SELECT m.document_id, m.rowid, {rank} FROM "{FTS_TABLE}" f JOIN "{FTS_ROWID_TABLE}" m ON m.rowid = f.rowid '
+           f'WHERE "{FTS_TABLE}" MATCH %s')
+    params: list = [match]
+    if after is not None:
+        sql += f' AND ({rank} < %s OR ({rank} = %s AND m.rowid < %s))'
+        params += [after[0], after[0], after[1]]
+    sql += f' ORDER BY {rank} DESC, m.rowid DESC'
+    if limit is not None:
+        sql += ' LIMIT %s'
+        params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _sqlite_search(queryset: QuerySet, terms: List[str]) -> QuerySet:
+    ids = [row[0] for row in _sqlite_matches(terms)]
+    # higher is better, like ts_rank on Postgres
+    ranking = Case(*[When(id=pk, then=Value(len(ids) - i)) for i, pk in enumerate(ids)], default=Value(0),
+                   output_field=IntegerField())
+    return queryset.filter(id__in=ids).annotate(rank=ranking).order_by("-rank")
+
+
+def _sqlite_search_page(queryset: QuerySet, terms: List[str], cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+    after = decode_cursor(cursor, 2) if cursor else None
+    if after is not None and not all(isinstance(v, (int, float)) for v in after):
+        raise ValueError("Invalid cursor")
+    matches = _sqlite_matches(terms, after, limit + 1)
+    documents = queryset.in_bulk([document_id for document_id, _, _ in matches[:limit]])
+    page = [documents[UUID(document_id)] for document_id, _, _ in matches[:limit] if UUID(document_id) in documents]
+    next_cursor = None
+    if len(matches) > limit:
+        _, rowid, rank = matches[limit - 1]
+        next_cursor = encode_cursor([rank, rowid])
+    return page, next_cursor
+
+
+def search_documents(query: str, queryset: QuerySet = None) -> QuerySet: # type: ignore
+    """
+    Documents matching query on topic and extracted text, best match first.
+    Postgres uses the weighted tsvector and trigram GIN indexes, SQLite the FTS5 table kept in sync by triggers.
+    """
+    queryset = Document.objects.all() if queryset is None else queryset
+    terms = search_terms(query)
+    if not terms:
+        return queryset.none()
+    if connection.vendor == "postgresql":
+        return _postgres_search(queryset, query, terms)
+    if connection.vendor == "sqlite":
+        return _sqlite_search(queryset, terms)
+    return queryset.filter(topic__icontains=query).annotate(rank=Value(0, output_field=IntegerField())).order_by("-uploaded_at")
+
+
+def search_page(query: str, queryset: QuerySet, cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+    """
+    One page of search_documents and the cursor of the next. On SQLite the page is cut inside the FTS query,
+    keyed on (rank, FTS rowid); elsewhere keyset_page walks (rank, uploaded_at, id).
+    queryset only chooses the columns and relations loaded for the page's rows.
+    Raises ValueError for a malformed cursor.
+    """
+    terms = search_terms(query)
+    if not terms:
+        # nothing to rank by, and search_documents' empty queryset has no rank to page on
+        return [], None
+    if connection.vendor == "sqlite":
+        return _sqlite_search_page(queryset, terms, cursor, limit)
+    return keyset_page(search_documents(query, queryset), ["rank", "uploaded_at", "id"], cursor, limit)
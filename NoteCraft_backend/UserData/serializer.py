@@ -10,9 +10,21 @@ User = get_user_model()
 class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
-        fields = ['id', 'topic', 'pdf_public_id', 'uploaded_by', 'uploaded_at']
+        fields = ['id', 'topic', 'pdf_public_id', 'preview_url', 'uploaded_by', 'uploaded_at']
         read_only_fields = ['uploaded_by', 'uploaded_at']
 
+class DocumentListSerializer(serializers.ModelSerializer):
+    pdf_url = serializers.CharField(source='pdf_public_id')
+    uploaded_by = serializers.CharField(source='uploaded_by.username')
+    created_at = serializers.DateTimeField(source='uploaded_at', format="%Y-%m-%d %H:%M:%S")
+
+    # columns the listing reads, for .only() together with select_related('uploaded_by')
+    db_fields = ['id', 'topic', 'pdf_public_id', 'preview_url', 'uploaded_at', 'uploaded_by__username']
+
+    class Meta:
+        model = Document
+        fields = ['id', 'topic', 'pdf_url', 'preview_url', 'uploaded_by', 'created_at']
+
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True, validators=[validate_password])
     confirm_password = serializers.CharField(write_only=True, required=True)  # Changed to snake_case
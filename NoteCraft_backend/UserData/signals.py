@@ -0,0 +1,10 @@
+from django.db import transaction
+from .indexing import user_namespace
+from .models import Document
+from .tasks import delete_document_vectors_task
+
+
+def remove_document_vectors(sender, instance: Document, **kwargs):
+    # covers view deletes, the admin and cascades from a deleted user alike
+    document_id, namespace = str(instance.pk), user_namespace(instance.uploaded_by_id) # type: ignore
+    transaction.on_commit(lambda: delete_document_vectors_task.delay(document_id, namespace)) # type: ignore
@@ -0,0 +1,104 @@
+import os
+import time
+import tempfile
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+from NoteMaker.http_client import get_session
+
+# uploaded files wait on disk for a worker; in docker-compose the web and worker containers mount
+# the same volume here, so only a path crosses the broker
+UPLOAD_STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR", os.path.join(tempfile.gettempdir(), "notecraft-uploads"))
+# staged files not picked up within this long (a lost task) are swept away
+UPLOAD_STAGING_TTL = int(os.getenv("UPLOAD_STAGING_TTL", "3600"))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(4 * UPLOAD_MAX_BYTES)))
+# also the Cloudinary upload_large part size, which must be at least 5MB
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+
+
+def staging_path(file_id: str) -> str:
+    return os.path.join(UPLOAD_STAGING_DIR, f"{file_id}.pdf")
+
+
+def sweep_staged(now: Optional[float] = None) -> int:
+    """
+    Delete staged files (and half-written parts) older than UPLOAD_STAGING_TTL. Returns how many went.
+    """
+    cutoff = (now or time.time()) - UPLOAD_STAGING_TTL
+    removed = 0
+    try:
+        entries = list(os.scandir(UPLOAD_STAGING_DIR))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def stage_file(file_id: str, chunks: Iterable[bytes]) -> int:
+    """
+    Write a file to the staging directory one chunk at a time, so it is never held whole in memory.
+    The file only appears under its final name once it is complete.
+    """
+    os.makedirs(UPLOAD_STAGING_DIR, exist_ok=True)
+    sweep_staged()
+    fd, tmp = tempfile.mkstemp(dir=UPLOAD_STAGING_DIR, prefix=f"{file_id}.", suffix=".part")
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp, staging_path(file_id))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return size
+
+
+def discard_staged(file_id: str) -> None:
+    try:
+        os.unlink(staging_path(file_id))
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def spooled(chunks: Iterable[bytes]) -> Iterator[str]:
+    """
+    Write chunks to a temporary .pdf and yield its path; PyMuPDF and upload_large both read from disk.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        yield path
+    finally:
+        os.unlink(path)
+
+
+@contextmanager
+def staged_pdf(file_id: str) -> Iterator[Optional[str]]:
+    # None once the staged upload has been discarded or swept
+    path = staging_path(file_id)
+    try:
+        # a file in use is not old, whatever time it was staged
+        os.utime(path)
+    except FileNotFoundError:
+        yield None
+        return
+    yield path
+
+
+@contextmanager
+def downloaded_pdf(url: str) -> Iterator[str]:
+    with get_session().get(url, stream=True) as response:
+        response.raise_for_status()
+        with spooled(response.iter_content(UPLOAD_CHUNK_BYTES)) as path:
+            yield path
@@ -0,0 +1,197 @@
+# tasks.py
+import os
+import json
+import uuid
+from contextlib import nullcontext
+from typing import Dict, List, Optional, Tuple
+import redis
+import cloudinary
+import cloudinary.uploader
+from celery import shared_task
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import UploadedFile
+from requests.exceptions import RequestException
+from pinecone.exceptions import PineconeException
+from dotenv import load_dotenv
+from NoteMaker.redis_cache import get_redis
+from NoteMaker.task_events import publish_task_event, task_snapshot
+from .indexing import index_document, delete_document_vectors, user_namespace
+from .models import Document
+from .serializer import DocumentSerializer
+from .previews import render_preview, upload_preview
+from .search import extract_text
+from .staging import stage_file, discard_staged, staged_pdf, downloaded_pdf, UPLOAD_CHUNK_BYTES
+load_dotenv()
+cloudinary.config(
+    cloud_name=os.getenv('CLOUDINARY_NAME'),
+    api_key=os.getenv('CLOUDINARY_API'),
+    api_secret =os.getenv('CLOUDINARY_KEY'),
+)
+
+config = cloudinary.config(secure=True)
+
+UPLOAD_RETRIES = 3
+INDEX_RETRIES = 3
+RETRYABLE = (RequestException, redis.RedisError, PineconeException, TimeoutError)
+
+
+def upload_job_key(job_id: str) -> str:
+    return f"notecraft:upload_job:{job_id}"
+
+
+def report_upload_progress(task, stage: str, name: str) -> None:
+    meta = {"stage": stage, "file": name}
+    task.update_state(state="PROGRESS", meta=meta)
+    publish_task_event(task.request.id, "PROGRESS", progress=meta)
+
+
+@shared_task(bind=True, max_retries=UPLOAD_RETRIES)
+def process_upload_task(self, file_id: str, name: str, user_id: int, content_hash: Optional[str] = None) -> dict:
+    """
+    Render the preview, push the PDF to Cloudinary and create the Document for one uploaded file.
+    """
+    with staged_pdf(file_id) as path:
+        if path is None:
+            return {"success": False, "file": name, "error": "Upload expired before it was processed"}
+        try:
+            report_upload_progress(self, "render", name)
+            preview = render_preview(path)
+            content = extract_text(path)
+        except Exception as e:
+            discard_staged(file_id)
+            return {"success": False, "file": name, "error": f"Could not read PDF: {e}"}
+        try:
+            report_upload_progress(self, "upload", name)
+            # sent in UPLOAD_CHUNK_BYTES parts straight from the spooled file
+            upload_result = cloudinary.uploader.upload_large(
+                path,
+                resource_type="raw",
+                folder="documents",
+                chunk_size=UPLOAD_CHUNK_BYTES
+            )
+            preview_url = upload_preview(preview)
+        except Exception as e:
+            if self.request.retries < UPLOAD_RETRIES:
+                raise self.retry(exc=e, countdown=2 ** self.request.retries)
+            discard_staged(file_id)
+            return {"success": False, "file": name, "error": str(e)}
+    document = Document.objects.create(
+        id=uuid.uuid4(),
+        topic=name,
+        pdf_public_id=upload_result['secure_url'],
+        uploaded_by=get_user_model().objects.get(pk=user_id),
+        preview_url=preview_url,
+        content=content,
+        content_hash=content_hash
+    )
+    # the staged bytes are handed on to the indexer, which deletes them when it is done
+    index_document_task.delay(str(document.id), file_id) # type: ignore
+    return {"success": True, "file": name, "document": DocumentSerializer(document).data}
+
+
+@shared_task(bind=True, max_retries=INDEX_RETRIES)
+def index_document_task(self, document_id: str, file_id: Optional[str] = None) -> dict:
+    """
+    Chunk, embed and upsert a document's text into its uploader's namespace so get_context can use it.
+    Reads the staged upload when there is one, otherwise downloads the PDF (e.g. to backfill old documents).
+    """
+    # the staged upload is dropped however the task ends, unless a retry still needs it
+    retrying = False
+    try:
+        document = Document.objects.filter(pk=document_id).only("id", "pdf_public_id", "uploaded_by_id").first()
+        if document is None:
+            return {"success": False, "error": "Document not found"}
+        namespace = user_namespace(document.uploaded_by_id) # type: ignore
+        with staged_pdf(file_id) if file_id else nullcontext() as path:
+            if path is not None:
+                chunks = index_document(document_id, namespace, path)
+            else:
+                with downloaded_pdf(document.pdf_public_id) as downloaded:
+                    chunks = index_document(document_id, namespace, downloaded)
+    except RETRYABLE as e:
+        if self.request.retries < INDEX_RETRIES:
+            retrying = True
+            raise self.retry(exc=e, countdown=2 ** self.request.retries)
+        return {"success": False, "error": str(e)}
+    finally:
+        if file_id and not retrying:
+            discard_staged(file_id)
+    return {"success": True, "document_id": document_id, "chunks": chunks}
+
+
+@shared_task(bind=True, max_retries=INDEX_RETRIES)
+def delete_document_vectors_task(self, document_id: str, namespace: str) -> dict:
+    try:
+        deleted = delete_document_vectors(document_id, namespace)
+    except RETRYABLE as e:
+        raise self.retry(exc=e, countdown=2 ** self.request.retries)
+    return {"success": True, "document_id": document_id, "deleted": deleted}
+
+
+def copy_document(original: Document, name: str, user_id: int) -> Document:
+    """
+    New Document for a file whose bytes are already stored: it shares the original's PDF and preview,
+    only the per-user vectors are rebuilt (mostly from the embedding cache).
+    """
+    document = Document.objects.create(
+        id=uuid.uuid4(),
+        topic=name,
+        pdf_public_id=original.pdf_public_id,
+        uploaded_by_id=user_id,
+        preview_url=original.preview_url,
+        content=original.content,
+        content_hash=original.content_hash
+    )
+    index_document_task.delay(str(document.id)) # type: ignore
+    return document
+
+
+def start_upload_job(files: List[Tuple[str, UploadedFile, str]], user_id: int) -> Dict:
+    """
+    Queue one task per file so a multi-file upload is processed in parallel. Files whose SHA-256 matches
+    a stored document are linked to its blob and preview right away; the rest are staged on disk.
+    The job id maps to the per-file task ids for upload_job_status.
+    """
+    job_id = str(uuid.uuid4())
+    originals = {
+        doc.content_hash: doc for doc in Document.objects.filter(content_hash__in=[digest for _, _, digest in files])
+                                                     .only("pdf_public_id", "preview_url", "content", "content_hash")
+    }
+    entries = []
+    staged = []
+    for name, file, digest in files:
+        if digest in originals:
+            document = copy_document(originals[digest], name, user_id)
+            entries.append({"file": name, "result": {
+                "success": True, "file": name, "deduplicated": True, "document": DocumentSerializer(document).data,
+            }})
+        else:
+            staged.append((name, file, digest, str(uuid.uuid4())))
+    for name, file, digest, file_id in staged:
+        file.seek(0)
+        stage_file(file_id, file.chunks(UPLOAD_CHUNK_BYTES))
+        task = process_upload_task.delay(file_id, name, user_id, digest) # type: ignore
+        entries.append({"file": name, "task_id": task.id})
+    job = {"job_id": job_id, "user_id": user_id, "files": entries}
+    get_redis().set(upload_job_key(job_id), json.dumps(job), ex=int(settings.CELERY_RESULT_EXPIRES.total_seconds()))
+    return job
+
+
+def get_upload_job(job_id: str) -> Optional[Dict]:
+    try:
+        job = get_redis().get(upload_job_key(job_id))
+    except redis.RedisError:
+        return None
+    return json.loads(job) if job else None # type: ignore
+
+
+def upload_job_status(job: Dict) -> List[Dict]:
+    statuses = []
+    for entry in job["files"]:
+        if "task_id" in entry:
+            statuses.append({"file": entry["file"], **task_snapshot(entry["task_id"])})
+        else:
+            statuses.append({"file": entry["file"], "task_id": None, "state": "SUCCESS", "progress": None,
+                             "result": entry["result"]})
+    return statuses
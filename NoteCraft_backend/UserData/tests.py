@@ -1,3 +1,390 @@
-from django.test import TestCase
+import io
+import os
+import time
+import uuid
+import tempfile
+import base64
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest.mock import patch
+from PIL import Image
+from django.core.management import call_command
+from django.db import connection
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase
+from rest_framework.test import APIClient
+from NoteMaker.tests import FakeRedisMixin
+from . import staging, tasks, views
+from .previews import encode_preview, PREVIEW_WIDTH
+from .search import search_documents
+from .pagination import encode_cursor, decode_cursor, keyset_page, page_size
+from .models import Document, User
+from .staging import staged_pdf
 
-# Create your tests here.
+
+class StagingDirMixin(FakeRedisMixin):
+    """
+    Stages uploads in a temporary directory, with job bookkeeping in fakeredis.
+    """
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = patch.object(staging, "UPLOAD_STAGING_DIR", tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+def pdf_upload(name: str, data: bytes = b"%PDF-1.4 test") -> SimpleUploadedFile:
+    return SimpleUploadedFile(name, data, content_type="application/pdf")
+
+
+class DocumentUploadTests(StagingDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("ada", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        patcher = patch.object(tasks.process_upload_task, "delay",
+                               side_effect=lambda *args: type("Result", (), {"id": f"task-{args[1]}"})())
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_every_file_is_queued(self):
+        # the form field name is the document's topic; several files may share one
+        response = self.client.post("/add_pdf/", {"Biology": [pdf_upload("a.pdf", b"aaa"), pdf_upload("b.pdf", b"bbb")],
+                                                  "Physics": pdf_upload("c.pdf", b"ccc")}, format="multipart")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([f["task_id"] for f in response.data["files"]], ["task-Biology", "task-Biology", "task-Physics"])
+        for call, data in zip(self.delay.call_args_list, (b"aaa", b"bbb", b"ccc")):
+            file_id, name, user_id, digest = call.args
+            self.assertEqual(user_id, self.user.pk)
+            with staged_pdf(file_id) as path:
+                with open(path, "rb") as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_job_is_only_visible_to_its_owner(self):
+        job_id = self.client.post("/add_pdf/", {"file": pdf_upload("a.pdf")}, format="multipart").data["job_id"]
+        with patch.object(tasks, "task_snapshot", return_value={"task_id": "task-file", "state": "PENDING",
+                                                                "progress": None, "result": None}):
+            response = self.client.get(f"/upload_status/{job_id}/")
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.data["done"])
+            other = APIClient()
+            other.force_authenticate(User.objects.create_user("bob", password="pw"))
+            self.assertEqual(other.get(f"/upload_status/{job_id}/").status_code, 404)
+
+    def test_rejected_requests(self):
+        self.assertEqual(self.client.post("/add_pdf/", {}, format="multipart").status_code, 400)
+        with patch.object(views, "UPLOAD_MAX_BYTES", 2):
+            response = self.client.post("/add_pdf/", {"file": pdf_upload("a.pdf")}, format="multipart")
+        self.assertEqual(response.status_code, 413)
+        with patch.object(views, "UPLOAD_MAX_REQUEST_BYTES", 10):
+            response = self.client.post("/add_pdf/", {"file": pdf_upload("a.pdf")}, format="multipart")
+        self.assertEqual(response.status_code, 413)
+        self.delay.assert_not_called()
+        self.assertEqual(APIClient().post("/add_pdf/", {"file": pdf_upload("a.pdf")}, format="multipart").status_code, 401)
+
+
+class ProcessUploadTaskTests(StagingDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("ada", password="pw")
+        tasks.stage_file("f1", [b"%PDF", b"-1.4"])
+        for name, value in (("render_preview", b"webp"), ("extract_text", "page text"),
+                            ("upload_preview", "https://cdn/preview.webp")):
+            patcher = patch.object(tasks, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(tasks.index_document_task, "delay")
+        self.index_delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_creates_the_document_and_hands_staging_to_the_indexer(self):
+        with patch.object(tasks.cloudinary.uploader, "upload_large", return_value={"secure_url": "https://cdn/a.pdf"}):
+            result = tasks.process_upload_task.apply(args=("f1", "a.pdf", self.user.pk, "abc")).get()
+        self.assertTrue(result["success"])
+        document = Document.objects.get()
+        self.assertEqual((document.pdf_public_id, document.preview_url, document.content),
+                         ("https://cdn/a.pdf", "https://cdn/preview.webp", "page text"))
+        self.index_delay.assert_called_once_with(str(document.id), "f1")
+
+    def test_unreadable_pdf_fails_without_retrying(self):
+        with patch.object(tasks, "render_preview", side_effect=RuntimeError("broken")):
+            result = tasks.process_upload_task.apply(args=("f1", "a.pdf", self.user.pk)).get()
+        self.assertFalse(result["success"])
+        with staged_pdf("f1") as path:
+            self.assertIsNone(path)
+
+    def test_expired_staging(self):
+        result = tasks.process_upload_task.apply(args=("gone", "a.pdf", self.user.pk)).get()
+        self.assertEqual(result["error"], "Upload expired before it was processed")
+
+
+class PreviewTests(TestCase):
+    def png(self, size) -> bytes:
+        out = io.BytesIO()
+        Image.new("RGB", size, "white").save(out, "PNG")
+        return out.getvalue()
+
+    def test_encode_preview_shrinks_to_webp(self):
+        with Image.open(io.BytesIO(encode_preview(Image.new("P", (1600, 2000))))) as img:
+            self.assertEqual((img.format, img.size), ("WEBP", (PREVIEW_WIDTH, 400)))
+        with Image.open(io.BytesIO(encode_preview(Image.new("RGB", (100, 50))))) as img:
+            self.assertEqual(img.size, (100, 50))
+
+    def test_backfill_moves_inline_previews(self):
+        user = User.objects.create_user("ada", password="pw")
+        legacy = Document.objects.create(topic="old", pdf_public_id="x", uploaded_by=user,
+                                         first_page=base64.b64encode(self.png((800, 1000))).decode())
+        fresh = Document.objects.create(topic="new", pdf_public_id="y", uploaded_by=user, preview_url="https://cdn/new")
+        with patch("UserData.management.commands.backfill_previews.upload_preview", return_value="https://cdn/old") as upload:
+            call_command("backfill_previews", stdout=io.StringIO())
+        upload.assert_called_once()
+        legacy.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((legacy.preview_url, fresh.preview_url), ("https://cdn/old", "https://cdn/new"))
+        self.assertEqual((legacy.first_page, fresh.first_page), ("", ""))
+
+    def test_backfill_with_nothing_pending(self):
+        out = io.StringIO()
+        call_command("backfill_previews", stdout=out)
+        self.assertIn("Moved 0 previews, 0 failed", out.getvalue())
+
+
+class DocumentSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("ada", password="pw")
+
+    def add(self, topic, content=""):
+        return Document.objects.create(topic=topic, content=content, pdf_public_id="x", uploaded_by=self.user)
+
+    def topics(self, query):
+        return [d.topic for d in search_documents(query)]
+
+    def test_topic_outranks_content_and_prefixes_match(self):
+        self.add("Cooking", "neural networks in the kitchen")
+        self.add("Neural networks", "an introduction")
+        self.add("Botany", "photosynthesis")
+        self.assertEqual(self.topics("neural"), ["Neural networks", "Cooking"])
+        self.assertEqual(self.topics("neur netw"), ["Neural networks", "Cooking"])
+        self.assertEqual(self.topics("!!"), [])
+
+    def test_index_follows_updates_and_deletes(self):
+        doc = self.add("Genetics", "mendel")
+        doc.topic = "Heredity"
+        doc.save()
+        self.assertEqual(self.topics("genetics"), [])
+        self.assertEqual(self.topics("heredity"), ["Heredity"])
+        doc.delete()
+        self.assertEqual(self.topics("mendel"), [])
+        self.add("Genetics again", "mendel")
+        self.assertEqual(self.topics("mendel"), ["Genetics again"])
+
+
+class DocumentSearchRemakeTests(TransactionTestCase):
+    def test_index_survives_a_table_remake(self):
+        from django.db import models
+        from .migrations._sqlite_fts import create_triggers
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite FTS5 only")
+        user = User.objects.create_user("ada", password="pw")
+        Document.objects.create(topic="Optics", content="lenses", pdf_public_id="x", uploaded_by=user)
+        old_field = Document._meta.get_field("topic")
+        new_field = models.CharField(max_length=300)
+        new_field.set_attributes_from_name("topic")
+        # what a later AlterField on SQLite does: copy into a new table, drop the old one with its triggers
+        with connection.schema_editor() as editor:
+            editor.alter_field(Document, old_field, new_field)
+            create_triggers(editor)
+        self.addCleanup(lambda: self.restore(new_field, old_field))
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM")
+        Document.objects.create(topic="Acoustics", content="lenses too", pdf_public_id="y", uploaded_by=user)
+        self.assertEqual([d.topic for d in search_documents("lenses")], ["Optics", "Acoustics"])
+
+    def restore(self, field, original):
+        from .migrations._sqlite_fts import create_triggers
+        with connection.schema_editor() as editor:
+            editor.alter_field(Document, field, original)
+            create_triggers(editor)
+
+
+class PaginationTests(TestCase):
+    def test_cursor_round_trip(self):
+        pk = uuid.uuid4()
+        when = datetime(2026, 10, 18, 12, 0, tzinfo=timezone.utc)
+        cursor = encode_cursor([Decimal("0.125000"), when, pk])
+        self.assertNotIn("=", cursor)
+        self.assertEqual(decode_cursor(cursor, 3), ["0.125000", when.isoformat(), str(pk)])
+
+    def test_bad_cursors(self):
+        for cursor in ("!!!", encode_cursor([1]), encode_cursor([1, 2, 3]), "eyJhIjogMX0"):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor, 2)
+
+    def test_page_size(self):
+        self.assertEqual((page_size(None), page_size("0"), page_size("5"), page_size("1000")), (20, 1, 5, 100))
+        with self.assertRaises(ValueError):
+            page_size("ten")
+
+    def test_keyset_pages_cover_every_row_once(self):
+        user = User.objects.create_user("ada", password="pw")
+        for i in range(7):
+            Document.objects.create(topic=f"doc {i}", pdf_public_id="x", uploaded_by=user)
+        # equal timestamps fall back to the id
+        Document.objects.filter(topic__in=["doc 2", "doc 3", "doc 4"]).update(uploaded_at=datetime(2026, 1, 1, tzinfo=timezone.utc))
+        expected = list(Document.objects.order_by("-uploaded_at", "-id").values_list("topic", flat=True))
+        seen, cursor = [], None
+        while True:
+            page, cursor = keyset_page(Document.objects.all(), ["uploaded_at", "id"], cursor, 3)
+            seen += [d.topic for d in page]
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+
+
+class ListDocumentViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("ada", password="pw")
+
+    def test_topic_is_required(self):
+        self.assertEqual(self.client.get("/search_pdfs/").status_code, 400)
+        self.assertEqual(self.client.get("/search_pdfs/", {"topic": "x", "limit": "ten"}).status_code, 400)
+        self.assertEqual(self.client.get("/search_pdfs/", {"topic": "x", "cursor": "bad"}).status_code, 400)
+
+    def test_no_match_is_204(self):
+        self.assertEqual(self.client.get("/search_pdfs/", {"topic": "nothing"}).status_code, 204)
+        self.assertEqual(self.client.get("/search_pdfs/", {"topic": "!!!"}).status_code, 204)
+
+    def test_pages_run_past_the_old_200_cap(self):
+        Document.objects.bulk_create([
+            Document(topic=f"Biology {i}", content="cells " * (i % 5 + 1), pdf_public_id="x", uploaded_by=self.user)
+            for i in range(230)
+        ])
+        seen, cursor = [], None
+        while True:
+            params = {"topic": "biology", "limit": "100", **({"cursor": cursor} if cursor else {})}
+            response = self.client.get("/search_pdfs/", params)
+            self.assertEqual(response.status_code, 200)
+            seen += [d["id"] for d in response.json()["result"]]
+            cursor = response.json()["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 230)
+        self.assertEqual(len(set(seen)), 230)
+        self.assertEqual(response.json()["result"][0]["uploaded_by"], "ada")
+
+
+class DocumentIndexingTests(StagingDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("ada", password="pw")
+        self.document = Document.objects.create(topic="t", pdf_public_id="x", uploaded_by=self.user)
+        tasks.stage_file("f1", [b"%PDF-1.4"])
+
+    def staged(self) -> bool:
+        with staged_pdf("f1") as path:
+            return path is not None
+
+    def run_index(self, error):
+        with patch.object(tasks, "index_document", side_effect=error):
+            return tasks.index_document_task.apply(args=(str(self.document.id), "f1"))
+
+    def test_success_discards_the_staged_upload(self):
+        result = self.run_index(lambda doc_id, namespace, path: 3).get()
+        self.assertEqual(result["chunks"], 3)
+        self.assertFalse(self.staged())
+
+    def test_unexpected_errors_still_discard_the_staged_upload(self):
+        result = self.run_index(RuntimeError("cannot open broken document"))
+        self.assertTrue(result.failed())
+        self.assertFalse(self.staged())
+
+    def test_retry_keeps_the_staged_upload(self):
+        import requests
+        with patch.object(tasks.index_document_task, "retry", side_effect=RuntimeError("retry")) as retry:
+            self.run_index(requests.ConnectionError("down"))
+        retry.assert_called_once()
+        self.assertTrue(self.staged())
+
+    def test_deleting_a_document_queues_vector_removal(self):
+        user_id = self.user.pk
+        with patch.object(tasks.delete_document_vectors_task, "delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.delete()
+        delay.assert_called_once_with(str(self.document.id), f"user-{user_id}")
+
+
+class DeduplicationTests(StagingDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("ada", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for target in (tasks.process_upload_task, tasks.index_document_task):
+            patcher = patch.object(target, "delay", return_value=SimpleNamespace(id="task"))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_hash_file_streams_the_whole_file(self):
+        import hashlib
+        data = b"x" * 100 + b"y" * 50
+        with patch.object(views, "UPLOAD_CHUNK_BYTES", 16):
+            self.assertEqual(views.hash_file(pdf_upload("a.pdf", data)), hashlib.sha256(data).hexdigest())
+
+    def test_known_bytes_reuse_the_stored_blob(self):
+        import hashlib
+        original = Document.objects.create(topic="Biology", pdf_public_id="https://cdn/a.pdf", uploaded_by=self.user,
+                                           preview_url="https://cdn/a.webp", content="cells",
+                                           content_hash=hashlib.sha256(b"same bytes").hexdigest())
+        response = self.client.post("/add_pdf/", {"Cells": pdf_upload("a.pdf", b"same bytes"),
+                                                  "Other": pdf_upload("b.pdf", b"new bytes")}, format="multipart")
+        self.assertEqual(response.status_code, 202, response.data)
+        deduplicated, queued = response.data["files"]
+        self.assertTrue(deduplicated["result"]["deduplicated"])
+        self.assertIn("task_id", queued)
+        tasks.process_upload_task.delay.assert_called_once()
+        copy = Document.objects.get(topic="Cells")
+        self.assertNotEqual(copy.pk, original.pk)
+        self.assertEqual((copy.pdf_public_id, copy.preview_url, copy.content, copy.content_hash),
+                         (original.pdf_public_id, original.preview_url, original.content, original.content_hash))
+        tasks.index_document_task.delay.assert_called_once_with(str(copy.pk))
+
+
+class StagingTests(StagingDirMixin, TestCase):
+    def test_stage_and_discard(self):
+        self.assertEqual(staging.stage_file("f1", [b"ab", b"cd"]), 4)
+        with staging.staged_pdf("f1") as path:
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"abcd")
+        self.assertEqual(os.listdir(staging.UPLOAD_STAGING_DIR), ["f1.pdf"])
+        staging.discard_staged("f1")
+        staging.discard_staged("f1")
+        with staging.staged_pdf("f1") as path:
+            self.assertIsNone(path)
+
+    def test_failed_write_leaves_nothing_behind(self):
+        def chunks():
+            yield b"ab"
+            raise OSError("client went away")
+        with self.assertRaises(OSError):
+            staging.stage_file("f1", chunks())
+        self.assertEqual(os.listdir(staging.UPLOAD_STAGING_DIR), [])
+
+    def test_sweep_removes_only_old_files(self):
+        staging.stage_file("old", [b"x"])
+        staging.stage_file("new", [b"y"])
+        old = time.time() - staging.UPLOAD_STAGING_TTL - 10
+        os.utime(staging.staging_path("old"), (old, old))
+        self.assertEqual(staging.sweep_staged(), 1)
+        self.assertEqual(os.listdir(staging.UPLOAD_STAGING_DIR), ["new.pdf"])
+
+    def test_reading_a_staged_file_keeps_it_from_the_sweep(self):
+        staging.stage_file("f1", [b"x"])
+        old = time.time() - staging.UPLOAD_STAGING_TTL - 10
+        os.utime(staging.staging_path("f1"), (old, old))
+        with staging.staged_pdf("f1"):
+            self.assertEqual(staging.sweep_staged(), 0)
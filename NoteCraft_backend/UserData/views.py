@@ -4,73 +4,89 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.parsers import MultiPartParser
 from rest_framework import status,permissions
 from .models import Document
-from .serializer import DocumentSerializer,UserSerializer
-import cloudinary.uploader
+from .serializer import DocumentSerializer,DocumentListSerializer,UserSerializer
 from django.core.cache import cache
 from rest_framework.request import Request
-import uuid
 from dotenv import load_dotenv
-import base64
 import requests
 from cloudinary.utils import cloudinary_url
 import os
+import hashlib
 from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import TokenError,AuthenticationFailed
-import fitz
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadedfile import UploadedFile
+from celery import states
+from .search import search_page
+from .pagination import page_size
+from .staging import UPLOAD_MAX_BYTES, UPLOAD_MAX_REQUEST_BYTES, UPLOAD_CHUNK_BYTES
+from .tasks import start_upload_job, get_upload_job, upload_job_status
 load_dotenv()
-cloudinary.config(
-    cloud_name=os.getenv('CLOUDINARY_NAME'),
-    api_key=os.getenv('CLOUDINARY_API'),
-    api_secret =os.getenv('CLOUDINARY_KEY'),
-)
 
-config = cloudinary.config(secure=True)
 
+def hash_file(file:UploadedFile)->str:
+    # hashed chunk by chunk, the digest is the dedup key for stored PDFs
+    digest = hashlib.sha256()
+    for chunk in file.chunks(UPLOAD_CHUNK_BYTES):
+        digest.update(chunk)
+    return digest.hexdigest()
 
-def get_first_page_as_base64(pdf:InMemoryUploadedFile)->str:
-    doc=fitz.open(stream=pdf.read(),filetype="pdf")
-    page=doc[0]
-    pix=page.get_pixmap().tobytes("png") # type: ignore
-    return base64.b64encode(pix).decode("utf-8")
 
 class DocumentUploadView(APIView):
     parser_classes = [MultiPartParser]
     permission_classes = [IsAuthenticated]
 
     def post(self, request:Request)->Response:
+        """
+        Accept every file in the request and hand them to Celery; rendering and the Cloudinary upload
+        happen in the workers. Poll upload_status/<job_id>/ for per-file results.
+        Files above FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to disk by Django and never read whole.
+        """
+        # checked before request.FILES, which is what reads and spools the body
+        if int(request.META.get("CONTENT_LENGTH") or 0) > UPLOAD_MAX_REQUEST_BYTES:
+            return Response({"error": "Upload too large"}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
         if not request.FILES:
             return Response({"error":"No files found"},status=status.HTTP_400_BAD_REQUEST)
+        files: list = []
         name:str
-        file:InMemoryUploadedFile
-        for name, file in request.FILES.items(): # type: ignore
-            print(name,file)
-            img=get_first_page_as_base64(file)
-            try:
-                file.seek(0)
-                upload_result = cloudinary.uploader.upload(
-                    file=file.read(),
-                    resource_type="raw",  
-                    folder="documents"   
-                )
-                document = Document.objects.create(
-                    id=uuid.uuid4(),
-                    topic=name,
-                    pdf_public_id=upload_result['secure_url'],  
-                    uploaded_by=request.user,
-                    first_page=img
-                )
-                serializer= DocumentSerializer(document)
-                return Response(serializer.data,status=status.HTTP_201_CREATED)
-            except Exception as e:
-                return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-
-
-        return Response({"message":"File uploaded successfully"},status=status.HTTP_200_OK)
+        file:UploadedFile
+        # lists() keeps every file sent under the same field name
+        for name, uploads in request.FILES.lists(): # type: ignore
+            for file in uploads:
+                if file.size > UPLOAD_MAX_BYTES:
+                    return Response({"error": f"{file.name} is larger than {UPLOAD_MAX_BYTES // (1024 * 1024)}MB"},
+                                    status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+                files.append((name, file, hash_file(file)))
+        try:
+            job = start_upload_job(files, request.user.pk)
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({"job_id": job["job_id"], "files": job["files"]}, status=status.HTTP_202_ACCEPTED)
+
+
+class DocumentDeleteView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def delete(self, request:Request, document_id)->Response:
+        # the post_delete hook in signals.py queues removal of the document's vectors
+        deleted, _ = Document.objects.filter(pk=document_id, uploaded_by=request.user).delete()
+        if not deleted:
+            return Response({"error": "Document not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request:Request, job_id:str)->Response:
+        job = get_upload_job(job_id)
+        if job is None or job["user_id"] != request.user.pk:
+            return Response({"error": "Upload job not found"}, status=status.HTTP_404_NOT_FOUND)
+        files = upload_job_status(job)
+        done = all(f["state"] in states.READY_STATES for f in files)
+        return Response({"job_id": job_id, "done": done, "files": files}, status=status.HTTP_200_OK)
 
 class SignupView(APIView):
     def post(self, request:Request)->Response:
@@ -86,28 +102,28 @@ class LoginView(TokenObtainPairView):
 
 class ListDocumentView(APIView):
     def get(self, request:Request)->Response:
-
+        """
+        Documents matching topic, best match first. Pass the returned next_cursor back as cursor for the following page.
+        """
         query:str = request.query_params.get("topic","")
         if not query:
             return Response({"error": "Topic is required"},status=status.HTTP_400_BAD_REQUEST)
-        
-        documents = Document.objects.filter(topic__icontains=query)
-        if not documents:
+        cursor = request.query_params.get("cursor")
+        try:
+            limit = page_size(request.query_params.get("limit"))
+        except ValueError:
+            return Response({"error": "limit must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+
+        documents = Document.objects.select_related("uploaded_by").only(*DocumentListSerializer.db_fields)
+        try:
+            page, next_cursor = search_page(query, documents, cursor, limit)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not page and not cursor:
             return Response({"error":"No Pdfs Found"},status=status.HTTP_204_NO_CONTENT)
-        results :list = []
-        for doc in documents:
-            # first_page_base64: str|None = get_first_page_as_base64(doc.pdf_public_id)
-
-            results.append({
-                "id": str(doc.id),
-                "topic": doc.topic,
-                "pdf_url": doc.pdf_public_id,
-                "first_page_base64": doc.first_page,
-                "uploaded_by": doc.uploaded_by.username,
-                "created_at": doc.uploaded_at.strftime("%Y-%m-%d %H:%M:%S"),
-            })
-        
-        return Response({"result":results},status=status.HTTP_200_OK)
+
+        results = DocumentListSerializer(page, many=True).data
+        return Response({"result":results, "next_cursor": next_cursor},status=status.HTTP_200_OK)
 
 class LogoutView(APIView):
     permission_classes = (permissions.IsAuthenticated,)
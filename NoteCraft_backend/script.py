@@ -2,18 +2,37 @@ from dotenv import load_dotenv
 import os
 import pinecone
 from typing import List, Dict
-from pinecone import Pinecone
 import uuid
 from llama_index.readers.papers import ArxivReader
 from llama_index.readers.papers import PubmedReader
+from NoteMaker.embeddings import embed_texts, EMBED_MAX_BATCH
+from NoteMaker.retrievers import LocalIndexWriter, LOCAL_INDEX_DIR
+from NoteMaker.chunking import chunk_document, CHUNK_TOKENS, CHUNK_OVERLAP
+from NoteMaker.pinecone_client import get_pinecone
+import argparse
+import numpy as np
+import time
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 
 arxiv_reader = ArxivReader()
 pubmed_reader = PubmedReader()
 load_dotenv()
 
-key=os.getenv("PINECONE_API_KEY")
-pc=Pinecone(api=key)
-index = pc.Index("notecraft")
+FETCH_WORKERS = int(os.getenv("INGEST_FETCH_WORKERS", "4"))
+UPSERT_WORKERS = int(os.getenv("INGEST_UPSERT_WORKERS", "4"))
+UPSERT_BATCH = 100  # Pinecone upsert limit
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "256"))
+# get_context reads metadata["text"], so every vector carries its chunk
+METADATA_FIELDS = ("source", "namespace", "doc_id", "chunk_index", "start", "end", "text")
+
+@lru_cache(maxsize=None)
+def get_index() -> pinecone.Index:
+    # opened on first upsert, so --local runs and imports need no Pinecone key
+    return get_pinecone().Index("notecraft")
 
 
 # index.delete(delete_all=True,namespace="ns2")
@@ -258,30 +277,34 @@ def fetch_documents(topic: str, namespace: str) -> List[Dict]:
         # PubMed and Wikipedia return dictionaries with a `text` key
         return [{"text": doc["text"], "source": source, "namespace": namespace} for doc in docs]
 
-def upsert_documents(documents: List[Dict], index: pinecone.Index):
-    batch = []
+def split_documents(documents: List[Dict], chunk_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP) -> List[Dict]:
+    """
+    Token-window chunks of every document, tagged with the id of the document they came from.
+    """
+    chunks = []
     for doc in documents:
-        vector = pc.inference.embed(
-            model="llama-text-embed-v2",
-            inputs=doc["text"],
-            parameters={
-                "input_type": "passage"
-            }
-
-        )[0].values
-        batch.append({
-            "id": generate_doc_id(),
-            "values": vector,
-            "metadata": {"source": doc["source"], "namespace": doc["namespace"]}
-        })
+        chunks.extend(chunk_document({**doc, "doc_id": generate_doc_id()}, chunk_tokens, overlap))
+    return chunks
+
+def build_records(chunks: List[Dict], vectors: List) -> List[Dict]:
+    return [{
+            "id": f"{chunk['doc_id']}#{chunk['chunk_index']}",
+            "values": vector.tolist(),
+            "metadata": {field: chunk[field] for field in METADATA_FIELDS}
+        } for chunk, vector in zip(chunks, vectors)]
+
+def upsert_documents(documents: List[Dict], index: pinecone.Index):
+    chunks = split_documents(documents)
+    vectors = embed_texts([chunk["text"] for chunk in chunks], input_type="passage")
+    batch = build_records(chunks, vectors)
     
     # Upsert in batches (Pinecone supports up to 100 vectors per upsert)
-    for i in range(0, len(batch), 100):
-        index.upsert(vectors=batch[i:i+100], namespace=doc["namespace"])
+    for i in range(0, len(batch), UPSERT_BATCH):
+        index.upsert(vectors=batch[i:i+UPSERT_BATCH], namespace=documents[0]["namespace"])
 
 import wikipedia
-import requests
 from typing import List, Dict
+from NoteMaker.http_client import get_session
 
 def fetch_pubmed_docs(search_query: str, max_results: int = 10) -> List[Dict]:
     """
@@ -299,7 +322,7 @@ def fetch_pubmed_docs(search_query: str, max_results: int = 10) -> List[Dict]:
             "retmax": max_results,
             "retmode": "json"
         }
-        search_response = requests.get(search_url, params=search_params)
+        search_response = get_session().get(search_url, params=search_params)
         search_response.raise_for_status()
         search_data = search_response.json()
 
@@ -317,7 +340,7 @@ def fetch_pubmed_docs(search_query: str, max_results: int = 10) -> List[Dict]:
             "retmode": "xml",
             "rettype": "abstract"  # Fetch only the abstract/metadata
         }
-        fetch_response = requests.get(fetch_url, params=fetch_params)
+        fetch_response = get_session().get(fetch_url, params=fetch_params)
         fetch_response.raise_for_status()
         fetch_data = fetch_response.text
 
@@ -356,21 +379,151 @@ def fetch_history_docs(topic: str) -> List[Dict]:
         return []
 
 
-def main():
-    # Iterate through namespaces and topics
-    for namespace, topics in namespaces.items():
-        for topic in topics:
-            print(f"Fetching documents for topic: {topic} (namespace: {namespace})")
-            
-            # Fetch documents based on the namespace
-            documents = fetch_documents(topic, namespace)
+class Progress:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.docs = 0
+        self.vectors = 0
+
+    def add(self, docs: int = 0, vectors: int = 0):
+        with self.lock:
+            self.docs += docs
+            self.vectors += vectors
+
+    def report(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f"{self.docs} docs, {self.vectors} vectors in {elapsed:.1f}s "
+                f"({self.docs / elapsed:.2f} docs/s, {self.vectors / elapsed:.2f} vectors/s)")
+
+
+def fetch_stage(out_q: queue.Queue, progress: Progress, chunk_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP):
+    """
+    Fetch every (namespace, topic) concurrently and feed the documents' chunks downstream.
+    """
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = {
+            executor.submit(fetch_documents, topic, namespace): (namespace, topic)
+            for namespace, topics in namespaces.items() for topic in topics
+        }
+        for future in as_completed(futures):
+            namespace, topic = futures[future]
+            try:
+                documents = future.result()
+            except Exception as e:
+                print(f"Error fetching documents for topic: {topic}: {e}")
+                continue
             if not documents:
                 print(f"No documents found for topic: {topic}")
                 continue
-            upsert_documents(documents, index)
-            print(f"Upserted {len(documents)} documents for topic: {topic}")
+            chunks = split_documents(documents, chunk_tokens, overlap)
+            for chunk in chunks:
+                out_q.put(chunk)  # blocks when embedding falls behind
+            progress.add(docs=len(documents))
+            print(f"Fetched {len(documents)} documents ({len(chunks)} chunks) for topic: {topic} (namespace: {namespace})")
+    out_q.put(None)
+
+
+def embed_stage(in_q: queue.Queue, out_q: queue.Queue):
+    """
+    Group chunks into multi-input embed calls of up to EMBED_MAX_BATCH.
+    A partial batch is sent as soon as the fetch queue runs dry so the pipeline never stalls.
+    """
+    batch: List[Dict] = []
 
-    print("All documents have been processed and upserted into Pinecone.")
+    def flush():
+        if batch:
+            try:
+                vectors = embed_texts([chunk["text"] for chunk in batch], input_type="passage")
+                out_q.put(build_records(batch, vectors))
+            except Exception as e:
+                print(f"Error embedding {len(batch)} chunks: {e}")
+            batch.clear()
+
+    while True:
+        chunk = in_q.get()
+        if chunk is None:
+            break
+        batch.append(chunk)
+        if len(batch) >= EMBED_MAX_BATCH or in_q.empty():
+            flush()
+    flush()
+    out_q.put(None)
+
+
+def pinecone_sink(namespace: str, records: List[Dict]):
+    get_index().upsert(vectors=records, namespace=namespace)
+
+def local_sink(writer: LocalIndexWriter):
+    def sink(namespace: str, records: List[Dict]):
+        writer.add(namespace, np.array([r["values"] for r in records], dtype=np.float32),
+                   [r["metadata"] for r in records], ids=[r["id"] for r in records])
+    return sink
+
+def upsert_stage(in_q: queue.Queue, progress: Progress, sink=pinecone_sink):
+    """
+    Buffer records per namespace and upsert full batches on a pool of workers.
+    """
+    pending: Dict[str, List[Dict]] = defaultdict(list)
+    slots = threading.BoundedSemaphore(UPSERT_WORKERS * 2)
+
+    def upsert(namespace: str, records: List[Dict]):
+        try:
+            sink(namespace, records)
+            progress.add(vectors=len(records))
+        except Exception as e:
+            print(f"Error upserting {len(records)} vectors into {namespace}: {e}")
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as executor:
+        def submit(namespace: str, records: List[Dict]):
+            slots.acquire()  # bound in-flight batches so memory stays flat
+            executor.submit(upsert, namespace, records)
+
+        while True:
+            records = in_q.get()
+            if records is None:
+                break
+            for record in records:
+                namespace = record["metadata"]["namespace"]
+                pending[namespace].append(record)
+                if len(pending[namespace]) >= UPSERT_BATCH:
+                    submit(namespace, pending.pop(namespace))
+        for namespace, records in pending.items():
+            submit(namespace, records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed the retrieval index")
+    parser.add_argument("--local", nargs="?", const=LOCAL_INDEX_DIR, default=None, metavar="DIR",
+                        help="build the local memory-mapped index in DIR instead of upserting to Pinecone")
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKENS, help="tokens per chunk")
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP, help="tokens shared by consecutive chunks")
+    args = parser.parse_args()
+    writer = LocalIndexWriter(args.local) if args.local else None
+    sink = local_sink(writer) if writer else pinecone_sink
+
+    progress = Progress()
+    docs_q: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+    records_q: queue.Queue = queue.Queue(maxsize=max(QUEUE_SIZE // EMBED_MAX_BATCH, 2))
+
+    stages = [
+        threading.Thread(target=fetch_stage, args=(docs_q, progress, args.chunk_tokens, args.chunk_overlap), name="fetch"),
+        threading.Thread(target=embed_stage, args=(docs_q, records_q), name="embed"),
+        threading.Thread(target=upsert_stage, args=(records_q, progress, sink), name="upsert"),
+    ]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+
+    if writer:
+        writer.close()
+        print(f"All documents have been processed and written to the local index in {args.local}.")
+    else:
+        print("All documents have been processed and upserted into Pinecone.")
+    print(progress.report())
 
 # Run the driver code
 if __name__ == "__main__":
@@ -11,30 +11,36 @@ interface Document {
   topic: string;
   uploaded_by: string;
   created_at: string;
-  first_page_base64?: string;
+  preview_url?: string;
   pdf_url: string;
 }
 
 const DocumentsPage = () => {
   const [documents, setDocuments] = useState<Document[]>([]);
   const [loading, setLoading] = useState(false);
+  const [lastQuery, setLastQuery] = useState("");
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
 
-  const fetchDocuments = async (query: string) => {
+  const fetchDocuments = async (query: string, cursor: string | null = null) => {
     if (!query.trim()) return;
     
     setLoading(true);
 
     try {
+      const params = new URLSearchParams({ topic: query });
+      if (cursor) params.set("cursor", cursor);
       const response = await axios.get(
-        `https://notecraft-backend-ag98.onrender.com/search_pdfs/?topic=${query}`
+        `https://notecraft-backend-ag98.onrender.com/search_pdfs/?${params.toString()}`
       );
       
       if (response.status === 204) {
         toast.error("No PDFs found.")
         setDocuments([]);
+        setNextCursor(null);
       } else {
-        console.log(response.data.result);
-        setDocuments(response.data.result);
+        setDocuments(cursor ? [...documents, ...response.data.result] : response.data.result);
+        setNextCursor(response.data.next_cursor);
+        setLastQuery(query);
       }
     } catch (err) {
       console.error("Error fetching documents:", err);
@@ -71,10 +77,11 @@ const DocumentsPage = () => {
             rel="noopener noreferrer"
             className="bg-white rounded-lg shadow-md p-4 hover:shadow-lg transition duration-300"
           >
-            {doc.first_page_base64 ? (
+            {doc.preview_url ? (
               <img
-                src={`data:image/png;base64,${doc.first_page_base64}`}
+                src={doc.preview_url}
                 alt={doc.topic}
+                loading="lazy"
                 className="w-full h-40 object-cover rounded-md"
               />
             ) : (
@@ -90,6 +97,14 @@ const DocumentsPage = () => {
           </a>
         ))}
       </div>
+      {nextCursor && !loading && (
+        <button
+          onClick={() => fetchDocuments(lastQuery, nextCursor)}
+          className="mt-6 px-4 py-2 rounded-md border hover:shadow-md transition duration-300"
+        >
+          Load more
+        </button>
+      )}
     </div>
   );
 };
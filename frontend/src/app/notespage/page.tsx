@@ -41,20 +41,26 @@ const Page = () => {
 
   const [query, setQuery] = useState<string>("");
   const [loading, setLoading] = useState<boolean>(false);
+  const handleTaskStatus = (data: { state?: string; status?: string; result?: any }) => {
+    const status = data.status || data.state;
+    if (status === "done" || status === "SUCCESS") {
+      setResults(data.result);
+      setLoading(false);
+      return true;
+    } else if (status === "failed" || status === "error" || status === "FAILURE") {
+      toast.error("Failed to generate notes.");
+      setLoading(false);
+      return true;
+    }
+    return false;
+  };
+
   const pollTaskStatus = async (taskId: string |null)=> {
     const interval = setInterval(async () => {
       try {
         const res = await axios.get(`https://notecraft-backend-ag98.onrender.com/task_status/${taskId}/`);
-        const status = res.data.status || res.data.state;
-        
-        if (status === "done" || status === "SUCCESS") {
-          clearInterval(interval);
-          setResults(res.data.result);
-          setLoading(false);
-        } else if (status === "failed" || status === "error") {
+        if (handleTaskStatus(res.data)) {
           clearInterval(interval);
-          toast.error("Failed to generate notes.");
-          setLoading(false);
         }
       } catch (err) {
         clearInterval(interval);
@@ -63,6 +69,27 @@ const Page = () => {
       }
     }, 10000);
   };
+
+  // The backend pushes task state over SSE; fall back to polling if the stream can't be opened
+  const watchTaskStatus = (taskId: string | null) => {
+    if (typeof EventSource === "undefined") {
+      pollTaskStatus(taskId);
+      return;
+    }
+    const source = new EventSource(`https://notecraft-backend-ag98.onrender.com/events/tasks/${taskId}/`);
+    let finished = false;
+    source.onmessage = (event) => {
+      if (handleTaskStatus(JSON.parse(event.data))) {
+        finished = true;
+        source.close();
+      }
+    };
+    source.onerror = () => {
+      if (finished) return;
+      source.close();
+      pollTaskStatus(taskId);
+    };
+  };
   
   const handleSearch = async (query: string) => {
     if (!query) return;
@@ -76,7 +103,7 @@ const Page = () => {
         },
       );
       taskIdRef.current = response.data.task_id;
-      pollTaskStatus(taskIdRef.current);
+      watchTaskStatus(taskIdRef.current);
       // setResults(response.data);
       // setTimeout(() => {
       //   setResults(res);
@@ -12,6 +12,31 @@ export default function Page() {
   const { isLoggedIn } = useContext(AuthContext);
   const destination = isLoggedIn ? "/notespage" : "/login";
   const destination2 = isLoggedIn ? "/browse_pdfs" : "/login";
+  const watchUploadJob = (jobId: string, token: string | null) => {
+    const poll = async () => {
+      try {
+        const response = await axios.get(`https://notecraft-backend-ag98.onrender.com/upload_status/${jobId}/`, {
+          headers: { "Authorization": `Bearer ${token}` },
+          withCredentials: true
+        });
+        if (!response.data.done) {
+          setTimeout(poll, 2000);
+          return;
+        }
+        for (const file of response.data.files) {
+          if (file.result?.success) {
+            toast.success(`${file.file} uploaded successfully`);
+          } else {
+            toast.error(`Error uploading ${file.file}`);
+          }
+        }
+      } catch (error) {
+        toast.error("Error checking upload status");
+      }
+    };
+    poll();
+  };
+
   const handleUpload = async (data:FormData) => {
     try {
       const token = localStorage.getItem("accessToken");
@@ -22,8 +47,9 @@ export default function Page() {
         },
         withCredentials: true
       });
-      if (response.status === 201) {
-        toast.success("File uploaded successfully");
+      if (response.status === 202) {
+        toast.success(`Processing ${response.data.files.length} file(s)`);
+        watchUploadJob(response.data.job_id, token);
       }
     } catch (error) {
       toast.error("Error uploading file");